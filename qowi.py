@@ -2,55 +2,98 @@
 
 import argparse
 import sys
-from bitstring import BitStream
-from skimage import io
 
-from qowi.qowi_encoder import QOWIEncoder
-from qowi.qowi_decoder import QOWIDecoder
+from qowi import batch
+from qowi.color_transform import COLOR_TRANSFORMS
+from qowi.dictionary import DICTIONARY_NONE
+from qowi.header import CODECS
+from qowi.instrumentation import Instrumentation
+from qowi.prediction import PREDICTOR_NAMES
+from utils.progress_bar import progress_bar
 
 DEFAULT_HARD_THRESHOLD = -1
 DEFAULT_SOFT_THRESHOLD = -1
 DEFAULT_WAVELET_LEVELS = 10
 DEFAULT_WAVELET_PRECISION_DIGITS = 0
-
-def encode(source_path, dest_path, hard_threshold, soft_threshold, wavelet_levels, wavelet_precision_digits):
-    source_image = io.imread(source_path)
-
-    encoder = QOWIEncoder(hard_threshold, soft_threshold, wavelet_levels, wavelet_precision_digits)
-    encoder.from_array(source_image)
-    bitstream = BitStream()
-    encoder.to_bitstream(bitstream)
-    encoder.encode()
-
-    with open(dest_path, 'wb') as dest_file:
-        dest_file.write(bitstream.bytes)
+DEFAULT_COLOR_TRANSFORM = "none"
+DEFAULT_PREDICTOR = "auto"
+DEFAULT_MODE = "wavelet"
+DEFAULT_SUBBAND_WEIGHTS = (1, 1, 1)
+
+def encoder_options(hard_threshold, soft_threshold, wavelet_levels, wavelet_precision_digits, color_transform, haar_blocks=False, zerotrees=False, embedded=False, quantization_step=0, predictor=DEFAULT_PREDICTOR, mode=DEFAULT_MODE, dictionary_id=DICTIONARY_NONE, scratch_dir=None, subband_weights=DEFAULT_SUBBAND_WEIGHTS):
+    """Translates the CLI options to QOWIEncoder keyword arguments."""
+    return {
+        "hard_threshold": hard_threshold,
+        "soft_threshold": soft_threshold,
+        "wavelet_encode_levels": wavelet_levels,
+        "wavelet_precision_digits": wavelet_precision_digits,
+        "color_transform": COLOR_TRANSFORMS[color_transform],
+        "haar_blocks": haar_blocks,
+        "zerotrees": zerotrees,
+        "embedded": embedded,
+        "quantization_step": quantization_step,
+        "subband_weights": subband_weights,
+        "predictors": None if predictor == "auto" else (PREDICTOR_NAMES[predictor],) * 3,
+        "codec": None if mode == "auto" else CODECS[mode],
+        "dictionary_id": dictionary_id,
+        "scratch_dir": scratch_dir,
+    }
+
+def encode(source_path, dest_path, hard_threshold, soft_threshold, wavelet_levels, wavelet_precision_digits, color_transform, target_bytes=None, target_psnr=None, haar_blocks=False, zerotrees=False, embedded=False, quantization_step=0, predictor=DEFAULT_PREDICTOR, mode=DEFAULT_MODE, dictionary_id=DICTIONARY_NONE, scratch_dir=None, timings=False, subband_weights=DEFAULT_SUBBAND_WEIGHTS):
+    options = encoder_options(hard_threshold, soft_threshold, wavelet_levels, wavelet_precision_digits, color_transform, haar_blocks, zerotrees, embedded, quantization_step, predictor, mode, dictionary_id, scratch_dir, subband_weights)
+    options["progress_hook"] = progress_bar
+    options["instrumentation"] = Instrumentation() if timings else None
+    batch.encode_file(source_path, dest_path, options, target_bytes, target_psnr)
+    print()
+    if timings:
+        print(options["instrumentation"].summary())
 
     print("Encoding completed successfully.")
 
-def decode(source_path, dest_path):
-    with open(source_path, 'rb') as source_file:
-        input_stream = BitStream(source_file.read())
-
-    decoder = QOWIDecoder()
-    decoder.from_bitstream(input_stream)
-    decoder.decode()
-    decoded_image = decoder.as_array()
-
-    io.imsave(dest_path, decoded_image)
+def decode(source_path, dest_path, scratch_dir=None, timings=False):
+    instrumentation = Instrumentation() if timings else None
+    batch.decode_file(source_path, dest_path, progress_hook=progress_bar, scratch_dir=scratch_dir, instrumentation=instrumentation)
+    print()
+    if timings:
+        print(instrumentation.summary())
 
     print("Decoding completed successfully.")
 
+def report_batch(operation, result):
+    for source_path, error in result.failures:
+        print("Failed {}: {}".format(source_path, error))
+    print(result.summary(operation))
+    if result.failures:
+        sys.exit(1)
+
 def main():
     parser = argparse.ArgumentParser(description="Quite OK Wavelet Image (QOWI) Encoder/Decoder")
-    parser.add_argument("operation", type=str, choices=["encode", "decode"], help="Operation to perform: encode or decode")
-    parser.add_argument("source", type=str, help="Path to the source file")
-    parser.add_argument("destination", type=str, help="Path to the destination file")
+    parser.add_argument("operation", type=str, choices=["encode", "decode", "encode-batch", "decode-batch"], help="Operation to perform: encode or decode a file, or a batch of files")
+    parser.add_argument("source", type=str, nargs="+", help="Path to the source file. For batches, directories or glob patterns of source files")
+    parser.add_argument("destination", type=str, help="Path to the destination file. For batches, the destination directory")
+
+    # Batch-specific arguments
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes for batches. Defaults to the number of cores")
+    parser.add_argument("-f", "--force", action="store_true", help="Code batch files even when their output is newer than the source")
+    parser.add_argument("--timings", action="store_true", help="Print the time spent in each stage of coding a single file and the op counters")
+    parser.add_argument("--scratch-dir", type=str, default=None, help="Back the wavelet with memory-mapped scratch files in this directory, for images larger than memory")
 
     # Encoding-specific arguments
     parser.add_argument("-t", "--hard-threshold", type=int, default=DEFAULT_HARD_THRESHOLD, help="Wavelet hard threshold")
     parser.add_argument("-s", "--soft-threshold", type=int, default=DEFAULT_SOFT_THRESHOLD, help="Wavelet soft threshold")
     parser.add_argument("-w", "--wavelet-levels", type=int, default=DEFAULT_WAVELET_LEVELS, help="Number of wavelet levels to encode. Defaults to {}".format(DEFAULT_WAVELET_LEVELS))
     parser.add_argument("-p", "--wavelet-precision", type=int, default=DEFAULT_WAVELET_PRECISION_DIGITS, help="Precision in binary digits to round at each wavelet level. Defaults to {}".format(DEFAULT_WAVELET_PRECISION_DIGITS))
+    parser.add_argument("-b", "--target-bytes", type=int, default=None, help="Choose the hard threshold so the output fits in this many bytes")
+    parser.add_argument("-q", "--target-psnr", type=float, default=None, help="Choose the largest hard threshold that keeps this PSNR")
+    parser.add_argument("-c", "--color-transform", type=str, choices=list(COLOR_TRANSFORMS), default=DEFAULT_COLOR_TRANSFORM, help="Reversible color transform applied before the wavelet. Defaults to {}".format(DEFAULT_COLOR_TRANSFORM))
+    parser.add_argument("-z", "--quantization-step", type=float, default=0, help="Dead-zone quantizer step in pixel units, scaled per wavelet level. Steps of 1 or less are lossless")
+    parser.add_argument("--subband-weights", type=float, nargs=3, metavar=("HL", "LH", "HH"), default=DEFAULT_SUBBAND_WEIGHTS, help="Multipliers of the quantizer step for the HL, LH and HH subbands. Defaults to 1 1 1")
+    parser.add_argument("--predictor", type=str, choices=["auto"] + list(PREDICTOR_NAMES), default=DEFAULT_PREDICTOR, help="DELTA op predictor of every subband, or auto to pick the best per subband. Defaults to {}".format(DEFAULT_PREDICTOR))
+    parser.add_argument("-m", "--mode", type=str, choices=["auto"] + list(CODECS), default=DEFAULT_MODE, help="Code the pixels with the wavelet or the lossless spatial codec, or auto to estimate both on the whole image and pick the smaller, which takes a few times longer. Lossy settings always use the wavelet. Defaults to {}".format(DEFAULT_MODE))
+    parser.add_argument("-d", "--dictionary", type=int, default=DICTIONARY_NONE, help="ID of a cache dictionary trained with scripts/train_dictionary.py to preload the coders with. Defaults to {}, none".format(DICTIONARY_NONE))
+    parser.add_argument("--haar-blocks", action="store_true", help="Allow coding 2x2 blocks of finest level coefficients by their Haar sort rank")
+    parser.add_argument("--zerotrees", action="store_true", help="Allow coding an all zero coefficient subtree as a single op")
+    parser.add_argument("--embedded", action="store_true", help="Code the coefficients in bit-planes so any prefix of the file decodes. With --target-bytes the file is cut to that size")
 
     args = parser.parse_args()
 
@@ -58,20 +101,58 @@ def main():
     if not args.source or not args.destination:
         print("Error: Source and destination file paths must be provided.")
         sys.exit(1)
+    if args.operation in ("encode", "decode") and len(args.source) != 1:
+        print("Error: A single source file must be provided, use {}-batch for several.".format(args.operation))
+        sys.exit(1)
 
     if args.operation == "encode":
         encode(
-            args.source,
+            args.source[0],
             args.destination,
             args.hard_threshold,
             args.soft_threshold,
             args.wavelet_levels,
-            args.wavelet_precision
+            args.wavelet_precision,
+            args.color_transform,
+            args.target_bytes,
+            args.target_psnr,
+            args.haar_blocks,
+            args.zerotrees,
+            args.embedded,
+            args.quantization_step,
+            args.predictor,
+            args.mode,
+            args.dictionary,
+            args.scratch_dir,
+            args.timings,
+            args.subband_weights
         )
     elif args.operation == "decode":
         decode(
-            args.source,
-            args.destination)
+            args.source[0],
+            args.destination,
+            args.scratch_dir,
+            args.timings)
+    elif args.operation == "encode-batch":
+        options = encoder_options(
+            args.hard_threshold,
+            args.soft_threshold,
+            args.wavelet_levels,
+            args.wavelet_precision,
+            args.color_transform,
+            args.haar_blocks,
+            args.zerotrees,
+            args.embedded,
+            args.quantization_step,
+            args.predictor,
+            args.mode,
+            args.dictionary,
+            args.scratch_dir,
+            args.subband_weights
+        )
+        report_batch("Encoded", batch.encode_batch(args.source, args.destination, options, args.target_bytes, args.target_psnr, args.jobs, args.force))
+    elif args.operation == "decode-batch":
+        report_batch("Decoded", batch.decode_batch(args.source, args.destination, args.jobs, args.force, scratch_dir=args.scratch_dir))
     else:
         print("Error: Invalid operation specified.")
         sys.exit(1)
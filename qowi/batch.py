@@ -0,0 +1,351 @@
+"""
+Batch encoding and decoding of many files in one interpreter.
+
+Each batch runs as a pipeline: reader threads load the sources, a pool of worker processes runs the
+coders and writer threads save the outputs. The stages are joined by bounded queues, so the disk and the
+coders overlap while the memory held stays bounded by the queue depth.
+
+Sources are directories, which are searched recursively, or glob patterns. The outputs mirror the
+sources' paths relative to their directory (or just their names, for globs) under the destination
+directory, and an output newer than its source is considered up to date and skipped. Sources that would
+write the same output, such as x.png and x.bmp, all fail rather than overwrite each other.
+"""
+
+import glob
+import os
+import queue
+import threading
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from bitstring import BitStream
+from skimage import io as image_io
+
+from qowi.qowi_decoder import QOWIDecoder
+from qowi.qowi_encoder import QOWIEncoder
+
+IMAGE_EXTENSIONS = (".png", ".bmp", ".jpg", ".jpeg", ".gif", ".tif", ".tiff", ".webp")
+ENCODED_EXTENSION = ".qowi"
+DECODED_EXTENSION = ".png"
+
+# file reads and writes, including image decompression and compression, mostly release the GIL
+READER_THREADS = 2
+WRITER_THREADS = 2
+
+# files are handed to the workers in chunks of up to this many, so small images do not pay a round trip each
+BATCH_CHUNK_SIZE = 8
+
+# the number of chunks each stage of the pipeline may hold per worker
+QUEUE_DEPTH_PER_JOB = 2
+
+
+def read_image(source_path: str) -> np.ndarray:
+    return image_io.imread(source_path)
+
+
+def encode_image(source_image: np.ndarray, encoder_options: dict = None, target_bytes=None, target_psnr=None) -> tuple:
+    """
+    Encodes an image to the bytes of a QOWI file.
+
+    Parameters:
+    source_image (np.ndarray): The image to encode.
+    encoder_options (dict): Keyword arguments for QOWIEncoder.
+    target_bytes (int), target_psnr (float): The targets passed to QOWIEncoder.encode.
+
+    Returns:
+    tuple: The encoded bytes and the number of pixels encoded.
+    """
+    encoder = QOWIEncoder(**(encoder_options or {}))
+    encoder.from_array(source_image)
+    bitstream = BitStream()
+    encoder.to_bitstream(bitstream)
+    encoder.encode(target_bytes=target_bytes, target_psnr=target_psnr)
+    return bitstream.bytes, source_image.shape[0] * source_image.shape[1]
+
+
+def write_bytes(dest_path: str, data: bytes):
+    with open(dest_path, 'wb') as dest_file:
+        dest_file.write(data)
+
+
+def read_bytes(source_path: str) -> bytes:
+    with open(source_path, 'rb') as source_file:
+        return source_file.read()
+
+
+def decode_image(data: bytes, progress_hook=None, scratch_dir=None, instrumentation=None) -> tuple:
+    """
+    Decodes the bytes of a QOWI file.
+
+    Parameters:
+    data (bytes): The QOWI file.
+    progress_hook (callable), scratch_dir (str), instrumentation (Instrumentation): Passed to QOWIDecoder.
+
+    Returns:
+    tuple: The decoded image and its number of pixels.
+    """
+    decoder = QOWIDecoder(progress_hook=progress_hook, scratch_dir=scratch_dir, instrumentation=instrumentation)
+    decoder.from_bitstream(BitStream(data))
+    decoder.decode()
+    decoded_image = decoder.as_array()
+    return decoded_image, decoded_image.shape[0] * decoded_image.shape[1]
+
+
+def write_image(dest_path: str, image: np.ndarray):
+    image_io.imsave(dest_path, image, check_contrast=False)
+
+
+def encode_file(source_path: str, dest_path: str, encoder_options: dict = None, target_bytes=None, target_psnr=None) -> int:
+    """
+    Encodes an image file to a QOWI file.
+
+    Returns:
+    int: The number of pixels encoded.
+    """
+    data, num_pixels = encode_image(read_image(source_path), encoder_options, target_bytes, target_psnr)
+    write_bytes(dest_path, data)
+    return num_pixels
+
+
+def decode_file(source_path: str, dest_path: str, progress_hook=None, scratch_dir=None, instrumentation=None) -> int:
+    """
+    Decodes a QOWI file to an image file.
+
+    Returns:
+    int: The number of pixels decoded.
+    """
+    image, num_pixels = decode_image(read_bytes(source_path), progress_hook, scratch_dir, instrumentation)
+    write_image(dest_path, image)
+    return num_pixels
+
+
+def find_sources(sources, extensions) -> list:
+    """
+    Expands directories and glob patterns into files.
+
+    Parameters:
+    sources (list): Directories, searched recursively for files with one of the extensions, or glob patterns.
+    extensions (tuple): The lower case extensions of the files to find in directories.
+
+    Returns:
+    list: The sorted (path, relative path) of each file, where the relative path places its output.
+    """
+    ret = []
+    for source in sources:
+        if os.path.isdir(source):
+            for directory, _, filenames in os.walk(source):
+                for filename in filenames:
+                    if os.path.splitext(filename)[1].lower() in extensions:
+                        path = os.path.join(directory, filename)
+                        ret.append((path, os.path.relpath(path, source)))
+        else:
+            ret.extend((path, os.path.basename(path)) for path in glob.glob(source) if os.path.isfile(path))
+    return sorted(set(ret))
+
+
+def is_up_to_date(source_path: str, dest_path: str) -> bool:
+    return os.path.exists(dest_path) and os.path.getmtime(dest_path) >= os.path.getmtime(source_path)
+
+
+class BatchResult:
+    def __init__(self):
+        self.num_coded = 0
+        self.num_skipped = 0
+        self.failures = []
+        self.num_pixels = 0
+        self.duration = 0
+
+    @property
+    def megapixels_per_second(self) -> float:
+        return self.num_pixels / 1e6 / self.duration if self.duration > 0 else 0.0
+
+    def summary(self, operation: str) -> str:
+        return "{} {} files ({} up to date, {} failed): {:.2f} MP in {:.2f} seconds, {:.2f} MP/s".format(
+            operation, self.num_coded, self.num_skipped, len(self.failures), self.num_pixels / 1e6, self.duration, self.megapixels_per_second)
+
+
+def _describe(error: Exception) -> str:
+    return "{}: {}".format(type(error).__name__, error)
+
+
+def _compute(function, data, args) -> tuple:
+    """Runs the compute stage of one file, returning (result, pixels, error)."""
+    try:
+        result, num_pixels = function(data, *args)
+        return result, num_pixels, None
+    except Exception as error:
+        return None, 0, _describe(error)
+
+
+def _compute_chunk(function, chunk, args) -> list:
+    """Runs the compute stage of a chunk of files, returning the outcome of each. Runs in the worker processes."""
+    return [_compute(function, data, args) for data in chunk]
+
+
+def _run_batch(reader, compute, writer, sources, destination, extensions, dest_extension, args, jobs=None, force=False, queue_depth=None) -> BatchResult:
+    """
+    Runs a batch as a pipeline of reader threads, compute workers and writer threads joined by bounded
+    queues, so the disk and the coders overlap while at most a few chunks of files per worker are held in memory.
+    Files that are read while the workers are busy are sent to a worker together, up to BATCH_CHUNK_SIZE at a time.
+    """
+    start_time = time.time()
+    result = BatchResult()
+    result_lock = threading.Lock()
+
+    dest_sources = {}
+    for source_path, relative_path in find_sources(sources, extensions):
+        dest_path = os.path.join(destination, os.path.splitext(relative_path)[0] + dest_extension)
+        dest_sources.setdefault(os.path.normcase(dest_path), []).append((source_path, dest_path))
+
+    pending = deque()
+    for claims in dest_sources.values():
+        if len(claims) > 1:
+            for source_path, dest_path in claims:
+                others = ", ".join(other_path for other_path, _ in claims if other_path != source_path)
+                result.failures.append((source_path, "Output {} would also be written by {}".format(dest_path, others)))
+            continue
+
+        source_path, dest_path = claims[0]
+        if not force and is_up_to_date(source_path, dest_path):
+            result.num_skipped += 1
+        else:
+            pending.append((source_path, dest_path))
+
+    jobs = jobs or os.cpu_count() or 1
+    chunk_size = BATCH_CHUNK_SIZE if jobs > 1 else 1
+    if queue_depth:
+        # leave enough chunks within the queue depth to keep every worker busy
+        chunk_size = max(1, min(chunk_size, queue_depth // (QUEUE_DEPTH_PER_JOB * jobs)))
+    else:
+        queue_depth = QUEUE_DEPTH_PER_JOB * chunk_size * jobs
+    read_queue = queue.Queue(maxsize=queue_depth)
+    write_queue = queue.Queue(maxsize=queue_depth)
+
+    def record(source_path, num_pixels, error):
+        with result_lock:
+            if error is None:
+                result.num_coded += 1
+                result.num_pixels += num_pixels
+            else:
+                result.failures.append((source_path, error))
+
+    def read_files():
+        while True:
+            try:
+                source_path, dest_path = pending.popleft()
+            except IndexError:
+                read_queue.put(None)
+                return
+            try:
+                read_queue.put((source_path, dest_path, reader(source_path), None))
+            except Exception as error:
+                read_queue.put((source_path, dest_path, None, _describe(error)))
+
+    def write_files():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            source_path, dest_path, data, num_pixels, error = item
+            if error is None:
+                try:
+                    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+                    writer(dest_path, data)
+                except Exception as write_error:
+                    error = _describe(write_error)
+            record(source_path, num_pixels, error)
+
+    readers = [threading.Thread(target=read_files, daemon=True) for _ in range(READER_THREADS)]
+    writers = [threading.Thread(target=write_files, daemon=True) for _ in range(WRITER_THREADS)]
+    for thread in readers + writers:
+        thread.start()
+
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        # keep at most queue_depth files in the workers, handing finished ones to the writers in order
+        in_flight = deque()
+        num_in_flight = 0
+        chunk = []
+        num_readers_done = 0
+        while num_readers_done < len(readers) or chunk or in_flight:
+            if num_readers_done < len(readers) and len(chunk) < chunk_size and num_in_flight + len(chunk) < queue_depth:
+                # only wait for a file when there is no chunk to send meanwhile
+                try:
+                    item = read_queue.get(block=not chunk)
+                except queue.Empty:
+                    pass
+                else:
+                    if item is None:
+                        num_readers_done += 1
+                    elif item[3] is not None:
+                        source_path, dest_path, _, error = item
+                        write_queue.put((source_path, dest_path, None, 0, error))
+                    else:
+                        chunk.append(item[:3])
+                    continue
+
+            if chunk:
+                paths = [(source_path, dest_path) for source_path, dest_path, _ in chunk]
+                data = [data for _, _, data in chunk]
+                if executor is None:
+                    in_flight.append((paths, _compute_chunk(compute, data, args)))
+                else:
+                    in_flight.append((paths, executor.submit(_compute_chunk, compute, data, args)))
+                num_in_flight += len(chunk)
+                chunk = []
+                continue
+
+            paths, outcomes = in_flight.popleft()
+            num_in_flight -= len(paths)
+            if executor is not None:
+                outcomes = outcomes.result()
+            for (source_path, dest_path), outcome in zip(paths, outcomes):
+                write_queue.put((source_path, dest_path) + outcome)
+    finally:
+        # stop the readers, releasing any that are blocked on the full read queue, so they do not hold file data
+        pending.clear()
+        for thread in readers:
+            while thread.is_alive():
+                try:
+                    read_queue.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        for _ in writers:
+            write_queue.put(None)
+        for thread in writers:
+            thread.join()
+
+    result.duration = time.time() - start_time
+    return result
+
+
+def encode_batch(sources, destination: str, encoder_options: dict = None, target_bytes=None, target_psnr=None, jobs=None, force=False, queue_depth=None) -> BatchResult:
+    """
+    Encodes every image found in the sources to QOWI files under the destination directory.
+
+    Parameters:
+    sources (list): Directories or glob patterns of images.
+    destination (str): The output directory.
+    encoder_options (dict): Keyword arguments for QOWIEncoder.
+    target_bytes (int), target_psnr (float): The targets passed to QOWIEncoder.encode.
+    jobs (int): The number of worker processes. Defaults to the number of cores.
+    force (bool): Whether to encode images whose output is already up to date.
+    queue_depth (int): The number of files each stage may hold. Defaults to QUEUE_DEPTH_PER_JOB chunks per job.
+
+    Returns:
+    BatchResult: The counts, failures and throughput of the batch.
+    """
+    return _run_batch(read_image, encode_image, write_bytes, sources, destination, IMAGE_EXTENSIONS, ENCODED_EXTENSION,
+                      (encoder_options, target_bytes, target_psnr), jobs, force, queue_depth)
+
+
+def decode_batch(sources, destination: str, jobs=None, force=False, queue_depth=None, scratch_dir=None) -> BatchResult:
+    """
+    Decodes every QOWI file found in the sources to PNG files under the destination directory, like encode_batch.
+    The wavelets are backed by files in scratch_dir when it is given.
+    """
+    return _run_batch(read_bytes, decode_image, write_image, sources, destination, (ENCODED_EXTENSION,), DECODED_EXTENSION,
+                      (None, scratch_dir), jobs, force, queue_depth)
@@ -0,0 +1,71 @@
+"""
+Fast bit I/O for the integer coders. bitstring creates several objects for every read and append, which
+dominates coding time when each op is only a few bits, so these classes work on Python ints and bytes
+and only touch the BitStream in bulk.
+"""
+
+from bitstring import Bits, BitStream, ReadError
+
+# codes are gathered in an int until it holds this many bits, which keeps the shifts short
+WRITER_FLUSH_BITS = 4096
+
+# the number of bits inspected at a time when reading a run of ones
+READER_WINDOW_BITS = 32
+
+
+class BitWriter:
+    def __init__(self, bit_stream: BitStream):
+        self._bit_stream = bit_stream
+        self._value = 0
+        self._length = 0
+
+    def write(self, code: int, length: int):
+        """Appends the low length bits of code, most significant first."""
+        self._value = (self._value << length) | code
+        self._length += length
+        if self._length >= WRITER_FLUSH_BITS:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered bits to the BitStream. Must be called once writing is done."""
+        if self._length > 0:
+            self._bit_stream.append(Bits(uint=self._value, length=self._length))
+            self._value = 0
+            self._length = 0
+
+
+class BitReader:
+    def __init__(self, bit_stream: BitStream):
+        self._bit_stream = bit_stream
+        self._bytes = bit_stream.tobytes()
+        self._length = bit_stream.len
+        self.pos = bit_stream.pos
+
+    def read_uint(self, length: int) -> int:
+        """Reads length bits as an unsigned integer, most significant first."""
+        end = self.pos + length
+        if end > self._length:
+            raise ReadError("Cannot read {} bits, only {} available".format(length, self._length - self.pos))
+
+        value = int.from_bytes(self._bytes[self.pos >> 3:(end + 7) >> 3], 'big')
+        value = (value >> (-end & 7)) & ((1 << length) - 1)
+        self.pos = end
+        return value
+
+    def read_ones(self) -> int:
+        """Reads a run of one bits and the zero bit that ends it, returning the number of ones."""
+        count = 0
+        while True:
+            window = min(READER_WINDOW_BITS, self._length - self.pos)
+            if window <= 0:
+                raise ReadError("No zero bit ends the run of ones")
+
+            start = self.pos
+            zeros = ~self.read_uint(window) & ((1 << window) - 1)
+            if zeros == 0:
+                count += window
+                continue
+
+            ones = window - zeros.bit_length()
+            self.pos = start + ones + 1
+            return count + ones
@@ -0,0 +1,76 @@
+import numpy as np
+
+COLOR_TRANSFORM_NONE = 0
+COLOR_TRANSFORM_YCOCG_R = 1
+
+COLOR_TRANSFORMS = {
+    "none": COLOR_TRANSFORM_NONE,
+    "ycocg-r": COLOR_TRANSFORM_YCOCG_R,
+}
+
+
+def rgb_to_ycocg_r(image: np.ndarray) -> np.ndarray:
+    """
+    Applies the reversible YCoCg-R transform to the first three channels of an image.
+    Any additional channels (e.g. alpha) are passed through untouched.
+
+    Parameters:
+    image (np.ndarray): The (width, height, channels) RGB image, channels >= 3.
+
+    Returns:
+    np.ndarray: A signed integer image holding Y, Co and Cg in the first three channels.
+    """
+    ret = image.astype(np.int64)
+    r, g, b = ret[..., 0].copy(), ret[..., 1].copy(), ret[..., 2].copy()
+
+    co = r - b
+    t = b + (co >> 1)
+    cg = g - t
+    y = t + (cg >> 1)
+
+    ret[..., 0] = y
+    ret[..., 1] = co
+    ret[..., 2] = cg
+    return ret
+
+
+def ycocg_r_to_rgb(image: np.ndarray) -> np.ndarray:
+    """
+    Inverts the YCoCg-R transform applied by rgb_to_ycocg_r.
+
+    Parameters:
+    image (np.ndarray): The (width, height, channels) YCoCg-R image, channels >= 3.
+
+    Returns:
+    np.ndarray: A signed integer image holding R, G and B in the first three channels.
+    """
+    ret = image.astype(np.int64)
+    y, co, cg = ret[..., 0].copy(), ret[..., 1].copy(), ret[..., 2].copy()
+
+    t = y - (cg >> 1)
+    g = cg + t
+    b = t - (co >> 1)
+    r = b + co
+
+    ret[..., 0] = r
+    ret[..., 1] = g
+    ret[..., 2] = b
+    return ret
+
+
+def to_image(array: np.ndarray, transform: int) -> np.ndarray:
+    """
+    Converts the output of the inverse wavelet back to an 8-bit image.
+
+    Parameters:
+    array (np.ndarray): The signed integer image produced by the inverse wavelet.
+    transform (int): The color transform that was applied before the wavelet.
+
+    Returns:
+    np.ndarray: The uint8 image.
+    """
+    if transform == COLOR_TRANSFORM_YCOCG_R:
+        array = ycocg_r_to_rgb(array)
+
+    # lossy coefficients can overshoot the 8-bit range, which must saturate rather than wrap around
+    return np.clip(array, 0, 255).astype(np.uint8)
@@ -0,0 +1,120 @@
+"""
+Cache dictionaries: snapshots of the tokens a corpus of images codes most often, with their counts.
+
+Both integer coders preload the dictionary named by the header into their MFLRU cache, so frequent
+tokens can be coded with short CACHE ops from the first token, which matters for small images that
+never warm the cache on their own. Dictionary 0 is empty. Other dictionaries are registered in code or
+loaded on first use from {DICTIONARY_DIR}/{id}.json, which scripts/train_dictionary.py writes.
+
+The header also records a CRC32 of the entries, and the decoders refuse a dictionary that does not match
+it, since a retrained dictionary or a different file under the same ID would otherwise decode garbage.
+"""
+
+import json
+import os
+import threading
+import zlib
+import numpy as np
+from qowi.header import DICTIONARY_ID_BITS
+
+DICTIONARY_NONE = 0
+MAX_DICTIONARY_ID = (1 << DICTIONARY_ID_BITS) - 1
+DEFAULT_DICTIONARY_SIZE = 1024
+DICTIONARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dictionaries")
+
+_dictionaries = {DICTIONARY_NONE: ()}
+_dictionaries_lock = threading.Lock()
+
+
+def dictionary_path(dictionary_id: int, directory: str = DICTIONARY_DIR) -> str:
+    """The file a dictionary is loaded from when it has not been registered."""
+    return os.path.join(directory, "{}.json".format(dictionary_id))
+
+
+def register_dictionary(dictionary_id: int, entries):
+    """
+    Makes a dictionary available to the coders under an ID.
+
+    Parameters:
+    dictionary_id (int): The ID written to the header, in [1, MAX_DICTIONARY_ID].
+    entries (iterable): The (token, count) pairs, most frequent first.
+    """
+    if not DICTIONARY_NONE < dictionary_id <= MAX_DICTIONARY_ID:
+        raise ValueError("Dictionary IDs must be in [1, {}]".format(MAX_DICTIONARY_ID))
+    entries = tuple((tuple(token), int(count)) for token, count in entries)
+    with _dictionaries_lock:
+        _dictionaries[dictionary_id] = entries
+
+
+def dictionary_checksum(entries) -> int:
+    """The CRC32 of the (token, count) entries of a dictionary, or 0 for the empty dictionary."""
+    if not entries:
+        return 0
+    data = json.dumps([[list(token), count] for token, count in entries], separators=(",", ":"))
+    return zlib.crc32(data.encode("ascii"))
+
+
+def get_dictionary(dictionary_id: int, checksum: int = None) -> tuple:
+    """
+    Returns the (token, count) entries of a dictionary, loading it from DICTIONARY_DIR if it has not
+    been registered.
+
+    Parameters:
+    dictionary_id (int): The ID of the dictionary.
+    checksum (int): When given, the dictionary_checksum the entries must have, as recorded in a header.
+    """
+    with _dictionaries_lock:
+        entries = _dictionaries.get(dictionary_id)
+
+    if entries is None:
+        path = dictionary_path(dictionary_id)
+        if not os.path.exists(path):
+            raise ValueError("Unknown cache dictionary {}, expected {}".format(dictionary_id, path))
+        register_dictionary(dictionary_id, load_dictionary(path))
+        entries = _dictionaries[dictionary_id]
+
+    if checksum is not None and dictionary_checksum(entries) != checksum:
+        raise ValueError("Cache dictionary {} does not match the one the image was encoded with".format(dictionary_id))
+    return entries
+
+
+def save_dictionary(path: str, entries):
+    with open(path, "w") as dictionary_file:
+        json.dump({"entries": [[list(token), count] for token, count in entries]}, dictionary_file)
+
+
+def load_dictionary(path: str) -> tuple:
+    with open(path) as dictionary_file:
+        return tuple((tuple(token), count) for token, count in json.load(dictionary_file)["entries"])
+
+
+def train_dictionary(token_arrays, size: int = DEFAULT_DICTIONARY_SIZE) -> tuple:
+    """
+    Builds a dictionary from the tokens each image of a corpus codes.
+
+    The coders only observe the first token of a run, so repeats are dropped before counting. Each count
+    is the average number of observations per image, so a preloaded token carries the weight it would
+    typically gain within one image and the image's own frequent tokens can still overtake it.
+
+    Parameters:
+    token_arrays (list): An (n, channels) integer array per image, holding its tokens in coding order.
+    size (int): The maximum number of entries.
+
+    Returns:
+    tuple: The (token, count) entries, most frequent first.
+    """
+    counts = {}
+    for tokens in token_arrays:
+        tokens = np.asarray(tokens, dtype=np.int64)
+        if len(tokens) == 0:
+            continue
+
+        changed = np.concatenate(([True], np.any(tokens[1:] != tokens[:-1], axis=1)))
+        values, value_counts = np.unique(tokens[changed], axis=0, return_counts=True)
+        for token, count in zip(map(tuple, values.tolist()), value_counts.tolist()):
+            counts[token] = counts.get(token, 0) + count
+
+    # ties keep a stable order, so training is deterministic
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:size]
+    num_images = max(len(token_arrays), 1)
+    return tuple((token, max(1, round(count / num_images))) for token, count in ranked)
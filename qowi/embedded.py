@@ -0,0 +1,196 @@
+"""
+Embedded bit-plane coding of the wavelet detail coefficients, in the spirit of SPIHT.
+
+The coefficients are coded one magnitude bit-plane at a time, from the most significant plane down.
+Each plane has a sorting pass followed by a refinement pass:
+
+- The sorting pass walks the quad-trees level by level from the coarsest. For every visible coefficient
+  that is not yet significant it sends whether the coefficient is significant in this plane, followed by
+  the signs of the newly significant ones. For every visible coefficient with descendants whose
+  descendants are not yet known to be significant it sends whether any descendant is significant in
+  this plane. The children of a coefficient become visible once its descendants are significant, so
+  insignificant subtrees cost a single bit per plane.
+- The refinement pass sends this plane's magnitude bit of every coefficient that was already
+  significant before the plane.
+
+The integer Haar transform doubles the scale of the coefficients at every coarser level, so each
+coefficient is weighted by 2 ** level (level 0 being the coarsest) before coding. Equal weighted
+magnitudes then contribute equally to the squared error, and the planes below a level's weight, which
+are known to be zero, are skipped for that level.
+
+Each channel has its own quad-trees. Since every pass sends the bits that matter most first, any
+prefix of the stream decodes to a valid image, and the decoder places coefficients with unknown low
+bits in the middle of their remaining range.
+"""
+
+import numpy as np
+import qowi.entropy as entropy
+from bitstring import Bits, BitStream, ReadError
+from qowi.wavelet import Wavelet
+
+
+def _upsample(mask: np.ndarray) -> np.ndarray:
+    """Marks the four children of every marked coefficient of a (3, length, length, channels) mask."""
+    return mask.repeat(2, axis=1).repeat(2, axis=2)
+
+
+def _descendant_maxima(magnitudes: list) -> list:
+    """The largest magnitude among the descendants of each coefficient that has descendants."""
+    ret = [None] * (len(magnitudes) - 1)
+    subtree_maxima = magnitudes[-1] if magnitudes else None
+    for level in reversed(range(len(magnitudes) - 1)):
+        length = 2 ** level
+        ret[level] = subtree_maxima.reshape((3, length, 2, length, 2) + subtree_maxima.shape[3:]).max(axis=(2, 4))
+        subtree_maxima = np.maximum(magnitudes[level], ret[level])
+    return ret
+
+
+class EmbeddedEncoder:
+    def __init__(self, bit_stream: BitStream):
+        self._response = bit_stream
+
+    def _append(self, bits: np.ndarray):
+        if len(bits) > 0:
+            self._response.append(Bits(bytes=np.packbits(bits).tobytes(), length=len(bits)))
+
+    def encode(self, wavelet: Wavelet):
+        """
+        Encodes the detail coefficients of the wavelet, i.e. everything but the root.
+
+        Parameters:
+        wavelet (Wavelet): The wavelet to encode.
+        """
+        num_levels = wavelet.num_levels
+        coefficients = [np.stack(wavelet.detail_bands(level)).astype(np.int64) for level in range(num_levels)]
+        magnitudes = [np.abs(c) << level for level, c in enumerate(coefficients)]
+        descendant_maxima = _descendant_maxima(magnitudes)
+
+        num_planes = max((int(np.max(m)).bit_length() for m in magnitudes), default=0)
+        self._response.append(entropy.simple_encode(num_planes))
+
+        significant = [np.zeros(m.shape, dtype=bool) for m in magnitudes]
+        descendants_significant = [np.zeros(m.shape, dtype=bool) for m in descendant_maxima]
+        for plane in reversed(range(num_planes)):
+            threshold = 1 << plane
+            previously_significant = [s.copy() for s in significant]
+
+            # sorting pass
+            visible = np.ones(magnitudes[0].shape, dtype=bool) if num_levels > 0 else None
+            for level in range(num_levels):
+                if plane >= level:
+                    candidates = visible & ~significant[level]
+                    newly_significant = candidates & (magnitudes[level] >= threshold)
+                    self._append(newly_significant[candidates])
+                    self._append(coefficients[level][newly_significant] < 0)
+                    significant[level] |= newly_significant
+
+                if level + 1 < num_levels:
+                    if plane >= level + 1:
+                        candidates = visible & ~descendants_significant[level]
+                        newly_significant = candidates & (descendant_maxima[level] >= threshold)
+                        self._append(newly_significant[candidates])
+                        descendants_significant[level] |= newly_significant
+                    visible = _upsample(descendants_significant[level])
+
+            # refinement pass
+            for level in range(min(plane + 1, num_levels)):
+                self._append((magnitudes[level][previously_significant[level]] >> plane) & 1 == 1)
+
+
+class EmbeddedDecoder:
+    def __init__(self, bitstream: BitStream):
+        self._bitstream = bitstream
+        self.truncated = False
+
+    def _available(self) -> int:
+        return self._bitstream.len - self._bitstream.pos
+
+    def _read(self, count: int) -> np.ndarray:
+        """Reads count bits, or None when the stream ends first."""
+        if count > self._available():
+            self.truncated = True
+            return None
+        if count == 0:
+            return np.zeros(0, dtype=bool)
+
+        bits = self._bitstream.read(count)
+        return np.unpackbits(np.frombuffer(bits.tobytes(), dtype=np.uint8), count=count).astype(bool)
+
+    def decode(self, wavelet: Wavelet):
+        """
+        Decodes the detail coefficients into the wavelet, whose root must already be set. A truncated
+        stream decodes every complete step and the available refinement bits, then sets truncated.
+
+        Parameters:
+        wavelet (Wavelet): The wavelet to decode into, initialized to the encoded shape.
+        """
+        num_levels = wavelet.num_levels
+        shapes = [(3, 2 ** level, 2 ** level, wavelet.color_depth) for level in range(num_levels)]
+
+        significant = [np.zeros(shape, dtype=bool) for shape in shapes]
+        negative = [np.zeros(shape, dtype=bool) for shape in shapes]
+        known = [np.zeros(shape, dtype=np.int64) for shape in shapes]
+        lowest_plane = [np.zeros(shape, dtype=np.int64) for shape in shapes]
+        descendants_significant = [np.zeros(shape, dtype=bool) for shape in shapes[:-1]]
+
+        try:
+            num_planes = entropy.simple_decode(self._bitstream)
+        except ReadError:
+            self.truncated = True
+            num_planes = 0
+
+        for plane in reversed(range(num_planes)):
+            if self.truncated:
+                break
+
+            threshold = 1 << plane
+            previously_significant = [s.copy() for s in significant]
+
+            # sorting pass
+            visible = np.ones(shapes[0], dtype=bool) if num_levels > 0 else None
+            for level in range(num_levels):
+                if plane >= level:
+                    candidates = visible & ~significant[level]
+                    bits = self._read(np.count_nonzero(candidates))
+                    if bits is None:
+                        break
+                    newly_significant = np.zeros(shapes[level], dtype=bool)
+                    newly_significant[candidates] = bits
+
+                    signs = self._read(np.count_nonzero(newly_significant))
+                    if signs is None:
+                        break
+                    negative[level][newly_significant] = signs
+                    significant[level] |= newly_significant
+                    known[level][newly_significant] = threshold
+                    lowest_plane[level][newly_significant] = plane
+
+                if level + 1 < num_levels:
+                    if plane >= level + 1:
+                        candidates = visible & ~descendants_significant[level]
+                        bits = self._read(np.count_nonzero(candidates))
+                        if bits is None:
+                            break
+                        descendants_significant[level][candidates] = bits
+                    visible = _upsample(descendants_significant[level])
+
+            if self.truncated:
+                break
+
+            # refinement pass, applying whatever bits are available
+            for level in range(min(plane + 1, num_levels)):
+                positions = np.flatnonzero(previously_significant[level])
+                bits = self._read(min(len(positions), self._available()))
+                positions = positions[:len(bits)]
+                known[level].flat[positions] |= bits.astype(np.int64) << plane
+                lowest_plane[level].flat[positions] = plane
+                if len(positions) < np.count_nonzero(previously_significant[level]):
+                    self.truncated = True
+                    break
+
+        # place each coefficient in the middle of the range its unknown low bits leave open
+        for level in range(num_levels):
+            magnitude = (known[level] >> level) + ((1 << np.maximum(lowest_plane[level] - level, 0)) >> 1)
+            values = np.where(significant[level], np.where(negative[level], -magnitude, magnitude), 0)
+            for band, band_values in zip(wavelet.detail_bands(level), values):
+                band[:] = band_values
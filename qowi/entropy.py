@@ -6,7 +6,7 @@ from bitstring import BitArray, Bits, BitStream
 DEFAULT_M = 4 # TODO: figure out how to optimize this number for each data distribution
 
 def calculate_order(value: int) -> int:
-    return math.floor(math.log2(value + 2))
+    return (value + 2).bit_length() - 1
 
 
 def simple_encode(uint_value: int) -> Bits:
@@ -24,6 +24,34 @@ def simple_encode(uint_value: int) -> Bits:
     return leading_bits + data_bits
 
 
+def simple_code(uint_value: int) -> tuple:
+    """Returns the simple encoding of uint_value as a (code, length) pair of ints, for a BitWriter."""
+    if uint_value < 0:
+        raise ValueError("Entropy encoding cannot be negative")
+
+    order = calculate_order(uint_value)
+    leading_ones = (1 << (order - 1)) - 1
+    return (leading_ones << (order + 1)) | (uint_value - (1 << order) + 2), 2 * order
+
+
+def simple_code_tuple(uint_tuple) -> tuple:
+    """Returns the simple encodings of the values in uint_tuple as a single (code, length) pair."""
+    code, length = 0, 0
+    for uint_value in uint_tuple:
+        value_code, value_length = simple_code(uint_value)
+        code = (code << value_length) | value_code
+        length += value_length
+    return code, length
+
+
+def simple_encode_length(uint_value: int) -> int:
+    return 2 * calculate_order(uint_value)
+
+
+def simple_encode_tuple_length(uint_tuple) -> int:
+    return sum(simple_encode_length(v) for v in uint_tuple)
+
+
 def simple_decode(bit_stream: BitStream) -> int:
     order = 1
     offset = 0
@@ -40,6 +68,16 @@ def simple_decode(bit_stream: BitStream) -> int:
     return offset + delta
 
 
+def simple_decode_reader(reader) -> int:
+    """Decodes a simple encoded value from a BitReader, which is much faster than simple_decode."""
+    order = reader.read_ones() + 1
+    return (1 << order) - 2 + reader.read_uint(order)
+
+
+def simple_decode_tuple_reader(reader, num_to_decode=1) -> tuple:
+    return tuple(simple_decode_reader(reader) for _ in range(num_to_decode))
+
+
 def simple_encode_tuple(uint_tuple) -> Bits:
     orders = np.array([calculate_order(v) for v in uint_tuple], dtype=int)
     offsets = (2 ** orders) - 2
@@ -61,12 +99,21 @@ def simple_decode_tuple(bit_stream: BitStream, num_to_decode=1) -> tuple:
     return tuple(ret)
 
 
+def calculate_order_ndarray(uint_array: np.ndarray) -> np.ndarray:
+    """calculate_order of each value, exact like the scalar version even where log2 rounds across a power of two."""
+    values = (uint_array + 2).astype(np.uint64)
+    order = np.log2(values).astype(np.int64)
+    order -= np.left_shift(np.uint64(1), order.astype(np.uint64)) > values
+    order += np.left_shift(np.uint64(1), (order + 1).astype(np.uint64)) <= values
+    return order
+
+
 def simple_encode_ndarray(uint_array: np.ndarray) -> Bits:
     if not np.issubdtype(uint_array.dtype, np.integer):
         raise ValueError("Input array must have an unsigned integer dtype.")
 
     # Vectorized calculation for encoding
-    order = np.floor(np.log2(uint_array + 2)).astype(int)
+    order = calculate_order_ndarray(uint_array)
     offset = (2 ** order) - 2
     delta = uint_array - offset
 
@@ -79,6 +126,10 @@ def simple_encode_ndarray(uint_array: np.ndarray) -> Bits:
     return ret
 
 
+def simple_encode_length_ndarray(uint_array: np.ndarray) -> np.ndarray:
+    return 2 * calculate_order_ndarray(uint_array)
+
+
 def simple_decode_ndarray(bit_stream: BitStream, num_to_decode=1, dtype=np.uint32) -> np.ndarray:
     values = []
     for _ in range(num_to_decode):
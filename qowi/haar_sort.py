@@ -0,0 +1,191 @@
+import numpy as np
+import threading
+from qowi.integers import integer_to_zigzag_ndarray
+from qowi.wavelet import haar_encode, haar_decode
+
+DEFAULT_BIT_DEPTH = 8
+
+_shared_ranks = {}
+_shared_ranks_lock = threading.Lock()
+
+
+def _zigzag_interval(z):
+    """
+    The integers with a zigzag value below z form the interval [low, high], since the zigzag order
+    is 0, 1, -1, 2, -2, ... The interval is empty (low > high) when z == 0.
+    """
+    z = np.asarray(z, dtype=np.int64)
+    high = np.where(z > 0, (z - 1) // 2, -1)
+    low = np.where(z > 0, np.minimum(0, -((z - 2) // 2)), 0)
+    return low, high
+
+
+def _zigzag_to_integer_ndarray(z):
+    return np.where(z & 1 == 0, z >> 1, -(z >> 1))
+
+
+def _triangle(y):
+    """Number of non-negative integer pairs with sum at most y."""
+    y = np.maximum(y + 1, 0)
+    return y * (y + 1) // 2
+
+
+def _ceil_div(a, b):
+    return -((-a) // b)
+
+
+def _search(count, ranks, num_values):
+    """
+    Vectorized binary search for the largest z in [0, num_values) with count(z) <= ranks, where count
+    is non-decreasing in z and count(0) == 0.
+    """
+    low = np.zeros_like(ranks)
+    high = np.full_like(ranks, num_values)
+    while np.any(high - low > 1):
+        mid = (low + high) // 2
+        below = count(mid) <= ranks
+        low = np.where(below, mid, low)
+        high = np.where(below, high, mid)
+    return low
+
+
+class HaarSortRank:
+    """
+    Closed-form position of 2x2 grids in the Haar sort order, without materializing the sort table.
+
+    Grids (a, b, c, d) are ordered by their haar_encode coefficients: by LL, then by the zigzag values of
+    HL, LH and HH. This is the same order scripts/haar_sort_generator.py writes, but instead of a table
+    with an entry per grid (16 GB each way at 8 bits) the rank is assembled from a count table per LL
+    and per (LL, HL) pair, about 8 MB at 8 bits. The counts within a fixed (LL, HL) pair are lattice
+    point counts in a rectangle and are computed directly.
+
+    With P = a + b and Q = c + d fixed by LL and HL, LH = 2 (a + c) - LL and HH = 4 a - 2 (a + c) - HL,
+    so counting grids below a given LH or HH means counting (a, c) pairs in an interval of sums or
+    differences.
+    """
+    def __init__(self, bit_depth=DEFAULT_BIT_DEPTH):
+        self.bit_depth = bit_depth
+        self.max_value = (1 << bit_depth) - 1
+        self.num_grids = 1 << (4 * bit_depth)
+        self._num_ll = 4 * self.max_value + 1
+        self._num_zigzag = 4 * self.max_value + 2  # detail coefficients lie in [-2 * max_value, 2 * max_value]
+
+        # pair_counts[p] is the number of (a, b) pairs with a + b == p
+        pair_counts = np.convolve(np.ones(self.max_value + 1, dtype=np.int64), np.ones(self.max_value + 1, dtype=np.int64))
+
+        # ll_starts[ll] is the rank of the first grid with that LL
+        ll_counts = np.convolve(pair_counts, pair_counts)
+        self._ll_starts = np.concatenate([[0], np.cumsum(ll_counts)])
+
+        # hl_counts[ll, hl + 2 * max_value] is the number of grids with that LL and HL
+        ll = np.arange(self._num_ll)[:, None]
+        hl = np.arange(-2 * self.max_value, 2 * self.max_value + 1)[None, :]
+        p = (ll + hl) // 2
+        q = (ll - hl) // 2
+        valid = ((ll + hl) % 2 == 0) & (p >= 0) & (p <= 2 * self.max_value) & (q >= 0) & (q <= 2 * self.max_value)
+        hl_counts = np.where(valid, pair_counts[np.clip(p, 0, 2 * self.max_value)] * pair_counts[np.clip(q, 0, 2 * self.max_value)], 0)
+        hl_cumulative = np.concatenate([np.zeros((self._num_ll, 1), dtype=np.int64), np.cumsum(hl_counts, axis=1)], axis=1)
+
+        # hl_starts[ll, z] is the number of grids with that LL whose HL has a zigzag value below z
+        low, high = _zigzag_interval(np.arange(self._num_zigzag + 1))
+        low = np.clip(low + 2 * self.max_value, 0, 4 * self.max_value + 1)
+        high = np.clip(high + 2 * self.max_value + 1, 0, 4 * self.max_value + 1)
+        self._hl_starts = np.maximum(hl_cumulative[:, high] - hl_cumulative[:, low], 0)
+
+    def _check_grids(self, grids):
+        grids = np.asarray(grids, dtype=np.int64)
+        if grids.shape[-1:] != (4,):
+            raise ValueError("Grids must have a last dimension of 4, got shape {}".format(grids.shape))
+        if np.any((grids < 0) | (grids > self.max_value)):
+            raise ValueError("Grid values must be in [0, {}]".format(self.max_value))
+        return grids
+
+    def _pair_range(self, total):
+        """The range [low, high] of a in the pairs (a, b) with a + b == total."""
+        return np.maximum(0, total - self.max_value), np.minimum(self.max_value, total)
+
+    def _lh_count(self, ll, hl, z):
+        """Number of grids with this LL and HL whose LH has a zigzag value below z."""
+        a_low, a_high = self._pair_range((ll + hl) // 2)
+        c_low, c_high = self._pair_range((ll - hl) // 2)
+        num_a = a_high - a_low + 1
+        num_c = c_high - c_low + 1
+
+        def pairs_with_sum_at_most(s):
+            y = s - a_low - c_low
+            return _triangle(y) - _triangle(y - num_a) - _triangle(y - num_c) + _triangle(y - num_a - num_c)
+
+        low, high = _zigzag_interval(z)
+        s_low = _ceil_div(low + ll, 2)
+        s_high = (high + ll) // 2
+        return np.where(s_high >= s_low, pairs_with_sum_at_most(s_high) - pairs_with_sum_at_most(s_low - 1), 0)
+
+    def _hh_count(self, ll, hl, lh, z):
+        """Number of grids with this LL, HL and LH whose HH has a zigzag value below z."""
+        s = (ll + lh) // 2
+        a_low, a_high = self._pair_range((ll + hl) // 2)
+        c_low, c_high = self._pair_range((ll - hl) // 2)
+        a_low = np.maximum(a_low, s - c_high)
+        a_high = np.minimum(a_high, s - c_low)
+
+        low, high = _zigzag_interval(z)
+        a_low = np.maximum(a_low, _ceil_div(low + 2 * s + hl, 4))
+        a_high = np.minimum(a_high, (high + 2 * s + hl) // 4)
+        return np.maximum(a_high - a_low + 1, 0)
+
+    def first_rank(self, ll: int) -> int:
+        """The rank of the first grid with this LL, a lower bound on the rank of every grid with it."""
+        return int(self._ll_starts[ll])
+
+    def rank(self, grids):
+        """
+        Finds the Haar sort position of a batch of grids.
+
+        Parameters:
+        grids (np.ndarray): An array of shape (..., 4) holding the values (a, b, c, d) of each grid.
+
+        Returns:
+        np.ndarray: An int64 array of shape (...) holding the position of each grid in the Haar sort order.
+        """
+        grids = self._check_grids(grids)
+        ll, hl, lh, hh = haar_encode(grids[..., 0], grids[..., 1], grids[..., 2], grids[..., 3])
+        return (self._ll_starts[ll]
+                + self._hl_starts[ll, integer_to_zigzag_ndarray(hl)]
+                + self._lh_count(ll, hl, integer_to_zigzag_ndarray(lh))
+                + self._hh_count(ll, hl, lh, integer_to_zigzag_ndarray(hh)))
+
+    def unrank(self, ranks):
+        """
+        Finds the grids at a batch of Haar sort positions.
+
+        Parameters:
+        ranks (np.ndarray): An array of positions in the Haar sort order.
+
+        Returns:
+        np.ndarray: An int64 array of shape ranks.shape + (4,) holding the values (a, b, c, d) of each grid.
+        """
+        ranks = np.asarray(ranks, dtype=np.int64)
+        if np.any((ranks < 0) | (ranks >= self.num_grids)):
+            raise ValueError("Haar sort positions must be in [0, {})".format(self.num_grids))
+
+        ll = np.searchsorted(self._ll_starts, ranks, side="right") - 1
+        ranks = ranks - self._ll_starts[ll]
+
+        hl_zigzag = _search(lambda z: self._hl_starts[ll, z], ranks, self._num_zigzag)
+        ranks = ranks - self._hl_starts[ll, hl_zigzag]
+        hl = _zigzag_to_integer_ndarray(hl_zigzag)
+
+        lh_zigzag = _search(lambda z: self._lh_count(ll, hl, z), ranks, self._num_zigzag)
+        ranks = ranks - self._lh_count(ll, hl, lh_zigzag)
+        lh = _zigzag_to_integer_ndarray(lh_zigzag)
+
+        hh = _zigzag_to_integer_ndarray(_search(lambda z: self._hh_count(ll, hl, lh, z), ranks, self._num_zigzag))
+        return np.stack(haar_decode(ll, hl, lh, hh), axis=-1)
+
+
+def get_haar_sort_rank(bit_depth=DEFAULT_BIT_DEPTH) -> HaarSortRank:
+    """Returns a HaarSortRank shared by all callers, so the count tables are only built once per bit depth."""
+    with _shared_ranks_lock:
+        if bit_depth not in _shared_ranks:
+            _shared_ranks[bit_depth] = HaarSortRank(bit_depth)
+        return _shared_ranks[bit_depth]
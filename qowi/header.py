@@ -1,4 +1,5 @@
 from bitstring import BitStream, Bits, BitArray
+import qowi.entropy as entropy
 
 WIDTH_NUM_BITS = 16
 HEIGHT_NUM_BITS = 16
@@ -6,6 +7,23 @@ COLOR_DEPTH_BITS = 2
 CACHE_NUM_BITS = 16
 WAVELET_LEVELS_BITS = 4
 WAVELET_PRECISION_DIGITS_BITS = 8
+COLOR_TRANSFORM_BITS = 2
+HAAR_BLOCKS_BITS = 1
+ZEROTREES_BITS = 1
+EMBEDDED_BITS = 1
+CODEC_BITS = 1
+DICTIONARY_ID_BITS = 8
+DICTIONARY_CHECKSUM_BITS = 32
+PREDICTOR_BITS = 2
+
+# the codec the pixels are coded with, the wavelet coder or the raster order spatial coder
+CODEC_WAVELET = 0
+CODEC_SPATIAL = 1
+
+CODECS = {
+    "wavelet": CODEC_WAVELET,
+    "spatial": CODEC_SPATIAL,
+}
 
 class Header:
 
@@ -16,6 +34,15 @@ class Header:
         self.cache_size = None
         self.wavelet_levels = None
         self.wavelet_precision_digits = None
+        self.color_transform = 0
+        self.haar_blocks = False
+        self.zerotrees = False
+        self.embedded = False
+        self.codec = CODEC_WAVELET
+        self.dictionary_id = 0
+        self.dictionary_checksum = 0
+        self.predictors = (0, 0, 0)
+        self.quantization_steps = []
 
     def header_bits(self) -> Bits:
         buffer = BitArray()
@@ -25,6 +52,22 @@ class Header:
         buffer.append(Bits(uint=self.cache_size, length=CACHE_NUM_BITS))
         buffer.append(Bits(uint=self.wavelet_levels, length=WAVELET_LEVELS_BITS))
         buffer.append(Bits(uint=self.wavelet_precision_digits, length=WAVELET_PRECISION_DIGITS_BITS))
+        buffer.append(Bits(uint=self.color_transform, length=COLOR_TRANSFORM_BITS))
+        buffer.append(Bits(uint=int(self.haar_blocks), length=HAAR_BLOCKS_BITS))
+        buffer.append(Bits(uint=int(self.zerotrees), length=ZEROTREES_BITS))
+        buffer.append(Bits(uint=int(self.embedded), length=EMBEDDED_BITS))
+        buffer.append(Bits(uint=self.codec, length=CODEC_BITS))
+        buffer.append(Bits(uint=self.dictionary_id, length=DICTIONARY_ID_BITS))
+        # the checksum of the dictionary, so a decoder with a different dictionary under the ID fails, unless none is used
+        if self.dictionary_id != 0:
+            buffer.append(Bits(uint=self.dictionary_checksum, length=DICTIONARY_CHECKSUM_BITS))
+        for predictor in self.predictors:
+            buffer.append(Bits(uint=predictor, length=PREDICTOR_BITS))
+
+        # the quantizer step table has an entry per level, so it is variable length
+        buffer.append(entropy.simple_encode(len(self.quantization_steps)))
+        for level_steps in self.quantization_steps:
+            buffer.append(entropy.simple_encode_tuple(level_steps))
         return buffer
 
     def read(self, bitstream: BitStream):
@@ -34,6 +77,17 @@ class Header:
         self.cache_size = bitstream.read(CACHE_NUM_BITS).uint
         self.wavelet_levels = bitstream.read(WAVELET_LEVELS_BITS).uint
         self.wavelet_precision_digits = bitstream.read(WAVELET_PRECISION_DIGITS_BITS).uint
+        self.color_transform = bitstream.read(COLOR_TRANSFORM_BITS).uint
+        self.haar_blocks = bitstream.read(HAAR_BLOCKS_BITS).uint == 1
+        self.zerotrees = bitstream.read(ZEROTREES_BITS).uint == 1
+        self.embedded = bitstream.read(EMBEDDED_BITS).uint == 1
+        self.codec = bitstream.read(CODEC_BITS).uint
+        self.dictionary_id = bitstream.read(DICTIONARY_ID_BITS).uint
+        self.dictionary_checksum = bitstream.read(DICTIONARY_CHECKSUM_BITS).uint if self.dictionary_id != 0 else 0
+        self.predictors = tuple(bitstream.read(PREDICTOR_BITS).uint for _ in range(3))
+
+        num_quantized_levels = entropy.simple_decode(bitstream)
+        self.quantization_steps = [entropy.simple_decode_tuple(bitstream, 3) for _ in range(num_quantized_levels)]
 
     def __eq__(self, other):
-        return self.width == other.width and self.height == other.height and self.color_depth == other.color_depth and self.cache_size == other.cache_size and self.wavelet_levels == other.wavelet_levels and self.wavelet_precision_digits == other.wavelet_precision_digits
+        return self.width == other.width and self.height == other.height and self.color_depth == other.color_depth and self.cache_size == other.cache_size and self.wavelet_levels == other.wavelet_levels and self.wavelet_precision_digits == other.wavelet_precision_digits and self.color_transform == other.color_transform and self.haar_blocks == other.haar_blocks and self.zerotrees == other.zerotrees and self.embedded == other.embedded and self.codec == other.codec and self.dictionary_id == other.dictionary_id and self.dictionary_checksum == other.dictionary_checksum and self.predictors == other.predictors and self.quantization_steps == other.quantization_steps
@@ -0,0 +1,95 @@
+"""
+Per-stage timing and counters for the coders, to see where the time goes without a profiler.
+
+The coders take an optional Instrumentation. Without one they behave exactly as before: the stages are
+entered through stage(), which is a no-op for None, and the per-token methods are only wrapped with timers
+and counters when an Instrumentation is given, so the disabled path costs nothing per token.
+
+Stage times are exclusive: while a nested stage runs, such as bit I/O inside integer coding, its time is
+charged to it and not to the enclosing stage, so the timings add up to the instrumented wall-clock time.
+An Instrumentation keeps no shared state, but it must only be used by one coder at a time.
+"""
+
+import contextlib
+import time
+
+STAGE_CODEC_CHOICE = "codec_choice"
+STAGE_TRANSFORM = "transform"
+STAGE_THRESHOLD = "threshold"
+STAGE_PREDICTOR_CHOICE = "predictor_choice"
+STAGE_TRAVERSAL = "traversal"
+STAGE_INTEGER_CODING = "integer_coding"
+STAGE_EMBEDDED_CODING = "embedded_coding"
+STAGE_BIT_IO = "bit_io"
+STAGE_DEQUANTIZE = "dequantize"
+STAGE_INVERSE_TRANSFORM = "inverse_transform"
+
+
+class Instrumentation:
+    def __init__(self, hook=None):
+        """
+        Parameters:
+        hook (callable): Called with (stage, seconds) whenever a stage entered with stage() ends, where seconds
+                         is the wall-clock time of that stage including any nested stages. The per-token stages
+                         are not reported to the hook, their totals are in timings.
+        """
+        self.timings = {}
+        self.counters = {}
+        self._hook = hook
+        self._stages = []
+        self._mark = 0.0
+
+    def _enter(self, name):
+        now = time.perf_counter()
+        if self._stages:
+            self._charge(self._stages[-1], now)
+        self._stages.append(name)
+        self._mark = now
+
+    def _exit(self):
+        now = time.perf_counter()
+        self._charge(self._stages.pop(), now)
+        self._mark = now
+
+    def _charge(self, name, now):
+        self.timings[name] = self.timings.get(name, 0.0) + now - self._mark
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """A context for a coarse stage of coding, reported to the hook when it ends."""
+        start = time.perf_counter()
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+            if self._hook is not None:
+                self._hook(name, time.perf_counter() - start)
+
+    def timed(self, function, name):
+        """Wraps a function, usually a bound method called per token, so the time spent in it is charged to a stage."""
+        def timed_function(*args, **kwargs):
+            self._enter(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._exit()
+        return timed_function
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self) -> str:
+        """The stage times, longest first, and the counters as lines of text."""
+        total = sum(self.timings.values())
+        lines = ["{:<18} {:9.4f} s {:6.1%}".format(name, seconds, seconds / total if total > 0 else 0)
+                 for name, seconds in sorted(self.timings.items(), key=lambda item: -item[1])]
+        lines.extend("{:<18} {:>11}".format(name, count) for name, count in sorted(self.counters.items()))
+        return "\n".join(lines)
+
+
+def stage(instrumentation: Instrumentation, name):
+    """Enters a stage of an optional Instrumentation, doing nothing for None."""
+    if instrumentation is None:
+        return contextlib.nullcontext()
+    return instrumentation.stage(name)
@@ -1,6 +1,11 @@
+import numpy as np
 import qowi.entropy as entropy
 from bitstring import Bits, BitStream
+from qowi.bit_io import BitReader
 from qowi import integers
+from qowi.haar_sort import get_haar_sort_rank
+from qowi.instrumentation import STAGE_BIT_IO, STAGE_INTEGER_CODING, Instrumentation
+from qowi.integer_encoder import EXTENDED_OP_HAAR_BLOCK, EXTENDED_OP_ZEROTREE, HAAR_BLOCK_BIT_DEPTH
 from qowi.mflru_cache import MFLRUCache
 
 ZERO_INTEGER = (0, 0, 0)
@@ -11,44 +16,84 @@ OP_CODE_DELTA = Bits('0b10')
 OP_CODE_VALUE = Bits('0b11')
 
 class IntegerDecoder:
-    def __init__(self, bitstream: BitStream, cache_size):
-        self._bitstream = bitstream
+    def __init__(self, bitstream: BitStream, cache_size, haar_blocks: bool = False, zerotrees: bool = False, color_depth: int = len(ZERO_INTEGER), dictionary=(), cache: MFLRUCache = None,
+                 instrumentation: Instrumentation = None):
+        self._reader = BitReader(bitstream)
+        self._color_depth = color_depth
+        self._extended_ops = haar_blocks or zerotrees
         self._run_length = 0
+        self._queued_integers = []
+        self._zerotree = False
         self._last_integer = ZERO_INTEGER
-        self._cache = MFLRUCache(cache_size)
-        self._cache.observe(ZERO_INTEGER_FOUR)
-        self._cache.observe(ZERO_INTEGER)
+        self._cache = cache
+        if self._cache is None:
+            self._cache = MFLRUCache(cache_size)
+            self._cache.preload(dictionary)
+            self._cache.observe(ZERO_INTEGER_FOUR)
+            self._cache.observe(ZERO_INTEGER)
         self._finished = False
 
-    def decode_next(self) -> tuple:
+        if instrumentation is not None:
+            self._instrument(instrumentation)
+
+    def _instrument(self, instrumentation: Instrumentation):
+        # like IntegerEncoder, only this instance's bound methods are wrapped
+        for name in ("decode_next", "take_run", "skip_zero_subtree"):
+            setattr(self, name, instrumentation.timed(getattr(self, name), STAGE_INTEGER_CODING))
+        self._reader.read_uint = instrumentation.timed(self._reader.read_uint, STAGE_BIT_IO)
+        self._reader.read_ones = instrumentation.timed(self._reader.read_ones, STAGE_BIT_IO)
+
+    @property
+    def cache(self) -> MFLRUCache:
+        """The MFLRU cache, which a later coder can continue from."""
+        return self._cache
+
+    @property
+    def last_integer(self) -> tuple:
+        """The most recently decoded token."""
+        return self._last_integer
+
+    def decode_next(self, prediction: tuple = None) -> tuple:
+        """
+        Decodes the next token.
+
+        Parameters:
+        prediction (tuple): The value a DELTA op was taken against, or None for the last token.
+        """
+        if self._queued_integers:
+            return self._queued_integers.pop()
+
         if self._run_length > 0:
             self._run_length -= 1
             return self._last_integer
 
-        op_code = self._bitstream.read(2).uint
+        op_code = self._reader.read_uint(2)
 
         if op_code == OP_CODE_RUN.uint:
             # NOTE: no point in incrementing for the offset, then decrementing for the use
-            self._run_length = entropy.simple_decode(self._bitstream)
+            self._run_length = entropy.simple_decode_reader(self._reader)
             return self._last_integer
 
         elif op_code == OP_CODE_CACHE.uint:
-            position = entropy.simple_decode(self._bitstream)
+            position = entropy.simple_decode_reader(self._reader)
             this_integer = self._cache[position]
             self._last_integer = this_integer
             self._cache.observe(this_integer)
             return this_integer
 
         elif op_code == OP_CODE_DELTA.uint:
-            delta_zigzag = entropy.simple_decode_tuple(self._bitstream, 3)
+            delta_zigzag = entropy.simple_decode_tuple_reader(self._reader, self._color_depth)
             delta = integers.zigzag_tuple_to_int_tuple(delta_zigzag)
-            this_integer = integers.subtract_tuples(self._last_integer, delta)
+            this_integer = integers.subtract_tuples(prediction if prediction is not None else self._last_integer, delta)
             self._last_integer = this_integer
             self._cache.observe(this_integer)
             return this_integer
 
+        elif op_code == OP_CODE_VALUE.uint and self._extended_ops and self._reader.read_uint(1) == 1:
+            return self._decode_extended_op()
+
         elif op_code == OP_CODE_VALUE.uint:
-            value_zigzag = entropy.simple_decode_tuple(self._bitstream, 3)
+            value_zigzag = entropy.simple_decode_tuple_reader(self._reader, self._color_depth)
             this_integer = integers.zigzag_tuple_to_int_tuple(value_zigzag)
             self._last_integer = this_integer
             self._cache.observe(this_integer)
@@ -56,3 +101,57 @@ class IntegerDecoder:
         else:
             raise ValueError("Invalid op code value {}".format(op_code))
 
+    def take_run(self, max_count: int) -> int:
+        """
+        Consumes up to max_count repeats of the last token from the pending run, so the caller can fill
+        them in bulk instead of calling decode_next for each one.
+
+        Returns:
+        int: The number of repeats consumed.
+        """
+        if self._queued_integers:
+            return 0
+
+        count = min(self._run_length, max_count)
+        self._run_length -= count
+        return count
+
+    def skip_zero_subtree(self, count: int) -> bool:
+        """
+        Called after decoding a coefficient with count descendants. Returns True when the descendants are
+        known to be zero, because the coefficient was a ZEROTREE or a run of zeros covers them, and
+        consumes them so the caller can skip the subtree without decoding it.
+        """
+        if self._zerotree:
+            self._zerotree = False
+            return True
+
+        if not self._queued_integers and self._run_length >= count and not any(self._last_integer):
+            self._run_length -= count
+            return True
+
+        return False
+
+    def _decode_extended_op(self) -> tuple:
+        extended_op = entropy.simple_decode_reader(self._reader)
+
+        if extended_op == EXTENDED_OP_HAAR_BLOCK:
+            ranks = entropy.simple_decode_tuple_reader(self._reader, self._color_depth)
+            zigzag_grids = get_haar_sort_rank(HAAR_BLOCK_BIT_DEPTH).unrank(np.array(ranks))
+            block = [integers.zigzag_tuple_to_int_tuple(token) for token in zigzag_grids.T.tolist()]
+            for this_integer in block:
+                self._cache.observe(this_integer)
+            self._last_integer = block[-1]
+
+            # return the first token now and the rest on the following calls
+            self._queued_integers = block[:0:-1]
+            return block[0]
+
+        elif extended_op == EXTENDED_OP_ZEROTREE:
+            this_integer = (0,) * self._color_depth
+            self._last_integer = this_integer
+            self._cache.observe(this_integer)
+            self._zerotree = True
+            return this_integer
+        else:
+            raise ValueError("Invalid extended op code value {}".format(extended_op))
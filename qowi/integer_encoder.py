@@ -1,7 +1,12 @@
+import numpy as np
 import qowi.entropy as entropy
 import qowi.integers as integers
-from bitstring import BitArray, Bits, BitStream
+from bitstring import Bits, BitStream
+from qowi.bit_io import BitWriter
+from qowi.haar_sort import get_haar_sort_rank
+from qowi.instrumentation import STAGE_BIT_IO, STAGE_INTEGER_CODING, Instrumentation
 from qowi.mflru_cache import MFLRUCache
+from qowi.op_stats import OP_CACHE, OP_DELTA, OP_HAAR_BLOCK, OP_NAMES, OP_RUN, OP_VALUE, OP_ZEROTREE, OpStats
 
 ZERO_INTEGER = (0, 0, 0)
 ZERO_INTEGER_FOUR = (0, 0, 0, 255)
@@ -10,65 +15,192 @@ OP_CODE_CACHE = Bits('0b01')
 OP_CODE_DELTA = Bits('0b10')
 OP_CODE_VALUE = Bits('0b11')
 
+# when extended op codes are enabled, VALUE gives up half its code space to the extended ops,
+# which are followed by the simple encoded id of the extended op
+OP_CODE_EXTENDED_VALUE = Bits('0b110')
+OP_CODE_EXTENDED = Bits('0b111')
+EXTENDED_OP_HAAR_BLOCK = 0
+EXTENDED_OP_ZEROTREE = 1
 
-def gen_difference_value_encoding(this_integer: tuple):
-    ret = BitArray()
-    ret.append(OP_CODE_VALUE)
+# a Haar block codes each channel of four sibling coefficients as the Haar sort rank of their zigzag values
+HAAR_BLOCK_SIZE = 4
+HAAR_BLOCK_BIT_DEPTH = 8
+HAAR_BLOCK_MAX_ZIGZAG = (1 << HAAR_BLOCK_BIT_DEPTH) - 1
+
+
+# each encoding is generated as a (code, length) pair of ints for the BitWriter
+
+def _join_codes(*codes) -> tuple:
+    ret_code, ret_length = 0, 0
+    for code, length in codes:
+        ret_code = (ret_code << length) | code
+        ret_length += length
+    return ret_code, ret_length
 
-    zigzag = integers.int_tuple_to_zigzag_tuple(this_integer)
-    ret.append(entropy.simple_encode_tuple(zigzag))
 
-    return ret
+def _op_code(op_code: Bits) -> tuple:
+    return op_code.uint, len(op_code)
+
+
+def gen_difference_value_encoding(this_integer: tuple, op_code: Bits = OP_CODE_VALUE):
+    zigzag = integers.int_tuple_to_zigzag_tuple(this_integer)
+    return _join_codes(_op_code(op_code), entropy.simple_code_tuple(zigzag))
 
 
 def gen_cache_encoding(position):
-    ret = BitArray()
-    ret.append(OP_CODE_CACHE)
-    ret.append(entropy.simple_encode(position))
-    return ret
+    return _join_codes(_op_code(OP_CODE_CACHE), entropy.simple_code(position))
 
 
 def gen_delta_encoding(last_integer: tuple, this_integer: tuple):
-    ret = BitArray()
-    ret.append(OP_CODE_DELTA)
-
     delta = integers.subtract_tuples(last_integer, this_integer)
     delta_zigzag = integers.int_tuple_to_zigzag_tuple(delta)
-    ret.append(entropy.simple_encode_tuple(delta_zigzag))
+    return _join_codes(_op_code(OP_CODE_DELTA), entropy.simple_code_tuple(delta_zigzag))
+
+
+def gen_haar_block_encoding(ranks: tuple):
+    return _join_codes(_op_code(OP_CODE_EXTENDED), entropy.simple_code(EXTENDED_OP_HAAR_BLOCK), entropy.simple_code_tuple(ranks))
+
 
-    return ret
+def gen_zerotree_encoding():
+    return _join_codes(_op_code(OP_CODE_EXTENDED), entropy.simple_code(EXTENDED_OP_ZEROTREE))
 
 
 def gen_run_encoding(run_length):
-    ret = BitArray()
-    ret.append(OP_CODE_RUN)
-    ret.append(entropy.simple_encode(run_length - 1))
-    return ret
+    return _join_codes(_op_code(OP_CODE_RUN), entropy.simple_code(run_length - 1))
 
 
 class IntegerEncoder:
-    def __init__(self, bit_stream: BitStream, cache_size: int):
-        self._response = bit_stream
+    def __init__(self, bit_stream: BitStream, cache_size: int, haar_blocks: bool = False, zerotrees: bool = False, dictionary=(), cache: MFLRUCache = None,
+                 instrumentation: Instrumentation = None, stats: bool = False):
+        """
+        Parameters:
+        bit_stream (BitStream): The destination, or None to only count bits.
+        cache_size (int): The capacity of the MFLRU cache.
+        haar_blocks (bool), zerotrees (bool): Whether the extended ops are enabled.
+        dictionary (tuple): (token, count) entries to preload the cache with.
+        cache (MFLRUCache): A cache to continue from instead, e.g. the previous frame's. It is updated in place.
+        instrumentation (Instrumentation): When given, times the coding and bit I/O and counts the ops, their
+                                           bits and the cache lookups and hits.
+        stats (bool): Whether to gather an OpStats of the ops in stats, which is None otherwise.
+        """
+        self._writer = BitWriter(bit_stream) if bit_stream is not None else None
+        self._haar_blocks = haar_blocks
+        self._zerotrees = zerotrees
+        self._extended_ops = haar_blocks or zerotrees
+        self._value_op_code = OP_CODE_EXTENDED_VALUE if self._extended_ops else OP_CODE_VALUE
         self._run_length = 0
         self._last_integer = ZERO_INTEGER
-        self._cache = MFLRUCache(cache_size)
-        self._cache.observe(ZERO_INTEGER_FOUR)
-        self._cache.observe(ZERO_INTEGER)
-        self.stats = []
+        self._cache = cache
+        if self._cache is None:
+            self._cache = MFLRUCache(cache_size)
+            self._cache.preload(dictionary)
+            self._cache.observe(ZERO_INTEGER_FOUR)
+            self._cache.observe(ZERO_INTEGER)
+        self.stats = None
         self._finished = False
 
-    def _record(self, stats_record):
-        self.stats.append(stats_record)
+        if stats:
+            self.stats = OpStats(cache_size)
+            self._record = self.stats.record
+
+        if instrumentation is not None:
+            self._instrument(instrumentation)
+
+    def _instrument(self, instrumentation: Instrumentation):
+        # wrapping the bound methods of this instance leaves uninstrumented coders untouched
+        for name in ("encode_next", "encode_repeated", "encode_zero_subtree", "encode_block", "finish"):
+            setattr(self, name, instrumentation.timed(getattr(self, name), STAGE_INTEGER_CODING))
+        if self._writer is not None:
+            self._writer.write = instrumentation.timed(self._writer.write, STAGE_BIT_IO)
+            self._writer.flush = instrumentation.timed(self._writer.flush, STAGE_BIT_IO)
+
+        record = self._record
+        def counted_record(op, num_bits, detail=None):
+            instrumentation.count("ops." + OP_NAMES[op])
+            instrumentation.count("bits." + OP_NAMES[op], num_bits)
+            record(op, num_bits, detail)
+        self._record = counted_record
 
-    def _look_in_cache_and_encode(self, token: tuple):
+        look_in_cache = self._look_in_cache
+        def counted_look_in_cache(token):
+            position = look_in_cache(token)
+            instrumentation.count("cache_lookups")
+            if position >= 0:
+                instrumentation.count("cache_hits")
+            return position
+        self._look_in_cache = counted_look_in_cache
+
+    @property
+    def cache(self) -> MFLRUCache:
+        """The MFLRU cache, which a later coder can continue from."""
+        return self._cache
+
+    def _record(self, op, num_bits, detail=None):
+        # replaced on the instance when statistics or instrumentation are enabled, so the default costs only a call
+        pass
+
+    def _append(self, num_bits, gen_encoding, *args):
+        self._writer.write(*gen_encoding(*args))
+
+    def _look_in_cache(self, token: tuple) -> int:
         try:
-            position = self._cache.index(token)
-            cached = gen_cache_encoding(position)
-            return position, cached
+            return self._cache.index(token)
         except IndexError:
-            return -1, Bits()
+            return -1
+
+    def _run_length_bits(self, run_length: int) -> int:
+        return len(OP_CODE_RUN) + entropy.simple_encode_length(run_length - 1)
+
+    def _flush_run(self):
+        num_bits = self._run_length_bits(self._run_length)
+        self._append(num_bits, gen_run_encoding, self._run_length)
+        self._record(OP_RUN, num_bits, self._run_length)
+        self._run_length = 0
 
-    def encode_next(self, this_integer: tuple):
+    def _code_lengths(self, prediction: tuple, this_integer: tuple):
+        """Returns the cache position of this_integer (-1 when missing) and the CACHE, DELTA and VALUE code lengths."""
+        position = self._look_in_cache(this_integer)
+        cached_len = len(OP_CODE_CACHE) + entropy.simple_encode_length(position) if position >= 0 else 0
+        delta = integers.subtract_tuples(prediction, this_integer)
+        delta_len = len(OP_CODE_DELTA) + entropy.simple_encode_tuple_length(integers.int_tuple_to_zigzag_tuple(delta))
+        if len(prediction) != len(this_integer):
+            delta_len = 0  # e.g. the first token of a four channel image, since the coders start from ZERO_INTEGER
+        value_len = len(self._value_op_code) + entropy.simple_encode_tuple_length(integers.int_tuple_to_zigzag_tuple(this_integer))
+        return position, cached_len, delta_len, value_len
+
+    def _estimate_individual_bits(self, tokens, predictions=None) -> int:
+        """
+        Estimates the bits to code the tokens one at a time with encode_next. The cache is not updated
+        between the tokens, so the estimate is close but not exact.
+        """
+        num_bits = 0
+        last_integer = self._last_integer
+        run_length = self._run_length
+        for token, prediction in zip(tokens, predictions or [None] * len(tokens)):
+            if token == last_integer:
+                run_length += 1
+                continue
+
+            if run_length > 0:
+                num_bits += self._run_length_bits(run_length)
+                run_length = 0
+
+            delta_base = prediction if prediction is not None else last_integer
+            num_bits += min(x for x in self._code_lengths(delta_base, token)[1:] if x > 0)
+            last_integer = token
+
+        if run_length > self._run_length:
+            num_bits += self._run_length_bits(run_length - self._run_length)
+        return num_bits
+
+    def encode_next(self, this_integer: tuple, prediction: tuple = None):
+        """
+        Encodes the next token.
+
+        Parameters:
+        this_integer (tuple): The token to encode.
+        prediction (tuple): The value a DELTA op is taken against, or None for the last token.
+        """
         if self._finished:
             raise RuntimeError("You cannot call encode_next after finished has been called")
 
@@ -79,33 +211,110 @@ class IntegerEncoder:
         ### this_integer does not equal last_integer ###
 
         if self._run_length > 0:
-            run = gen_run_encoding(self._run_length)
-            self._response.append(run)
-            self._record({"op_code": "RUN", "run_length": self._run_length, "num_bits": len(run)})
-            self._run_length = 0
-
-        position, cached = self._look_in_cache_and_encode(this_integer)
-        delta = gen_delta_encoding(self._last_integer, this_integer)
-        value = gen_difference_value_encoding(this_integer)
-
-        smallest_length = min(x for x in (cached.len, delta.len, value.len) if x > 0)
-        if cached.len == smallest_length:  # CACHED is shortest
-            self._response.append(cached)
-            self._cache.observe(this_integer)
-            self._last_integer = this_integer
-            self._record({"op_code": "CACHE", "index": position, "num_bits": len(cached)})
-        elif delta.len == smallest_length:
-            self._response.append(delta)
-            self._cache.observe(this_integer)
-            self._last_integer = this_integer
-            self._record({"op_code": "DELTA", "num_bits": len(delta)})
-        elif value.len == smallest_length:  # VALUE is shortest
-            self._response.append(value)
-            self._cache.observe(this_integer)
-            self._last_integer = this_integer
-            self._record({"op_code": "VALUE", "num_bits": len(value), "color_R": this_integer[0], "color_G": this_integer[1], "color_B": this_integer[2]})
-        else:
-            raise ValueError("Cached, delta and value encodings were zero length")
+            self._flush_run()
+
+        # compare code lengths arithmetically and only generate the shortest encoding
+        delta_base = prediction if prediction is not None else self._last_integer
+        position, cached_len, delta_len, value_len = self._code_lengths(delta_base, this_integer)
+
+        smallest_length = min(x for x in (cached_len, delta_len, value_len) if x > 0)
+        if cached_len == smallest_length:  # CACHED is shortest
+            self._append(cached_len, gen_cache_encoding, position)
+            self._record(OP_CACHE, cached_len, position)
+        elif delta_len == smallest_length:
+            self._append(delta_len, gen_delta_encoding, delta_base, this_integer)
+            self._record(OP_DELTA, delta_len)
+        else:  # VALUE is shortest
+            self._append(value_len, gen_difference_value_encoding, this_integer, self._value_op_code)
+            self._record(OP_VALUE, value_len, this_integer)
+
+        self._cache.observe(this_integer)
+        self._last_integer = this_integer
+
+    def encode_repeated(self, this_integer: tuple, count: int, prediction: tuple = None):
+        """Encodes the same token count times, producing the same bits as calling encode_next count times."""
+        self.encode_next(this_integer, prediction)
+        self._run_length += count - 1
+
+    def encode_zero_subtree(self, zero_integer: tuple, count: int, prediction: tuple = None):
+        """
+        Encodes a coefficient whose whole subtree of count tokens, itself included, is zero. The zeros
+        extend the current run when the last token was zero. Otherwise, when zerotrees are enabled, the
+        subtree is coded as a single ZEROTREE op, which the decoder expands from the traversal.
+        """
+        if self._finished:
+            raise RuntimeError("You cannot call encode_zero_subtree after finished has been called")
+
+        if not self._zerotrees or zero_integer == self._last_integer:
+            self.encode_repeated(zero_integer, count, prediction)
+            return
+
+        if self._run_length > 0:
+            self._flush_run()
+
+        num_bits = len(OP_CODE_EXTENDED) + entropy.simple_encode_length(EXTENDED_OP_ZEROTREE)
+        self._append(num_bits, gen_zerotree_encoding)
+        self._record(OP_ZEROTREE, num_bits, count)
+
+        self._cache.observe(zero_integer)
+        self._last_integer = zero_integer
+
+    def encode_block(self, tokens, predictions=None):
+        """
+        Encodes four sibling tokens. When Haar blocks are enabled and the Haar sort ranks of the block
+        are shorter than coding the tokens one at a time, the block is coded as a single HAAR_BLOCK op,
+        otherwise each token is passed to encode_next.
+
+        Parameters:
+        tokens (list): The four sibling tokens in traversal order.
+        predictions (list): The DELTA prediction of each token, or None to predict from the last token.
+        """
+        predictions = predictions or [None] * len(tokens)
+        if self._finished:
+            raise RuntimeError("You cannot call encode_block after finished has been called")
+
+        if not self._haar_blocks or all(token == self._last_integer for token in tokens):
+            for token, prediction in zip(tokens, predictions):
+                self.encode_next(token, prediction)
+            return
+
+        # rule the block out from the LL of each channel before ranking it, since ranking is the slow part
+        pending_run_len = self._run_length_bits(self._run_length) if self._run_length > 0 else 0
+        individual_len = self._estimate_individual_bits(tokens, predictions)
+        block_len_bound = self._haar_block_length_bound(tokens)
+        if block_len_bound is None or pending_run_len + block_len_bound >= individual_len:
+            for token, prediction in zip(tokens, predictions):
+                self.encode_next(token, prediction)
+            return
+
+        zigzag = integers.integer_to_zigzag_ndarray(np.array(tokens, dtype=np.int64).T)
+        ranks = tuple(get_haar_sort_rank(HAAR_BLOCK_BIT_DEPTH).rank(zigzag).tolist())
+        block_len = len(OP_CODE_EXTENDED) + entropy.simple_encode_length(EXTENDED_OP_HAAR_BLOCK) + entropy.simple_encode_tuple_length(ranks)
+        if pending_run_len + block_len >= individual_len:
+            for token, prediction in zip(tokens, predictions):
+                self.encode_next(token, prediction)
+            return
+
+        if self._run_length > 0:
+            self._flush_run()
+
+        self._append(block_len, gen_haar_block_encoding, ranks)
+        self._record(OP_HAAR_BLOCK, block_len)
+
+        for token in tokens:
+            self._cache.observe(token)
+        self._last_integer = tokens[-1]
+
+    def _haar_block_length_bound(self, tokens):
+        """A lower bound on the HAAR_BLOCK code length, or None if a zigzag value is too large to rank."""
+        haar_sort_rank = get_haar_sort_rank(HAAR_BLOCK_BIT_DEPTH)
+        num_bits = len(OP_CODE_EXTENDED) + entropy.simple_encode_length(EXTENDED_OP_HAAR_BLOCK)
+        for channel in zip(*tokens):
+            zigzag = integers.int_tuple_to_zigzag_tuple(channel)
+            if max(zigzag) > HAAR_BLOCK_MAX_ZIGZAG:
+                return None
+            num_bits += entropy.simple_encode_length(haar_sort_rank.first_rank(sum(zigzag)))
+        return num_bits
 
     def finish(self):
         if self._finished:
@@ -113,9 +322,21 @@ class IntegerEncoder:
 
         # flush the run length
         if self._run_length > 0:
-            run = gen_run_encoding(self._run_length)
-            self._response.append(run)
-            self._record({"op_code": "RUN", "run_length": self._run_length, "num_bits": len(run)})
-            self._run_length = 0
+            self._flush_run()
+
+        if self._writer is not None:
+            self._writer.flush()
+        self._finished = True
+
+
+class IntegerSizeEstimator(IntegerEncoder):
+    """
+    Runs the same op code selection, run tracking and cache simulation as IntegerEncoder, but only
+    counts the bits of each chosen encoding rather than generating them.
+    """
+    def __init__(self, cache_size: int, haar_blocks: bool = False, zerotrees: bool = False, dictionary=(), cache: MFLRUCache = None):
+        super().__init__(None, cache_size, haar_blocks, zerotrees, dictionary, cache)
+        self.num_bits = 0
 
-        self._finished = True
\ No newline at end of file
+    def _append(self, num_bits, gen_encoding, *args):
+        self.num_bits += num_bits
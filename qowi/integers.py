@@ -7,10 +7,20 @@ def integer_to_shifted(integer: int, num_values) -> int:
 def shifted_to_integer(shifted_integer: int, num_values) -> int:
     return shifted_integer + num_values // 2
 
+def integer_to_shifted_ndarray(int_values: np.ndarray, num_values) -> np.ndarray:
+    return int_values.astype(np.int64) - num_values // 2
+
+def shifted_to_integer_ndarray(shifted_values: np.ndarray, num_values) -> np.ndarray:
+    return shifted_values + num_values // 2
+
 def integer_to_zigzag(int_value: int) -> int:
     return abs(int_value << 1) + (0 if int_value >= 0 else 1)
 
 
+def integer_to_zigzag_ndarray(int_values: np.ndarray) -> np.ndarray:
+    return np.where(int_values >= 0, int_values << 1, (-int_values << 1) + 1)
+
+
 def zigzag_to_integer(zigzag_value: int) -> int:
     return (1 if zigzag_value & 1 == 0 else -1) * (zigzag_value >> 1)
 
@@ -24,6 +24,9 @@ class MFLRUCache:
         self._observation_index = -1
 
     def observe(self, value):
+        self._add(value, 1)
+
+    def _add(self, value, count):
         self._observation_index += 1
 
         if value not in self._value_index:
@@ -33,7 +36,7 @@ class MFLRUCache:
             node = self._value_index[value]
 
         self._list.discard(node)
-        node.observed_count += 1
+        node.observed_count += count
         node.observation_index = self._observation_index
         self._list.add(node)
 
@@ -41,6 +44,29 @@ class MFLRUCache:
             old_node = self._list.pop()
             del self._value_index[old_node.value]
 
+    def preload(self, entries):
+        """
+        Seeds the cache with (value, count) entries, e.g. from a trained dictionary, as if each value had
+        been observed count times. Of values with equal counts, the earlier entries rank first.
+
+        Parameters:
+        entries (iterable): The (value, count) pairs.
+        """
+        for value, count in reversed(list(entries)):
+            self._add(value, count)
+
+    def copy(self):
+        """Returns an independent cache with the same contents and order."""
+        ret = MFLRUCache(self._capacity)
+        ret._observation_index = self._observation_index
+        for node in self._list:
+            node_copy = ValueNode(node.value)
+            node_copy.observed_count = node.observed_count
+            node_copy.observation_index = node.observation_index
+            ret._value_index[node.value] = node_copy
+            ret._list.add(node_copy)
+        return ret
+
     def index(self, value):
         if value not in self._value_index:
             raise IndexError
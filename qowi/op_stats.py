@@ -0,0 +1,90 @@
+"""
+Statistics of the ops chosen by the integer encoder, for tuning the op codes.
+
+The encoder only keeps statistics when asked to. Each op then increments preaggregated NumPy histograms
+instead of appending a record, so the memory held is fixed whatever the number of ops, and the statistics of
+many images can be merged. utils/analysis.py turns them into tables.
+"""
+
+import numpy as np
+
+OP_RUN = 0
+OP_CACHE = 1
+OP_DELTA = 2
+OP_VALUE = 3
+OP_HAAR_BLOCK = 4
+OP_ZEROTREE = 5
+OP_NAMES = ("RUN", "CACHE", "DELTA", "VALUE", "HAAR_BLOCK", "ZEROTREE")
+
+# ops of this many bits or more are counted in the last bin of op_bits
+MAX_OP_BITS = 128
+
+# run lengths and the magnitudes of VALUE channels are binned by their bit length
+MAX_BIT_LENGTH = 64
+MAX_CHANNELS = 4
+
+
+class OpStats:
+    def __init__(self, cache_size: int):
+        """
+        Parameters:
+        cache_size (int): The capacity of the encoder's MFLRU cache, which bounds the CACHE positions.
+        """
+        # the number of ops of each op code and length in bits
+        self.op_bits = np.zeros((len(OP_NAMES), MAX_OP_BITS + 1), dtype=np.int64)
+
+        # the number of runs whose length has each bit length, and the longest run
+        self.run_lengths = np.zeros(MAX_BIT_LENGTH + 1, dtype=np.int64)
+        self.max_run_length = 0
+
+        # the number of CACHE ops at each cache position
+        self.cache_positions = np.zeros(cache_size, dtype=np.int64)
+
+        # for each channel, the number of VALUE ops whose absolute value has each bit length
+        self.value_magnitudes = np.zeros((MAX_CHANNELS, MAX_BIT_LENGTH + 1), dtype=np.int64)
+
+        # the number of tokens covered by ZEROTREE ops
+        self.zerotree_tokens = 0
+
+    def record(self, op: int, num_bits: int, detail=None):
+        """
+        Counts an op.
+
+        Parameters:
+        op (int): One of the OP_ constants.
+        num_bits (int): The length of the op in bits.
+        detail: The run length of a RUN, the position of a CACHE, the token of a VALUE or the subtree size of a ZEROTREE.
+        """
+        self.op_bits[op, min(num_bits, MAX_OP_BITS)] += 1
+        if op == OP_RUN:
+            self.run_lengths[min(detail.bit_length(), MAX_BIT_LENGTH)] += 1
+            self.max_run_length = max(self.max_run_length, detail)
+        elif op == OP_CACHE:
+            self.cache_positions[detail] += 1
+        elif op == OP_VALUE:
+            for channel, value in enumerate(detail[:MAX_CHANNELS]):
+                self.value_magnitudes[channel, min(abs(value).bit_length(), MAX_BIT_LENGTH)] += 1
+        elif op == OP_ZEROTREE:
+            self.zerotree_tokens += detail
+
+    def merge(self, other: 'OpStats'):
+        """Adds the counts of another OpStats, e.g. to gather the statistics of a corpus."""
+        self.op_bits += other.op_bits
+        self.run_lengths += other.run_lengths
+        self.max_run_length = max(self.max_run_length, other.max_run_length)
+        size = max(len(self.cache_positions), len(other.cache_positions))
+        self.cache_positions = np.pad(self.cache_positions, (0, size - len(self.cache_positions)))
+        self.cache_positions[:len(other.cache_positions)] += other.cache_positions
+        self.value_magnitudes += other.value_magnitudes
+        self.zerotree_tokens += other.zerotree_tokens
+
+    @property
+    def op_counts(self) -> dict:
+        """The number of ops of each op code used, by name."""
+        counts = self.op_bits.sum(axis=1)
+        return {name: int(count) for name, count in zip(OP_NAMES, counts) if count > 0}
+
+    @property
+    def num_bits(self) -> int:
+        """The total length of the ops, when none reached MAX_OP_BITS."""
+        return int((self.op_bits @ np.arange(MAX_OP_BITS + 1)).sum())
@@ -0,0 +1,196 @@
+"""
+Predictors for the DELTA op. Each subband (HL, LH and HH) picks the predictor its DELTA ops are taken
+against:
+
+- PREDICTOR_LAST: the previous coefficient in traversal order, which is the original behaviour.
+- PREDICTOR_PARENT: half the parent coefficient in the quad-tree, since the integer Haar coefficients
+  of a coarser level are about twice as large.
+- PREDICTOR_NEIGHBOUR: the adjacent coefficient of the same subband along the edges it responds to,
+  i.e. the next column for HL, the next row for LH and the next diagonal for HH. The children of each
+  coefficient are visited in reverse raster order, so this neighbour is always decoded first.
+- PREDICTOR_MEDIAN: the median of the last, parent and neighbour predictions in each channel.
+
+A parent or neighbour outside the wavelet predicts zero.
+"""
+
+import numpy as np
+from qowi.wavelet import FILTERS, coefficient_position
+
+PREDICTOR_LAST = 0
+PREDICTOR_PARENT = 1
+PREDICTOR_NEIGHBOUR = 2
+PREDICTOR_MEDIAN = 3
+PREDICTORS = (PREDICTOR_LAST, PREDICTOR_PARENT, PREDICTOR_NEIGHBOUR, PREDICTOR_MEDIAN)
+PREDICTOR_NAMES = {
+    "last": PREDICTOR_LAST,
+    "parent": PREDICTOR_PARENT,
+    "neighbour": PREDICTOR_NEIGHBOUR,
+    "median": PREDICTOR_MEDIAN,
+}
+DEFAULT_PREDICTORS = (PREDICTOR_LAST, PREDICTOR_LAST, PREDICTOR_LAST)
+
+# the (row, column) offset of the neighbour of each filter
+NEIGHBOUR_OFFSETS = {'HL': (0, 1), 'LH': (1, 0), 'HH': (1, 1)}
+
+# predictions are made a block of rows of a band at a time, so the temporaries of a block stay about this size
+PREDICTION_BLOCK_BYTES = 1 << 20
+
+
+def predict(wavelet: np.ndarray, predictor: int, last_integer: tuple, level: int, filter: str, i: int, j: int) -> tuple:
+    """
+    Predicts a coefficient from the coefficients decoded before it.
+
+    Parameters:
+    wavelet (np.ndarray): The (length, length, channels) wavelet array holding the decoded coefficients.
+    predictor (int): One of the PREDICTORS.
+    last_integer (tuple): The previous coefficient in traversal order.
+    level (int), filter (str), i (int), j (int): The quad-tree node of the coefficient.
+
+    Returns:
+    tuple: The predicted coefficient.
+    """
+    if predictor == PREDICTOR_LAST:
+        return last_integer
+
+    zero = (0,) * wavelet.shape[2]
+    parent = tuple((wavelet[coefficient_position(level - 1, filter, i // 2, j // 2)] >> 1).tolist()) if level > 0 else zero
+    if predictor == PREDICTOR_PARENT:
+        return parent
+
+    di, dj = NEIGHBOUR_OFFSETS[filter]
+    length = 2 ** level
+    neighbour = tuple(wavelet[coefficient_position(level, filter, i + di, j + dj)].tolist()) if i + di < length and j + dj < length else zero
+    if predictor == PREDICTOR_NEIGHBOUR:
+        return neighbour
+
+    if predictor == PREDICTOR_MEDIAN:
+        # the coders start from a three channel zero, which prediction_array takes as zero in every channel
+        if len(last_integer) != len(zero):
+            last_integer = zero
+        return tuple(sorted(values)[1] for values in zip(last_integer, parent, neighbour))
+
+    raise ValueError("Unknown predictor {}".format(predictor))
+
+
+def row_blocks(length: int, channels: int):
+    """Yields the (start, stop) ranges of the rows of a band of this length worked on at a time."""
+    rows = max(1, PREDICTION_BLOCK_BYTES // (length * max(channels, 1) * 8))
+    for start in range(0, length, rows):
+        yield start, min(start + rows, length)
+
+
+def _finest_descendants(wavelet: np.ndarray, num_levels: int, level: int, filter: str) -> np.ndarray:
+    """A view holding, for each coefficient of a band, the last coefficient of its subtree in traversal order."""
+    stride = 2 ** (num_levels - 1 - level)
+    row, col = coefficient_position(num_levels - 1, filter, 0, 0)
+    length = 2 ** (num_levels - 1)
+    return wavelet[row:row + length:stride, col:col + length:stride]
+
+
+def last_predictions(wavelet: np.ndarray, num_levels: int, level: int, filter: str, start: int, stop: int) -> np.ndarray:
+    """
+    Calculates the coefficient visited before each coefficient of some rows of a band, without the traversal order.
+
+    The children of a coefficient are visited in reverse raster order after it, so the first child follows its
+    parent and every other child follows the last coefficient of its previous sibling's subtree, which is
+    reached by always descending to the top left child. The trees of the subbands follow one another.
+
+    Parameters:
+    wavelet (np.ndarray): The (length, length, channels) wavelet array.
+    num_levels (int): The number of levels of the wavelet.
+    level (int), filter (str): The band.
+    start (int), stop (int): The rows of the band.
+
+    Returns:
+    np.ndarray: An int64 (stop - start, 2 ** level, channels) array.
+    """
+    length = 2 ** level
+    ret = np.zeros((stop - start, length, wavelet.shape[2]), dtype=np.int64)
+    if level == 0:
+        # the first coefficient follows the zero the coders start from
+        index = FILTERS.index(filter)
+        if index > 0:
+            ret[0, 0] = _finest_descendants(wavelet, num_levels, level, FILTERS[index - 1])[0, 0]
+        return ret
+
+    descendants = _finest_descendants(wavelet, num_levels, level, filter)
+    rows = np.arange(start, stop)
+    odd = rows % 2 == 1
+
+    # a child in an even column follows the subtree of its right neighbour
+    ret[:, 0::2] = descendants[start:stop, 1::2]
+
+    # a child in an odd row and column is visited first and follows its parent, the other follows the subtree below left
+    parent_row, parent_col = coefficient_position(level - 1, filter, 0, 0)
+    ret[odd, 1::2] = wavelet[parent_row + rows[odd] // 2, parent_col:parent_col + length // 2]
+    ret[~odd, 1::2] = descendants[rows[~odd] + 1, 0:length:2]
+    return ret
+
+
+def band_predictions(wavelet: np.ndarray, num_levels: int, level: int, filter: str, predictor: int, start: int, stop: int) -> np.ndarray:
+    """
+    Calculates the predict() result for the coefficients in some rows of a band, given the final coefficients.
+
+    Parameters:
+    wavelet (np.ndarray): The (length, length, channels) wavelet array.
+    num_levels (int): The number of levels of the wavelet.
+    level (int), filter (str): The band.
+    predictor (int): One of the PREDICTORS.
+    start (int), stop (int): The rows of the band.
+
+    Returns:
+    np.ndarray: An int64 (stop - start, 2 ** level, channels) array.
+    """
+    length = 2 ** level
+    last = last_predictions(wavelet, num_levels, level, filter, start, stop)
+    if predictor == PREDICTOR_LAST:
+        return last
+
+    parent = np.zeros_like(last)
+    if level > 0:
+        parent_row, parent_col = coefficient_position(level - 1, filter, 0, 0)
+        parent_band = wavelet[parent_row + start // 2:parent_row + (stop + 1) // 2, parent_col:parent_col + length // 2]
+        parent = (parent_band.astype(np.int64) >> 1).repeat(2, axis=0).repeat(2, axis=1)[start % 2:start % 2 + stop - start]
+    if predictor == PREDICTOR_PARENT:
+        return parent
+
+    row, col = coefficient_position(level, filter, 0, 0)
+    di, dj = NEIGHBOUR_OFFSETS[filter]
+    neighbour = np.zeros_like(last)
+    neighbour_stop = min(stop, length - di)
+    if neighbour_stop > start:
+        neighbour[:neighbour_stop - start, :length - dj] = wavelet[row + start + di:row + neighbour_stop + di, col + dj:col + length]
+    if predictor == PREDICTOR_NEIGHBOUR:
+        return neighbour
+
+    if predictor == PREDICTOR_MEDIAN:
+        return np.median(np.stack([last, parent, neighbour]), axis=0).astype(np.int64)
+
+    raise ValueError("Unknown predictor {}".format(predictor))
+
+
+def prediction_array(wavelet: np.ndarray, num_levels: int, predictors: tuple, out: np.ndarray = None) -> np.ndarray:
+    """
+    Calculates the predict() result for every detail coefficient, given the final coefficients. The bands are
+    worked on a block of rows at a time, so no more than a block is held in memory besides the result.
+
+    Parameters:
+    wavelet (np.ndarray): The (length, length, channels) wavelet array.
+    num_levels (int): The number of levels of the wavelet.
+    predictors (tuple): The predictor of the HL, LH and HH subbands.
+    out (np.ndarray): The zeroed array shaped like the wavelet to store the predictions in, e.g. one backed by a
+                      scratch file. The predictions are coefficients or halves of them, so the wavelet's dtype holds them.
+
+    Returns:
+    np.ndarray: The predictions, in out when given or an int64 array shaped like the wavelet, where the
+                prediction of each detail coefficient is stored at its position.
+    """
+    ret = np.zeros(wavelet.shape, dtype=np.int64) if out is None else out
+    for level in range(num_levels):
+        length = 2 ** level
+        for filter, predictor in zip(FILTERS, predictors):
+            row, col = coefficient_position(level, filter, 0, 0)
+            for start, stop in row_blocks(length, wavelet.shape[2]):
+                ret[row + start:row + stop, col:col + length] = band_predictions(wavelet, num_levels, level, filter, predictor, start, stop)
+
+    return ret
@@ -1,23 +1,52 @@
 import qowi.entropy as entropy
 import numpy as np
 import qowi.integers as integers
+from qowi import color_transform
 import time
 from bitstring import BitStream
-from qowi.header import Header
+from qowi.dictionary import get_dictionary
+from qowi.embedded import EmbeddedDecoder
+from qowi.header import CODEC_SPATIAL, Header
+from qowi.instrumentation import STAGE_DEQUANTIZE, STAGE_EMBEDDED_CODING, STAGE_INVERSE_TRANSFORM, STAGE_TRAVERSAL, stage
 from qowi.integer_decoder import IntegerDecoder
-from qowi.wavelet import Wavelet
-from utils.progress_bar import progress_bar
+from qowi.prediction import PREDICTOR_LAST, predict
+from qowi.spatial_decoder import SpatialDecoder
+from qowi.wavelet import FILTERS, Wavelet, coefficient_position, subtree_size
 
 class QOWIDecoder:
-    def __init__(self):
+    def __init__(self, cache=None, progress_hook=None, scratch_dir=None, instrumentation=None):
         self._header = Header()
         self._wavelet = None
+        self._reference = None
+        self._spatial_decoder = None
         self._bitstream = None
         self._finished = False
         self.decode_duration = 0
+        self.truncated = False
+        self.codec = None
 
-    def from_bitstream(self, bitstream: BitStream):
+        # the integer coder's MFLRU cache, which continues from the given one, e.g. the previous frame's
+        self.cache = cache
+
+        # called with (tokens decoded, total tokens) as the coefficients are decoded, e.g. utils.progress_bar.progress_bar
+        self._progress_hook = progress_hook
+
+        # a directory for scratch files backing the wavelet, for images too large to decode in memory
+        self._scratch_dir = scratch_dir
+
+        # an optional qowi.instrumentation.Instrumentation timing the stages of decode() and as_array()
+        self._instrumentation = instrumentation
+
+    def from_bitstream(self, bitstream: BitStream, reference: Wavelet = None):
+        """
+        Prepares the source bitstream for decoding.
+
+        Parameters:
+        bitstream (BitStream): The encoded image.
+        reference (Wavelet): The reference wavelet the image was encoded against, if any.
+        """
         self._bitstream = bitstream
+        self._reference = reference
 
     def from_file(self, filename):
         raise NotImplementedError
@@ -25,7 +54,20 @@ class QOWIDecoder:
     def as_array(self) -> np.ndarray:
         if not self._finished:
             raise RuntimeError("Decoder must be finished")
-        return self._wavelet.as_image()
+
+        if self._spatial_decoder is not None:
+            return self._spatial_decoder.as_array()
+        with stage(self._instrumentation, STAGE_INVERSE_TRANSFORM):
+            return color_transform.to_image(self._wavelet.as_array(), self._header.color_transform)
+
+    def as_wavelet(self) -> Wavelet:
+        """The decoded wavelet, e.g. to decode the next frame of a sequence against. Not available for spatial images."""
+        if not self._finished:
+            raise RuntimeError("Decoder must be finished")
+        if self._wavelet is None:
+            raise RuntimeError("Only wavelet coded images have a wavelet")
+
+        return self._wavelet
 
     def to_file(self, filename):
         raise NotImplementedError
@@ -41,53 +83,78 @@ class QOWIDecoder:
 
         self._bitstream.pos = 0
         self._header.read(self._bitstream)
-        self._wavelet = Wavelet(self._header.width, self._header.height, self._header.color_depth, self._header.wavelet_levels, self._header.wavelet_precision_digits)
+        self.codec = self._header.codec
+
+        if self._header.codec == CODEC_SPATIAL:
+            self._spatial_decoder = SpatialDecoder(self._instrumentation)
+            self._spatial_decoder.from_bitstream(self._bitstream)
+            self._spatial_decoder.decode()
+        else:
+            self._decode_wavelet()
+
+        end_time = time.time()
+        self.decode_duration = end_time - start_time
+        self._finished = True
+
+    def _decode_wavelet(self):
+        self._wavelet = Wavelet(self._header.width, self._header.height, self._header.color_depth, self._header.wavelet_levels, self._header.wavelet_precision_digits,
+                               scratch_dir=self._scratch_dir)
 
         # decode the top value of the wavelet
-        root_zigzag = entropy.simple_decode_tuple(self._bitstream, 3)
+        root_zigzag = entropy.simple_decode_tuple(self._bitstream, self._header.color_depth)
         root_integer = integers.zigzag_tuple_to_int_tuple(root_zigzag)
         self._wavelet.wavelet[0, 0] = root_integer
 
-        self._read_coefficients()
+        if self._header.embedded:
+            embedded_decoder = EmbeddedDecoder(self._bitstream)
+            with stage(self._instrumentation, STAGE_EMBEDDED_CODING):
+                embedded_decoder.decode(self._wavelet)
+            self.truncated = embedded_decoder.truncated
+        else:
+            with stage(self._instrumentation, STAGE_TRAVERSAL):
+                self._read_coefficients()
 
-        end_time = time.time()
-        self.decode_duration = end_time - start_time
-        self._finished = True
+        with stage(self._instrumentation, STAGE_DEQUANTIZE):
+            self._wavelet.dequantize(self._header.quantization_steps)
+
+        if self._reference is not None:
+            self._wavelet.wavelet += self._reference.wavelet
 
     def _read_coefficients(self):
         stack = [(0, 'HH', 0, 0), (0, 'LH', 0, 0), (0, 'HL', 0, 0)]
-        integer_decoder = IntegerDecoder(self._bitstream, self._header.cache_size)
+        integer_decoder = IntegerDecoder(self._bitstream, self._header.cache_size, self._header.haar_blocks, self._header.zerotrees, self._header.color_depth,
+                                         get_dictionary(self._header.dictionary_id, self._header.dictionary_checksum), self.cache, self._instrumentation)
 
         number_of_tokens = self._wavelet.length ** 2 - 1
         counter = 1
         while len(stack) > 0:
-            progress_bar(counter, number_of_tokens)
+            if self._progress_hook is not None:
+                self._progress_hook(counter, number_of_tokens)
             counter += 1
 
             level, filter, i, j = stack.pop()
 
-            level_length = 2 ** level
-            if filter == 'HL':
-                i_offset = 0
-                j_offset = level_length
-            elif filter == 'LH':
-                i_offset = level_length
-                j_offset = 0
-            elif filter == 'HH':
-                i_offset = level_length
-                j_offset = level_length
-            else:
-                raise ValueError("Unknown filter '{}'".format(filter))
-
             # decode this coefficient
-            this_integer = integer_decoder.decode_next()
-            self._wavelet.wavelet[i + i_offset][j + j_offset] = this_integer
+            predictor = self._header.predictors[FILTERS.index(filter)]
+            prediction = None
+            if predictor != PREDICTOR_LAST:
+                prediction = predict(self._wavelet.wavelet, predictor, integer_decoder.last_integer, level, filter, i, j)
+            this_integer = integer_decoder.decode_next(prediction)
+            self._wavelet.wavelet[coefficient_position(level, filter, i, j)] = this_integer
+
+            if level + 1 >= self._wavelet.num_levels:
+                continue
+
+            # the wavelet starts out zero, so a subtree known to be zero needs no decoding
+            num_descendants = subtree_size(level, self._wavelet.num_levels) - 1
+            if integer_decoder.skip_zero_subtree(num_descendants):
+                counter += num_descendants
+                continue
 
             # append children to the stack
-            if level + 1 < self._wavelet.num_levels:
-                stack.append((level + 1, filter, 2 * i, 2 * j))
-                stack.append((level + 1, filter, 2 * i, 2 * j + 1))
-                stack.append((level + 1, filter, 2 * i + 1, 2 * j))
-                stack.append((level + 1, filter, 2 * i + 1, 2 * j + 1))
+            stack.append((level + 1, filter, 2 * i, 2 * j))
+            stack.append((level + 1, filter, 2 * i, 2 * j + 1))
+            stack.append((level + 1, filter, 2 * i + 1, 2 * j))
+            stack.append((level + 1, filter, 2 * i + 1, 2 * j + 1))
 
-        print()
\ No newline at end of file
+        self.cache = integer_decoder.cache
@@ -2,57 +2,164 @@ import numpy as np
 import qowi.entropy as entropy
 import time
 from bitstring import Bits, BitStream
-from qowi import integers
-from qowi.integer_encoder import IntegerEncoder
+from qowi import color_transform, integers
+from qowi.dictionary import DICTIONARY_NONE, dictionary_checksum, get_dictionary
+from qowi.embedded import EmbeddedEncoder
+from qowi.integer_encoder import IntegerEncoder, IntegerSizeEstimator, ZERO_INTEGER
 from skimage import io
-from qowi.header import Header
-from qowi.wavelet import Wavelet
-from utils.progress_bar import progress_bar
+from qowi.header import CODEC_SPATIAL, CODEC_WAVELET, Header
+from qowi.instrumentation import (STAGE_CODEC_CHOICE, STAGE_EMBEDDED_CODING, STAGE_INVERSE_TRANSFORM, STAGE_PREDICTOR_CHOICE,
+                                  STAGE_THRESHOLD, STAGE_TRANSFORM, STAGE_TRAVERSAL, stage)
+from qowi.prediction import DEFAULT_PREDICTORS, PREDICTOR_LAST, PREDICTORS, band_predictions, prediction_array, row_blocks
+from qowi.spatial_encoder import SpatialEncoder
+from qowi.wavelet import FILTERS, Wavelet, coefficient_position, subtree_size, traversal_order
 
 DEFAULT_CACHE_SIZE = 65533
 DEFAULT_HARD_THRESHOLD = -1
 DEFAULT_SOFT_THRESHOLD = -1
 DEFAULT_WAVELET_LEVELS = 2
 DEFAULT_WAVELET_PRECISION_DIGITS = 0
+DEFAULT_COLOR_TRANSFORM = color_transform.COLOR_TRANSFORM_NONE
+DEFAULT_QUANTIZATION_STEP = 0
+DEFAULT_SUBBAND_WEIGHTS = (1, 1, 1)
+DEFAULT_CODEC = CODEC_WAVELET
 
 MIN_HARD_THRESHOLD = -1
 MIN_SOFT_THRESHOLD = -1
 MIN_WAVELET_LEVELS = 0
 MIN_WAVELET_PRECISION_DIGITS = 0
+MIN_QUANTIZATION_STEP = 0
 
 MAX_HARD_THRESHOLD = 510
 MAX_SOFT_THRESHOLD = 510
 MAX_WAVELET_LEVELS = 15
 MAX_WAVELET_PRECISION_DIGITS = 255
+MAX_QUANTIZATION_STEP = 510
+
+RATE_CONTROL_ITERATIONS = 16
+RATE_CONTROL_REFINEMENTS = 4
+MAX_PIXEL_VALUE = 255
 
 class QOWIEncoder:
     def __init__(self, hard_threshold=DEFAULT_HARD_THRESHOLD,
                  soft_threshold=DEFAULT_SOFT_THRESHOLD,
                  wavelet_encode_levels=DEFAULT_WAVELET_LEVELS,
-                 wavelet_precision_digits=DEFAULT_WAVELET_PRECISION_DIGITS, ):
+                 wavelet_precision_digits=DEFAULT_WAVELET_PRECISION_DIGITS,
+                 color_transform=DEFAULT_COLOR_TRANSFORM,
+                 haar_blocks=False,
+                 zerotrees=False,
+                 embedded=False,
+                 quantization_step=DEFAULT_QUANTIZATION_STEP,
+                 subband_weights=DEFAULT_SUBBAND_WEIGHTS,
+                 predictors=None,
+                 codec=DEFAULT_CODEC,
+                 dictionary_id=DICTIONARY_NONE,
+                 cache=None,
+                 progress_hook=None,
+                 scratch_dir=None,
+                 instrumentation=None,
+                 stats=False, ):
 
         self._hard_threshold = max(MIN_HARD_THRESHOLD, min(hard_threshold, MAX_HARD_THRESHOLD))
         self._soft_threshold = max(MIN_SOFT_THRESHOLD, min(soft_threshold, MAX_SOFT_THRESHOLD))
         self._wavelet_levels = max(MIN_WAVELET_LEVELS, min(wavelet_encode_levels, MAX_WAVELET_LEVELS))
         self._wavelet_precision_digits = max(MIN_WAVELET_PRECISION_DIGITS, min(wavelet_precision_digits, MAX_WAVELET_PRECISION_DIGITS))
+        self._color_transform = color_transform
+        self._quantization_step = max(MIN_QUANTIZATION_STEP, min(quantization_step, MAX_QUANTIZATION_STEP))
+        # multipliers of the quantizer step for the HL, LH and HH subbands of every level
+        self._subband_weights = tuple(subband_weights)
+        self._predictors = predictors
+        self._codec = codec
+
+        # called with (tokens coded, total tokens) as the coefficients are coded, e.g. utils.progress_bar.progress_bar
+        self._progress_hook = progress_hook
+
+        # an optional qowi.instrumentation.Instrumentation timing the stages of encode() and counting the ops
+        self._instrumentation = instrumentation
+
+        # whether encode() gathers a qowi.op_stats.OpStats of the integer coder's ops in stats
+        self._gather_stats = stats
 
         self._header = Header()
         self._header.cache_size = DEFAULT_CACHE_SIZE
         self._header.wavelet_levels = self._wavelet_levels
         self._header.wavelet_precision_digits = self._wavelet_precision_digits
+        self._header.haar_blocks = haar_blocks
+        self._header.zerotrees = zerotrees
+        self._header.embedded = embedded
+        self._header.dictionary_id = dictionary_id
+        self._dictionary = get_dictionary(dictionary_id)
+        self._header.dictionary_checksum = dictionary_checksum(self._dictionary)
 
-        self._wavelet = Wavelet(wavelet_levels=self._wavelet_levels, precision_digits=self._wavelet_precision_digits)
+        self._wavelet = Wavelet(wavelet_levels=self._wavelet_levels, precision_digits=self._wavelet_precision_digits, scratch_dir=scratch_dir)
+        self._source_image = None
+        self._wavelet_image = None
+        self._reference = None
         self._bitstream = None
 
+        # the codec chosen automatically and its estimated size in bits, as estimating both codecs is slow
+        self._codec_estimate = None
+
         self._finished = False
-        self.stats = {}
+        self.stats = None
         self.encode_duration = 0
+        self.codec = None
+
+        # the integer coder's MFLRU cache, which continues from the given one, e.g. the previous frame's
+        self.cache = cache
+
+    def from_array(self, array: np.ndarray, wavelet: Wavelet = None, reference: Wavelet = None):
+        """
+        Prepares the source image for encoding.
+
+        Parameters:
+        array (np.ndarray): The (width, height, channels) source image.
+        wavelet (Wavelet): Optionally, an unthresholded wavelet already prepared from this image, e.g.
+                           from a cache, with the same levels, precision and color transform. A copy is used.
+        reference (Wavelet): Optionally, the wavelet of a previous frame of the same shape. The coefficients
+                             are then coded as residuals against it, and decoding needs the same reference.
+
+        Without a prepared wavelet, the wavelet is only prepared once it is needed, so images coded spatially skip it.
+        """
+        self._source_image = array
+
+        # the color transform needs three color channels, so fall back to none for other images
+        if self._color_transform == color_transform.COLOR_TRANSFORM_YCOCG_R and array.shape[2] >= 3:
+            self._header.color_transform = color_transform.COLOR_TRANSFORM_YCOCG_R
+            array = color_transform.rgb_to_ycocg_r(array)
+        else:
+            self._header.color_transform = color_transform.COLOR_TRANSFORM_NONE
 
-    def from_array(self, array: np.ndarray):
-        self._wavelet.prepare_from_image(array)
-        self._header.width = self._wavelet.width
-        self._header.height = self._wavelet.height
-        self._header.color_depth = self._wavelet.color_depth
+        if wavelet is None:
+            self._wavelet_image = array
+        elif wavelet.wavelet_levels != self._wavelet_levels or wavelet.precision_binary_digits != self._wavelet_precision_digits:
+            raise ValueError("The prepared wavelet does not match the encoder's wavelet levels and precision")
+        else:
+            self._wavelet = wavelet.copy()
+            self._wavelet_image = None
+
+        self._reference = reference
+        if wavelet is not None:
+            self._subtract_reference()
+
+        self._header.width = array.shape[0]
+        self._header.height = array.shape[1]
+        self._header.color_depth = array.shape[2]
+
+    def _subtract_reference(self):
+        if self._reference is None:
+            return
+        if self._reference.wavelet.shape != self._wavelet.wavelet.shape:
+            raise ValueError("The reference wavelet does not match the shape of the image's wavelet")
+        self._wavelet.wavelet -= self._reference.wavelet
+
+    def _prepare_wavelet(self):
+        if self._wavelet_image is not None:
+            with stage(self._instrumentation, STAGE_TRANSFORM):
+                self._wavelet.prepare_from_image(self._wavelet_image)
+                self._wavelet_image = None
+                self._subtract_reference()
+        self._header.quantization_steps = self._wavelet.quantization_steps(self._quantization_step, self._subband_weights)
 
     def from_file(self, filename):
         self.from_array(io.imread(filename))
@@ -63,7 +170,18 @@ class QOWIEncoder:
     def to_file(self, filename):
         raise NotImplementedError
 
-    def encode(self):
+    def encode(self, target_bytes=None, target_psnr=None):
+        """
+        Encodes the source to the destination bitstream.
+
+        Parameters:
+        target_bytes (int): When given, the hard threshold is chosen so the output fits in this many bytes.
+                            An embedded stream is instead truncated to this many bytes.
+        target_psnr (float): When given, the hard threshold is chosen as the largest that keeps this PSNR.
+
+        The configured thresholds are ignored when a target is given, except when truncating an embedded
+        stream. Only one target may be given. The codec used is recorded in the header and in codec.
+        """
         if self._finished:
             return
 
@@ -71,66 +189,342 @@ class QOWIEncoder:
 
         if self._bitstream is None:
             raise RuntimeError("Destination must be prepared to encode")
-        if self._wavelet is None:
+        if self._source_image is None:
             raise RuntimeError("Source must be prepared to encode")
+        if target_bytes is not None and target_psnr is not None:
+            raise ValueError("Only one of target_bytes and target_psnr can be given")
+        if self._wavelet.scratch_dir is not None and (target_bytes is not None or target_psnr is not None or self._header.embedded):
+            raise ValueError("Size and PSNR targets and embedded coding work on the whole wavelet in memory, so they cannot be used with a scratch directory")
 
-        if self._hard_threshold > 0:
-            self._wavelet.apply_hard_threshold(self._hard_threshold)
-        elif self._soft_threshold > -1:
-            self._wavelet.apply_soft_threshold(self._soft_threshold)
+        with stage(self._instrumentation, STAGE_CODEC_CHOICE):
+            self._header.codec = self._choose_codec(target_bytes is not None or target_psnr is not None)
+        self.codec = self._header.codec
+        if self._header.codec == CODEC_SPATIAL:
+            spatial_encoder = SpatialEncoder(self._header.dictionary_id, self._instrumentation, self._gather_stats)
+            spatial_encoder.from_array(self._source_image)
+            spatial_encoder.to_bitstream(self._bitstream)
+            spatial_encoder.encode()
+            self.stats = spatial_encoder.stats
+        else:
+            self._encode_wavelet(target_bytes, target_psnr)
+
+        end_time = time.time()
+        self.encode_duration = end_time - start_time
+        self._finished = True
+
+    def _encode_wavelet(self, target_bytes, target_psnr):
+        self._prepare_wavelet()
+        with stage(self._instrumentation, STAGE_THRESHOLD):
+            if target_bytes is not None and not self._header.embedded:
+                self._hard_threshold = self._search_threshold_for_size(target_bytes)
+                self._soft_threshold = MIN_SOFT_THRESHOLD
+            elif target_psnr is not None:
+                self._hard_threshold = self._search_threshold_for_psnr(target_psnr)
+                self._soft_threshold = MIN_SOFT_THRESHOLD
+
+            self._apply_thresholds(self._wavelet)
+        with stage(self._instrumentation, STAGE_PREDICTOR_CHOICE):
+            self._header.predictors = self._choose_predictors(self._wavelet)
 
         self._bitstream.append(self._header.header_bits())
 
         # encode the top value of the wavelet to the buffer
-        root_integer = self._wavelet.wavelet[0, 0]
-        root_zigzag = integers.int_tuple_to_zigzag_tuple(root_integer)
-        self._bitstream.append(entropy.simple_encode_tuple(root_zigzag))
+        self._bitstream.append(entropy.simple_encode_tuple(self._root_zigzag(self._wavelet)))
 
         # encode the coefficients to the buffer
-        self._write_coefficients()
+        if self._header.embedded:
+            start = self._bitstream.len
+            with stage(self._instrumentation, STAGE_EMBEDDED_CODING):
+                EmbeddedEncoder(self._bitstream).encode(self._wavelet)
+            self._bitstream.append('0b' + '0' * (8 - self._bitstream.len % 8))
 
-        self._bitstream.append('0b' + '0' * (8 - self._bitstream.len % 8))
+            # any prefix of the planes decodes, so a size target just cuts the stream short
+            if target_bytes is not None:
+                minimum_bytes = (start + 7) // 8
+                del self._bitstream[max(target_bytes, minimum_bytes) * 8:]
+        else:
+            integer_encoder = IntegerEncoder(self._bitstream, DEFAULT_CACHE_SIZE, self._header.haar_blocks, self._header.zerotrees, self._dictionary, self.cache,
+                                             self._instrumentation, self._gather_stats)
+            with stage(self._instrumentation, STAGE_TRAVERSAL):
+                self._encode_coefficients(self._wavelet, integer_encoder, self._header.predictors, self._progress_hook)
+            self.stats = integer_encoder.stats
+            self.cache = integer_encoder.cache
 
-        end_time = time.time()
-        self.encode_duration = end_time - start_time
-        self._finished = True
+            self._bitstream.append('0b' + '0' * (8 - self._bitstream.len % 8))
+
+    def estimate_size(self) -> int:
+        """
+        Calculates the size in bits of the bitstream that encode() would produce with the configured
+        thresholds and quantizer step, without generating any bits. The op code selection, runs and cache are
+        simulated exactly, so the estimate matches the encoded size.
+
+        Returns:
+        int: The encoded size in bits, including the header and final padding.
+        """
+        codec = self._choose_codec(False)
+        if self._codec_estimate is not None:
+            return self._codec_estimate[1]
+        if codec == CODEC_SPATIAL:
+            return self._spatial_estimator(self._source_image).estimate_size()
+
+        self._prepare_wavelet()
+        wavelet = self._wavelet.copy()
+        self._apply_thresholds(wavelet)
+        return self._estimate_bits(wavelet)
+
+    def estimate_psnr(self) -> float:
+        """
+        Calculates the PSNR of the image a decoder would reconstruct with the configured thresholds and
+        quantizer step, without encoding. Since the entropy coding is lossless, this matches the decoded image.
+
+        Returns:
+        float: The PSNR in dB, which is infinite for a lossless encoding.
+        """
+        self._prepare_wavelet()
+        wavelet = self._wavelet.copy()
+        self._apply_thresholds(wavelet)
+        return self._psnr(wavelet)
+
+    def _choose_codec(self, targeted: bool) -> int:
+        """
+        Returns the configured codec, or when none is configured, the one with the smaller estimated size.
+        The spatial codec is lossless, so any lossy setting selects the wavelet.
+
+        Both codecs are estimated exactly on the whole image, as estimates on a crop do not carry over: the
+        coarser wavelet levels of a larger image save more, and a crop caps the depth of the wavelet.
+        """
+        lossy = (targeted or self._hard_threshold > 0 or self._soft_threshold > 0 or self._wavelet_precision_digits > 0
+                 or self._quantization_step > 1 or self._header.embedded)
+
+        if self._reference is not None or self.cache is not None:
+            # only the wavelet codec continues from a previous frame, and lossy residuals would drift from frame to frame
+            if self._codec == CODEC_SPATIAL:
+                raise ValueError("The spatial codec cannot code residuals or continue from a cache")
+            if self._reference is not None and lossy:
+                raise ValueError("Residuals against a reference wavelet can only be coded losslessly")
+            return CODEC_WAVELET
+
+        if self._codec is not None:
+            if self._codec == CODEC_SPATIAL and lossy:
+                raise ValueError("The spatial codec is lossless and cannot be combined with thresholds, precision, quantization, targets or embedded coding")
+            return self._codec
+        if lossy:
+            return CODEC_WAVELET
+        if self._wavelet.scratch_dir is not None:
+            # estimating the spatial codec holds the whole image in memory
+            return CODEC_WAVELET
 
-    def _write_coefficients(self):
+        if self._codec_estimate is None:
+            self._prepare_wavelet()
+            spatial_bits = self._spatial_estimator(self._source_image).estimate_size()
+            wavelet_bits = self._estimate_bits(self._wavelet)
+            # ties go to the spatial codec, which is the faster of the two
+            if spatial_bits <= wavelet_bits:
+                self._codec_estimate = (CODEC_SPATIAL, spatial_bits)
+            else:
+                self._codec_estimate = (CODEC_WAVELET, wavelet_bits)
+        return self._codec_estimate[0]
+
+    def _spatial_estimator(self, image: np.ndarray) -> SpatialEncoder:
+        ret = SpatialEncoder(self._header.dictionary_id)
+        ret.from_array(image)
+        return ret
+
+    def _apply_thresholds(self, wavelet: Wavelet):
+        if self._hard_threshold > 0:
+            wavelet.apply_hard_threshold(self._hard_threshold)
+        elif self._soft_threshold > -1:
+            wavelet.apply_soft_threshold(self._soft_threshold)
+        wavelet.quantize(self._header.quantization_steps)
+
+    def _root_zigzag(self, wavelet: Wavelet) -> tuple:
+        root_integer = tuple(wavelet.wavelet[0, 0].tolist())
+        return integers.int_tuple_to_zigzag_tuple(root_integer)
+
+    def _estimate_bits(self, wavelet: Wavelet) -> int:
+        num_bits = self._header.header_bits().len + entropy.simple_encode_tuple_length(self._root_zigzag(wavelet))
+
+        if self._header.embedded:
+            # the bit-plane coder is vectorized, so encoding to a scratch stream is cheap
+            planes = BitStream()
+            EmbeddedEncoder(planes).encode(wavelet)
+            num_bits += planes.len
+        else:
+            cache = self.cache.copy() if self.cache is not None else None
+            size_estimator = IntegerSizeEstimator(DEFAULT_CACHE_SIZE, self._header.haar_blocks, self._header.zerotrees, self._dictionary, cache)
+            self._encode_coefficients(wavelet, size_estimator, self._choose_predictors(wavelet))
+            num_bits += size_estimator.num_bits
+
+        return num_bits + 8 - num_bits % 8
+
+    def _search_threshold_for_size(self, target_bytes) -> float:
+        target_bits = target_bytes * 8
+        if self._approximate_bits(self._wavelet) <= target_bits:
+            return MIN_HARD_THRESHOLD
+
+        # find the smallest threshold that fits by the fast approximation, settling for the largest if none do
+        too_small, large_enough = 0, MAX_HARD_THRESHOLD
+        for _ in range(RATE_CONTROL_ITERATIONS):
+            threshold = (too_small + large_enough) / 2
+            if self._approximate_bits(self._thresholded_copy(threshold)) <= target_bits:
+                large_enough = threshold
+            else:
+                too_small = threshold
+
+        # the approximation never underestimates, so refine downwards with the exact estimate
+        too_small = 0
+        for _ in range(RATE_CONTROL_REFINEMENTS):
+            threshold = (too_small + large_enough) / 2
+            if self._estimate_bits(self._thresholded_copy(threshold)) <= target_bits:
+                large_enough = threshold
+            else:
+                too_small = threshold
+
+        return large_enough
+
+    def _search_threshold_for_psnr(self, target_psnr) -> float:
+        if self._psnr(self._thresholded_copy(MAX_HARD_THRESHOLD)) >= target_psnr:
+            return MAX_HARD_THRESHOLD
+
+        # find the largest threshold that keeps the PSNR, settling for none if the wavelet is already too lossy
+        small_enough, too_large = 0, MAX_HARD_THRESHOLD
+        for _ in range(RATE_CONTROL_ITERATIONS):
+            threshold = (small_enough + too_large) / 2
+            if self._psnr(self._thresholded_copy(threshold)) >= target_psnr:
+                small_enough = threshold
+            else:
+                too_large = threshold
+
+        return small_enough if small_enough > 0 else MIN_HARD_THRESHOLD
+
+    def _thresholded_copy(self, threshold) -> Wavelet:
+        ret = self._wavelet.copy()
+        ret.apply_hard_threshold(threshold)
+        ret.quantize(self._header.quantization_steps)
+        return ret
+
+    def _psnr(self, wavelet: Wavelet) -> float:
+        if self._header.quantization_steps:
+            wavelet = wavelet.copy()
+            wavelet.dequantize(self._header.quantization_steps)
+        with stage(self._instrumentation, STAGE_INVERSE_TRANSFORM):
+            reconstructed = color_transform.to_image(wavelet.as_array(), self._header.color_transform)
+        mse = np.mean((self._source_image.astype(np.float64) - reconstructed) ** 2)
+        if mse == 0:
+            return float('inf')
+        return 10 * np.log10(MAX_PIXEL_VALUE ** 2 / mse)
+
+    def _approximate_bits(self, wavelet: Wavelet) -> int:
+        """
+        Quickly approximates the encoded size in bits from the run lengths and code lengths of the
+        coefficients in traversal order. The cache, Haar blocks and zerotrees are not simulated, so this never underestimates.
+        """
+        num_bits = self._header.header_bits().len + entropy.simple_encode_tuple_length(self._root_zigzag(wavelet))
+
+        rows, cols = traversal_order(wavelet.num_levels)
+        tokens = wavelet.wavelet[rows, cols].astype(np.int64)
+        if len(tokens) > 0:
+            previous = np.empty_like(tokens)
+            previous[0] = 0
+            previous[1:] = tokens[:-1]
+            repeats = np.all(tokens == previous, axis=1)
+            if len(ZERO_INTEGER) != tokens.shape[1]:
+                repeats[0] = False
+
+            # each run of repeated tokens is coded as a single RUN op
+            edges = np.diff(np.concatenate(([0], repeats.astype(np.int8), [0])))
+            run_lengths = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+            num_bits += int(np.sum(2 + entropy.simple_encode_length_ndarray(run_lengths - 1)))
+
+            # every other token is coded as the shorter of DELTA and VALUE
+            changed = ~repeats
+            predictions = prediction_array(wavelet.wavelet, wavelet.num_levels, self._choose_predictors(wavelet))[rows, cols]
+            num_bits += int(np.sum(self._op_bits(tokens[changed], predictions[changed])))
+
+        return num_bits + 8 - num_bits % 8
+
+    def _op_bits(self, tokens: np.ndarray, predictions: np.ndarray) -> np.ndarray:
+        """The length of the shorter of the DELTA and VALUE ops of each token, given its DELTA prediction."""
+        delta_zigzag = integers.integer_to_zigzag_ndarray(predictions - tokens)
+        value_zigzag = integers.integer_to_zigzag_ndarray(tokens)
+        delta_bits = np.sum(entropy.simple_encode_length_ndarray(delta_zigzag), axis=1)
+        value_bits = np.sum(entropy.simple_encode_length_ndarray(value_zigzag), axis=1)
+        value_op_bits = 3 if self._header.haar_blocks or self._header.zerotrees else 2
+        return np.minimum(2 + delta_bits, value_op_bits + value_bits)
+
+    def _choose_predictors(self, wavelet: Wavelet) -> tuple:
+        """
+        Returns the configured DELTA predictor of each subband, or when none is configured, picks for each
+        subband the predictor with the fewest DELTA and VALUE op bits over its coefficients. The bands are
+        estimated a block of rows at a time, so this works on scratch backed wavelets too.
+        """
+        if self._header.embedded:
+            return DEFAULT_PREDICTORS
+        if self._predictors is not None:
+            return tuple(self._predictors)
+        if wavelet.num_levels == 0:
+            return DEFAULT_PREDICTORS
+
+        channels = wavelet.wavelet.shape[2]
+        costs = np.zeros((len(PREDICTORS), len(FILTERS)), dtype=np.int64)
+        for level in range(wavelet.num_levels):
+            for subband, (filter, band) in enumerate(zip(FILTERS, wavelet.detail_bands(level))):
+                for start, stop in row_blocks(len(band), channels):
+                    tokens = band[start:stop].reshape(-1, channels).astype(np.int64)
+                    for predictor in PREDICTORS:
+                        predictions = band_predictions(wavelet.wavelet, wavelet.num_levels, level, filter, predictor, start, stop)
+                        costs[predictor, subband] += np.sum(self._op_bits(tokens, predictions.reshape(-1, channels)))
+
+        return tuple(PREDICTORS[index] for index in np.argmin(costs, axis=0))
+
+    def _encode_coefficients(self, wavelet: Wavelet, integer_encoder: IntegerEncoder, predictors=DEFAULT_PREDICTORS, progress_hook=None):
         stack = [(0, 'HH', 0, 0), (0, 'LH', 0, 0), (0, 'HL', 0, 0)]
-        integer_encoder = IntegerEncoder(self._bitstream, DEFAULT_CACHE_SIZE)
+        subtree_maxima = wavelet.subtree_maxima()
+
+        # every prediction depends only on coefficients coded earlier, so they can all be made up front
+        predictions = None
+        if any(predictor != PREDICTOR_LAST for predictor in predictors):
+            predictions = prediction_array(wavelet.wavelet, wavelet.num_levels, predictors, wavelet.zeros_like())
+
+        def prediction(level, filter, i, j):
+            if predictions is None or predictors[FILTERS.index(filter)] == PREDICTOR_LAST:
+                return None
+            return tuple(predictions[coefficient_position(level, filter, i, j)].tolist())
 
-        number_of_tokens = self._wavelet.length ** 2 - 1
+        number_of_tokens = wavelet.length ** 2 - 1
         counter = 1
         while len(stack) > 0:
-            progress_bar(counter, number_of_tokens)
+            if progress_hook is not None:
+                progress_hook(counter, number_of_tokens)
             counter += 1
 
             level, filter, i, j = stack.pop()
+            this_integer = tuple(wavelet.wavelet[coefficient_position(level, filter, i, j)].tolist())
 
-            level_length = 2 ** level
-            if filter == 'HL':
-                i_offset = 0
-                j_offset = level_length
-            elif filter == 'LH':
-                i_offset = level_length
-                j_offset = 0
-            elif filter == 'HH':
-                i_offset = level_length
-                j_offset = level_length
-            else:
-                raise ValueError("Unknown filter '{}'".format(filter))
+            if level + 1 >= wavelet.num_levels:
+                integer_encoder.encode_next(this_integer, prediction(level, filter, i, j))
+                continue
+
+            # skip visiting the descendants of a coefficient whose subtree is all zero
+            if subtree_maxima[level][FILTERS.index(filter), i, j] == 0:
+                num_tokens = subtree_size(level, wavelet.num_levels)
+                integer_encoder.encode_zero_subtree(this_integer, num_tokens, prediction(level, filter, i, j))
+                counter += num_tokens - 1
+                continue
 
             # encode this coefficient
-            this_integer = self._wavelet.wavelet[i + i_offset][j + j_offset]
-            integer_encoder.encode_next(tuple(this_integer))
+            integer_encoder.encode_next(this_integer, prediction(level, filter, i, j))
 
-            # append children to the stack
-            if level + 1 < self._wavelet.num_levels:
-                stack.append((level + 1, filter, 2 * i, 2 * j))
-                stack.append((level + 1, filter, 2 * i, 2 * j + 1))
-                stack.append((level + 1, filter, 2 * i + 1, 2 * j))
-                stack.append((level + 1, filter, 2 * i + 1, 2 * j + 1))
+            children = [(level + 1, filter, 2 * i, 2 * j), (level + 1, filter, 2 * i, 2 * j + 1),
+                        (level + 1, filter, 2 * i + 1, 2 * j), (level + 1, filter, 2 * i + 1, 2 * j + 1)]
+
+            if self._header.haar_blocks and level + 2 == wavelet.num_levels:
+                # the children are leaves, so they would be popped next in reverse order; encode them as a block
+                block = [tuple(wavelet.wavelet[coefficient_position(*child)].tolist()) for child in reversed(children)]
+                integer_encoder.encode_block(block, [prediction(*child) for child in reversed(children)])
+                counter += len(block)
+            else:
+                # append children to the stack
+                stack.extend(children)
 
-        print()
         integer_encoder.finish()
-        self.stats = integer_encoder.stats
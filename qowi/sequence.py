@@ -0,0 +1,183 @@
+"""
+A container for sequences of nearly identical frames, such as bursts and time-lapses.
+
+Every frame is a QOWI wavelet stream. A keyframe is coded like a single image. Any other frame codes its
+wavelet coefficients as residuals against the previous frame's, and its integer coder continues from
+the previous frame's MFLRU cache, so static content codes as a single run and decodes by skipping a
+zero subtree. Keyframes start afresh every keyframe_interval frames, which bounds the work to seek.
+
+Each frame is stored as a record of a keyframe bit and the simple encoded payload length in bytes, padded
+to a whole byte, followed by the payload. The records are byte aligned, so the frames can be indexed
+without decoding them.
+"""
+
+import numpy as np
+import qowi.entropy as entropy
+from bitstring import Bits, BitStream
+from qowi import color_transform
+from qowi.dictionary import DICTIONARY_NONE
+from qowi.header import CODEC_WAVELET
+from qowi.qowi_decoder import QOWIDecoder
+from qowi.qowi_encoder import DEFAULT_COLOR_TRANSFORM, DEFAULT_WAVELET_LEVELS, QOWIEncoder
+from qowi.wavelet import Wavelet
+
+DEFAULT_KEYFRAME_INTERVAL = 30
+KEYFRAME_BITS = 1
+
+
+class SequenceEncoder:
+    def __init__(self, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+                 wavelet_encode_levels=DEFAULT_WAVELET_LEVELS,
+                 color_transform=DEFAULT_COLOR_TRANSFORM,
+                 haar_blocks=False,
+                 zerotrees=False,
+                 predictors=None,
+                 dictionary_id=DICTIONARY_NONE, ):
+        if keyframe_interval < 1:
+            raise ValueError("The keyframe interval must be at least 1")
+
+        self._keyframe_interval = keyframe_interval
+        self._wavelet_levels = wavelet_encode_levels
+        self._color_transform = color_transform
+        self._haar_blocks = haar_blocks
+        self._zerotrees = zerotrees
+        self._predictors = predictors
+        self._dictionary_id = dictionary_id
+
+        self._bitstream = None
+        self._reference = None
+        self._cache = None
+        self.num_frames = 0
+        self.frame_sizes = []
+
+    def to_bitstream(self, bitstream: BitStream):
+        self._bitstream = bitstream
+
+    def add_frame(self, array: np.ndarray):
+        """
+        Encodes the next frame and appends its record to the destination bitstream.
+
+        Parameters:
+        array (np.ndarray): The (width, height, channels) frame, shaped like every other frame.
+        """
+        if self._bitstream is None:
+            raise RuntimeError("Destination must be prepared to encode")
+        if self._reference is not None and array.shape[:2] != (self._reference.width, self._reference.height):
+            raise ValueError("Every frame of a sequence must have the same shape")
+
+        keyframe = self.num_frames % self._keyframe_interval == 0
+        if keyframe:
+            self._reference = None
+            self._cache = None
+
+        # the next frame is coded against this frame's full wavelet, so prepare it here
+        transformed = array
+        if self._color_transform == color_transform.COLOR_TRANSFORM_YCOCG_R and array.shape[2] >= 3:
+            transformed = color_transform.rgb_to_ycocg_r(array)
+        wavelet = Wavelet(wavelet_levels=self._wavelet_levels).prepare_from_image(transformed)
+
+        payload = BitStream()
+        encoder = QOWIEncoder(wavelet_encode_levels=self._wavelet_levels, color_transform=self._color_transform,
+                              haar_blocks=self._haar_blocks, zerotrees=self._zerotrees, predictors=self._predictors,
+                              codec=CODEC_WAVELET, dictionary_id=self._dictionary_id, cache=self._cache)
+        encoder.from_array(array, wavelet, self._reference)
+        encoder.to_bitstream(payload)
+        encoder.encode()
+
+        record = BitStream()
+        record.append(Bits(uint=int(keyframe), length=KEYFRAME_BITS))
+        record.append(entropy.simple_encode(len(payload) // 8))
+        record.append('0b' + '0' * (-record.len % 8))
+        self._bitstream.append(record)
+        self._bitstream.append(payload)
+
+        self._reference = wavelet
+        self._cache = encoder.cache
+        self.num_frames += 1
+        self.frame_sizes.append((record.len + payload.len) // 8)
+
+
+class SequenceDecoder:
+    def __init__(self):
+        self._bitstream = None
+        self._records = None
+        self._next_index = None
+        self._reference = None
+        self._cache = None
+
+    def from_bitstream(self, bitstream: BitStream):
+        self._bitstream = bitstream
+        self._records = None
+        self._next_index = None
+
+    def _index(self) -> list:
+        """Reads the (keyframe, start, length) of every frame record, in bits, without decoding the frames."""
+        if self._records is None:
+            if self._bitstream is None:
+                raise RuntimeError("Source must be prepared to decode")
+
+            self._records = []
+            self._bitstream.pos = 0
+            while self._bitstream.pos < self._bitstream.len:
+                start = self._bitstream.pos
+                keyframe = self._bitstream.read(KEYFRAME_BITS).uint == 1
+                num_bytes = entropy.simple_decode(self._bitstream)
+                self._bitstream.pos += -(self._bitstream.pos - start) % 8
+                if not self._records and not keyframe:
+                    raise ValueError("A sequence must start with a keyframe")
+
+                self._records.append((keyframe, self._bitstream.pos, num_bytes * 8))
+                self._bitstream.pos += num_bytes * 8
+        return self._records
+
+    @property
+    def num_frames(self) -> int:
+        return len(self._index())
+
+    def keyframes(self) -> list:
+        """The indices of the keyframes, where decoding can start."""
+        return [index for index, (keyframe, _, _) in enumerate(self._index()) if keyframe]
+
+    def frame(self, index: int) -> np.ndarray:
+        """
+        Decodes a frame. Decoding continues from the last decoded frame when index follows it, and otherwise
+        starts from the closest keyframe at or before index.
+
+        Parameters:
+        index (int): The frame to decode.
+
+        Returns:
+        np.ndarray: The (width, height, channels) frame.
+        """
+        records = self._index()
+        if not 0 <= index < len(records):
+            raise IndexError("Frame {} is not in a sequence of {} frames".format(index, len(records)))
+
+        start = index
+        if index != self._next_index:
+            while not records[start][0]:
+                start -= 1
+
+        for position in range(start, index + 1):
+            ret = self._decode_frame(position)
+        return ret
+
+    def frames(self):
+        """Decodes the frames in order."""
+        for index in range(self.num_frames):
+            yield self.frame(index)
+
+    def _decode_frame(self, index: int) -> np.ndarray:
+        keyframe, start, length = self._records[index]
+        if keyframe:
+            self._reference = None
+            self._cache = None
+
+        decoder = QOWIDecoder(cache=self._cache)
+        decoder.from_bitstream(BitStream(self._bitstream[start:start + length]), self._reference)
+        decoder.decode()
+
+        self._reference = decoder.as_wavelet()
+        self._cache = decoder.cache
+        self._next_index = index + 1
+        return decoder.as_array()
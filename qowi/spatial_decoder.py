@@ -1,16 +1,18 @@
-import qowi.entropy as entropy
 import numpy as np
 import time
 from bitstring import BitStream
 
 from qowi import integers
+from qowi.dictionary import get_dictionary
 from qowi.header import Header
+from qowi.instrumentation import STAGE_TRAVERSAL, stage
 from qowi.integer_decoder import IntegerDecoder
-from utils.progress_bar import progress_bar
+from qowi.spatial_encoder import NUM_PIXEL_VALUES
 
 class SpatialDecoder:
-    def __init__(self):
+    def __init__(self, instrumentation=None):
         self._header = Header()
+        self._instrumentation = instrumentation
         self._output_image = None
         self._bitstream = None
         self._finished = False
@@ -39,27 +41,30 @@ class SpatialDecoder:
         if self._bitstream is None:
             raise RuntimeError("Destination must be prepared to encode")
 
+        self._bitstream.pos = 0
         self._header.read(self._bitstream)
-        self._output_image = np.empty((self._header.width, self._header.height, 3), dtype=np.uint8)
 
-        self._read_pixels()
+        with stage(self._instrumentation, STAGE_TRAVERSAL):
+            self._read_pixels()
 
         end_time = time.time()
         self.decode_duration = end_time - start_time
         self._finished = True
 
     def _read_pixels(self):
-        integer_decoder = IntegerDecoder(self._bitstream, self._header.cache_size)
-
-        number_of_tokens = self._header.width * self._header.height
-        counter = 1
-        for i in range(self._header.width):
-            for j in range(self._header.height):
-                progress_bar(counter, number_of_tokens)
-                counter += 1
-
-                this_shifted = integer_decoder.decode_next()
-                this_pixel = integers.shifted_tuple_to_int_tuple(this_shifted, 256)
-                self._output_image[i, j] = this_pixel
-
-        print()
\ No newline at end of file
+        integer_decoder = IntegerDecoder(self._bitstream, self._header.cache_size, color_depth=self._header.color_depth,
+                                         dictionary=get_dictionary(self._header.dictionary_id, self._header.dictionary_checksum), instrumentation=self._instrumentation)
+
+        num_pixels = self._header.width * self._header.height
+        pixels = np.empty((num_pixels, self._header.color_depth), dtype=np.int64)
+        position = 0
+        while position < num_pixels:
+            this_shifted = integer_decoder.decode_next()
+
+            # fill the rest of a run in one go
+            count = 1 + integer_decoder.take_run(num_pixels - position - 1)
+            pixels[position:position + count] = this_shifted
+            position += count
+
+        pixels = integers.shifted_to_integer_ndarray(pixels, NUM_PIXEL_VALUES)
+        self._output_image = pixels.reshape(self._header.width, self._header.height, self._header.color_depth).astype(np.uint8)
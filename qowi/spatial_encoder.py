@@ -1,32 +1,44 @@
-import warnings
 import numpy as np
 import time
 from bitstring import Bits, BitStream
 
 from qowi import integers
-from qowi.integer_encoder import IntegerEncoder
+from qowi.integer_encoder import IntegerEncoder, IntegerSizeEstimator
 from skimage import io
-from qowi.header import Header
-from utils.progress_bar import progress_bar
+from qowi.dictionary import DICTIONARY_NONE, dictionary_checksum, get_dictionary
+from qowi.header import CODEC_SPATIAL, Header
+from qowi.instrumentation import STAGE_TRAVERSAL, stage
 
 DEFAULT_CACHE_SIZE = 65533
+NUM_PIXEL_VALUES = 256
 
 class SpatialEncoder:
-    def __init__(self):
+    """
+    Lossless QOI-style codec that codes the pixels in raster order with the integer coder, skipping the
+    wavelet entirely. It suits screenshots and UI assets, whose flat areas become long runs.
+    """
+    def __init__(self, dictionary_id=DICTIONARY_NONE, instrumentation=None, stats=False):
         self._header = Header()
         self._header.cache_size = DEFAULT_CACHE_SIZE
-
-        if self._header.bit_shift > 0:
-            warnings.warn("Bit shift is currently not implemented", category=UserWarning)
+        self._header.wavelet_levels = 0
+        self._header.wavelet_precision_digits = 0
+        self._header.codec = CODEC_SPATIAL
+        self._header.dictionary_id = dictionary_id
+        self._dictionary = get_dictionary(dictionary_id)
+        self._header.dictionary_checksum = dictionary_checksum(self._dictionary)
+        self._instrumentation = instrumentation
+        self._gather_stats = stats
 
         self._source_image = None
         self._bitstream = None
 
         self._finished = False
-        self.stats = {}
+        self.stats = None
         self.encode_duration = 0
 
     def from_array(self, array: np.ndarray):
+        if array.ndim == 2:
+            array = array[:, :, np.newaxis]
         self._source_image = array
 
     def from_file(self, filename):
@@ -49,31 +61,51 @@ class SpatialEncoder:
         if self._source_image is None:
             raise RuntimeError("Source must be prepared to encode")
 
-        self._header.width = self._source_image.shape[0]
-        self._header.height = self._source_image.shape[1]
-        self._header.write(self._bitstream)
+        self._prepare_header()
+        self._bitstream.append(self._header.header_bits())
 
-        self._write_pixels()
+        integer_encoder = IntegerEncoder(self._bitstream, self._header.cache_size, dictionary=self._dictionary,
+                                         instrumentation=self._instrumentation, stats=self._gather_stats)
+        with stage(self._instrumentation, STAGE_TRAVERSAL):
+            self._write_pixels(integer_encoder)
+        self.stats = integer_encoder.stats
+
+        self._bitstream.append('0b' + '0' * (8 - self._bitstream.len % 8))
 
         end_time = time.time()
         self.encode_duration = end_time - start_time
         self._finished = True
 
-    def _write_pixels(self):
-        integer_encoder = IntegerEncoder(self._bitstream, DEFAULT_CACHE_SIZE)
-        self._header.cache_size = DEFAULT_CACHE_SIZE
+    def estimate_size(self) -> int:
+        """
+        Calculates the size in bits of the bitstream that encode() would produce, without generating any bits.
+
+        Returns:
+        int: The encoded size in bits, including the header and final padding.
+        """
+        if self._source_image is None:
+            raise RuntimeError("Source must be prepared to estimate")
+
+        self._prepare_header()
+        size_estimator = IntegerSizeEstimator(self._header.cache_size, dictionary=self._dictionary)
+        self._write_pixels(size_estimator)
 
-        number_of_tokens = self._source_image.shape[0] * self._source_image.shape[1]
-        counter = 1
-        for i in range(self._header.width):
-            for j in range(self._header.height):
-                progress_bar(counter, number_of_tokens)
-                counter += 1
+        num_bits = self._header.header_bits().len + size_estimator.num_bits
+        return num_bits + 8 - num_bits % 8
 
-                this_pixel = self._source_image[i, j]
-                this_shifted = integers.int_tuple_to_shifted_tuple(this_pixel, 256)
-                integer_encoder.encode_next(this_shifted)
+    def _prepare_header(self):
+        self._header.width = self._source_image.shape[0]
+        self._header.height = self._source_image.shape[1]
+        self._header.color_depth = self._source_image.shape[2]
+
+    def _write_pixels(self, integer_encoder: IntegerEncoder):
+        pixels = integers.integer_to_shifted_ndarray(self._source_image.reshape(-1, self._header.color_depth), NUM_PIXEL_VALUES)
+
+        # find the runs of identical pixels up front, so the encoder only visits the first pixel of each
+        if len(pixels) > 0:
+            starts = np.flatnonzero(np.concatenate(([True], np.any(pixels[1:] != pixels[:-1], axis=1))))
+            counts = np.diff(np.append(starts, len(pixels)))
+            for this_shifted, count in zip(pixels[starts].tolist(), counts.tolist()):
+                integer_encoder.encode_repeated(tuple(this_shifted), count)
 
-        print()
         integer_encoder.finish()
-        self.stats = integer_encoder.stats
@@ -1,8 +1,118 @@
+import copy
 import math
 import numpy as np
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from numpy import ndarray
 from qowi import integers
 
+DEFAULT_BIT_DEPTH = 8
+STORAGE_DTYPES = (np.int16, np.int32, np.int64)
+FILTERS = ('HL', 'LH', 'HH')
+
+# the inverse transform sums four coefficients before dividing, so keep two bits of headroom
+INVERSE_HEADROOM_BITS = 2
+
+# channel planes at least this long are transformed in parallel threads, smaller ones are not worth the overhead
+PARALLEL_MIN_LENGTH = 128
+
+# when the coefficients are backed by scratch files, they are transformed and copied in bands of rows of about this size
+SCRATCH_BLOCK_BYTES = 64 << 20
+
+def max_coefficient_magnitude(bit_depth, wavelet_levels, precision_digits):
+    """
+    Calculates an upper bound on the magnitude of any value held by a wavelet, including
+    the coefficients of every level and the rounding adjustments made when rescaling.
+
+    Parameters:
+    bit_depth (int): The number of bits needed for the magnitude of a source channel value.
+    wavelet_levels (int): The number of wavelet levels that will be generated.
+    precision_digits (int): The precision in binary digits kept at each wavelet level.
+
+    Returns:
+    int: The maximum possible magnitude.
+    """
+    magnitude = (1 << bit_depth) - 1
+    ret = magnitude
+    for scaling_factor_digits in range(2, 2 * wavelet_levels + 1, 2):
+        if precision_digits > 0:
+            rescale_digits = scaling_factor_digits - precision_digits
+            if rescale_digits > 0:
+                # rounding can add one to the shifted value and the adjustment must be representable
+                ret = max(ret, 1 << (rescale_digits - 1))
+                magnitude = (magnitude >> rescale_digits) + 1
+
+        magnitude *= 4
+        ret = max(ret, magnitude)
+
+    return ret
+
+def storage_dtype(max_magnitude):
+    """
+    Chooses the smallest signed integer dtype able to hold the wavelet and its inverse.
+
+    Parameters:
+    max_magnitude (int): The maximum possible magnitude as given by max_coefficient_magnitude.
+
+    Returns:
+    type: One of the STORAGE_DTYPES.
+    """
+    for dtype in STORAGE_DTYPES:
+        if max_magnitude << INVERSE_HEADROOM_BITS <= np.iinfo(dtype).max:
+            return dtype
+
+    raise ValueError("Wavelet coefficients of magnitude {} do not fit in 64 bits".format(max_magnitude))
+
+def traversal_order(num_levels):
+    """
+    Calculates the order in which the coefficients of a wavelet are visited for coding. This
+    is a depth-first walk of the HL, LH and HH quad-trees, visiting the children of each
+    coefficient in reverse raster order, so the subtree of any coefficient is contiguous.
+
+    Parameters:
+    num_levels (int): The number of levels of the wavelet, where the wavelet length is 2 ** num_levels.
+
+    Returns:
+    tuple: The (rows, cols) ndarrays of wavelet positions in visit order.
+    """
+    if num_levels == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # build the pre-order of a single quad-tree from the leaves up as (level, i, j) triples
+    levels = np.zeros(1, dtype=np.int64)
+    i = np.zeros(1, dtype=np.int64)
+    j = np.zeros(1, dtype=np.int64)
+    for _ in range(1, num_levels):
+        subtree_offsets = 2 ** levels
+        all_levels, all_i, all_j = [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)]
+        for di, dj in ((1, 1), (1, 0), (0, 1), (0, 0)):
+            all_levels.append(levels + 1)
+            all_i.append(i + di * subtree_offsets)
+            all_j.append(j + dj * subtree_offsets)
+        levels, i, j = np.concatenate(all_levels), np.concatenate(all_i), np.concatenate(all_j)
+
+    level_lengths = 2 ** levels
+    rows = np.concatenate([i, i + level_lengths, i + level_lengths])  # HL, LH, HH
+    cols = np.concatenate([j + level_lengths, j, j + level_lengths])
+    return rows, cols
+
+def coefficient_position(level, filter, i, j):
+    """Converts a node of the quad-tree traversal to its (row, column) in the wavelet array."""
+    level_length = 2 ** level
+    if filter == 'HL':
+        return i, j + level_length
+    elif filter == 'LH':
+        return i + level_length, j
+    elif filter == 'HH':
+        return i + level_length, j + level_length
+    else:
+        raise ValueError("Unknown filter '{}'".format(filter))
+
+def subtree_size(level, num_levels):
+    """The number of coefficients in the quad-tree below a coefficient of this level, itself included."""
+    return (4 ** (num_levels - level) - 1) // 3
+
 def haar_encode(a, b, c, d):
     ll = a + b + c + d
     hl = a + b - c - d
@@ -20,7 +130,7 @@ def haar_decode(ll, hl, lh, hh):
     return a, b, c, d
 
 class Wavelet:
-    def __init__(self, width=0, height=0, color_depth=0, wavelet_levels=10, precision_digits=0):
+    def __init__(self, width=0, height=0, color_depth=0, wavelet_levels=10, precision_digits=0, bit_depth=DEFAULT_BIT_DEPTH, threads=None, scratch_dir=None):
         self.width = 0
         self.height = 0
         self.color_depth = 0
@@ -28,9 +138,18 @@ class Wavelet:
         self.num_levels = 0
         self.wavelet_levels = wavelet_levels
         self.precision_binary_digits = precision_digits
+        self.bit_depth = bit_depth
+        self.dtype = np.int64
         self.wavelet = None
         self.carry_over = None
 
+        # the number of threads transforming the channel planes, by default one per channel up to the number of cores
+        self.threads = threads
+
+        # when given, the coefficients and the transform's temporaries are np.memmap arrays backed by files in this
+        # directory, so images larger than memory can be transformed a band of rows at a time
+        self.scratch_dir = scratch_dir
+
         self._initialize_from_shape(width, height, color_depth)
 
     def _initialize_from_shape(self, width, height, color_depth):
@@ -44,41 +163,140 @@ class Wavelet:
             self.num_levels = max(math.ceil(math.log2(width)), math.ceil(math.log2(height)))
             self.length = 2 ** self.num_levels
 
-        self.wavelet = np.zeros((self.length, self.length, self.color_depth), dtype=np.int64)
+        encoded_levels = min(self.wavelet_levels, self.num_levels)
+        self.dtype = storage_dtype(max_coefficient_magnitude(self.bit_depth, encoded_levels, self.precision_binary_digits))
+        self.wavelet = self._allocate((self.length, self.length, self.color_depth))
+
+    def _allocate(self, shape) -> ndarray:
+        """Allocates a zeroed array of coefficients, backed by an anonymous scratch file when a scratch directory is set."""
+        if self.scratch_dir is None or 0 in shape:
+            return np.zeros(shape, dtype=self.dtype)
+
+        # the file is unlinked on creation and its space is freed once the mapping is released
+        with tempfile.TemporaryFile(dir=self.scratch_dir) as scratch_file:
+            return np.memmap(scratch_file, dtype=self.dtype, mode='w+', shape=shape)
+
+    def _band_rows(self, row_length) -> int:
+        """The number of rows of a level processed at a time when the coefficients are backed by scratch files."""
+        return max(1, SCRATCH_BLOCK_BYTES // (row_length * max(self.color_depth, 1) * np.dtype(self.dtype).itemsize))
+
+    def _copy_rows(self, source: ndarray, dest: ndarray):
+        band_rows = self._band_rows(source.shape[1])
+        for start in range(0, source.shape[0], band_rows):
+            dest[start:start + band_rows] = source[start:start + band_rows]
+
+    def _copy_array(self, array: ndarray) -> ndarray:
+        if self.scratch_dir is None:
+            return array.copy()
+        ret = self._allocate(array.shape)
+        self._copy_rows(array, ret)
+        return ret
+
+    def _rescale_digits(self, level):
+        """The number of binary digits the inputs of a level are rounded off by to keep the configured precision."""
+        if self.precision_binary_digits > 0:
+            return max((self.num_levels - level) * 2 - self.precision_binary_digits, 0)
+        return 0
+
+    def _map_planes(self, function, array: ndarray):
+        """
+        Applies an in-place transform to each channel plane of an array. The channels are independent
+        and NumPy releases the GIL for integer arithmetic, so large planes are transformed in parallel threads.
+        """
+        planes = [np.ascontiguousarray(array[:, :, channel]) for channel in range(array.shape[2])]
+        threads = min(len(planes), self.threads or os.cpu_count() or 1)
+        if threads > 1 and array.shape[0] >= PARALLEL_MIN_LENGTH:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(function, planes))
+        else:
+            for plane in planes:
+                function(plane)
+
+        for channel, plane in enumerate(planes):
+            array[:, :, channel] = plane
+
+    def _forward_rows(self, region: ndarray, dest: ndarray, level, start, stop):
+        """
+        Transforms the rows of a level that produce the coefficient rows [start, stop) of each quadrant.
+        The source rows are read before anything is written, so dest may be region when all rows are done at once.
+        """
+        length = 2 ** level
+        rows = region[2 * start:2 * stop]
+        a, b, c, d = rows[0::2, 0::2], rows[0::2, 1::2], rows[1::2, 0::2], rows[1::2, 1::2]
+
+        rescale_digits = self._rescale_digits(level)
+        if rescale_digits > 0:
+            a, b, c, d = (integers.rescale_ndarray(value, -rescale_digits) for value in (a, b, c, d))  # shift right
+
+        ll, hl, lh, hh = haar_encode(a, b, c, d)
+        dest[start:stop, :length] = ll
+        dest[start:stop, length:] = hl
+        dest[length + start:length + stop, :length] = lh
+        dest[length + start:length + stop, length:] = hh
+
+    def _inverse_rows(self, region: ndarray, dest: ndarray, level, start, stop):
+        """Inverts the coefficient rows [start, stop) of each quadrant of a level, like _forward_rows."""
+        length = 2 ** level
+        top, bottom = region[start:stop], region[length + start:length + stop]
+
+        a, b, c, d = haar_decode(top[:, :length], top[:, length:], bottom[:, :length], bottom[:, length:])
+
+        rescale_digits = self._rescale_digits(level)
+        if rescale_digits > 0:
+            a, b, c, d = (integers.rescale_ndarray(value, rescale_digits) for value in (a, b, c, d))  # shift left
+
+        rows = dest[2 * start:2 * stop]
+        rows[0::2, 0::2] = a
+        rows[0::2, 1::2] = b
+        rows[1::2, 0::2] = c
+        rows[1::2, 1::2] = d
+
+    def _forward_levels(self):
+        lowest_order_level = max(self.num_levels - self.wavelet_levels, 0)
+        return reversed(range(lowest_order_level, self.num_levels))
 
-    def _gen_wavelet(self):
+    def _inverse_levels(self):
         lowest_order_level = max(self.num_levels - self.wavelet_levels, 0)
-        for dest_level in reversed(range(lowest_order_level, self.num_levels)):
-            dest_length = 2 ** dest_level
-            dest_wavelets = np.zeros((2 * dest_length, 2 * dest_length, self.color_depth), dtype=np.int64)
-
-            for i in range(dest_length):
-                for j in range(dest_length):
-                    a = self.wavelet[2 * i, 2 * j]
-                    b = self.wavelet[2 * i, 2 * j + 1]
-                    c = self.wavelet[2 * i + 1, 2 * j]
-                    d = self.wavelet[2 * i + 1, 2 * j + 1]
-
-                    if self.precision_binary_digits > 0:
-                        scaling_factor_digits = (self.num_levels - dest_level) * 2
-                        rescale_digits = scaling_factor_digits - self.precision_binary_digits
-                        if rescale_digits > 0:
-                            a = integers.rescale_ndarray(a, -rescale_digits) # shift right
-                            b = integers.rescale_ndarray(b, -rescale_digits)  # shift right
-                            c = integers.rescale_ndarray(c, -rescale_digits)  # shift right
-                            d = integers.rescale_ndarray(d, -rescale_digits)  # shift right
-
-                    ll, hl, lh, hh = haar_encode(a, b, c, d)
-
-                    dest_wavelets[i, j] = ll
-                    dest_wavelets[i, dest_length + j] = hl
-                    dest_wavelets[dest_length + i, j] = lh
-                    dest_wavelets[dest_length + i, dest_length + j] = hh
-
-            # copy to main wavelets
-            self.wavelet[:dest_wavelets.shape[1], :dest_wavelets.shape[1]] = dest_wavelets
+        return range(lowest_order_level, self.num_levels)
+
+    def _forward_plane(self, plane: ndarray):
+        for level in self._forward_levels():
+            length = 2 ** level
+            region = plane[:2 * length, :2 * length]
+            self._forward_rows(region, region, level, 0, length)
+
+    def _inverse_plane(self, plane: ndarray):
+        for level in self._inverse_levels():
+            length = 2 ** level
+            region = plane[:2 * length, :2 * length]
+            self._inverse_rows(region, region, level, 0, length)
+
+    def _transform_in_bands(self, transform_rows, array: ndarray, levels):
+        """
+        Transforms each level of a scratch backed array into a scratch level, a band of rows at a time, and
+        copies it back. Every band is read and written sequentially, so the pages are streamed rather than held.
+        """
+        for level in levels:
+            length = 2 ** level
+            region = array[:2 * length, :2 * length]
+            dest = self._allocate(region.shape)
+            band_rows = self._band_rows(4 * length)
+            for start in range(0, length, band_rows):
+                transform_rows(region, dest, level, start, min(start + band_rows, length))
+            self._copy_rows(dest, region)
+            del dest
+
+    def _gen_wavelet(self):
+        if self.scratch_dir is None:
+            self._map_planes(self._forward_plane, self.wavelet)
+        else:
+            self._transform_in_bands(self._forward_rows, self.wavelet, self._forward_levels())
 
     def prepare_from_image(self, image: ndarray):
+        max_value = (1 << self.bit_depth) - 1
+        if image.size > 0 and np.max(np.abs(image)) > max_value:
+            raise ValueError("Image values exceed the {}-bit depth of the wavelet".format(self.bit_depth))
+
         self._initialize_from_shape(image.shape[0], image.shape[1], image.shape[2])
 
         # fill the empty area with zeros and copy source image to top left of wavelet
@@ -90,38 +308,71 @@ class Wavelet:
         return self
 
     def as_image(self):
-        ret_wavelet = self.wavelet.copy()
-        lowest_order_level = max(self.num_levels - self.wavelet_levels, 0)
-        for source_level in range(lowest_order_level, self.num_levels):
-            source_length = 2 ** source_level
-            dest_wavelets = np.zeros((2 * source_length, 2 * source_length, self.color_depth), dtype=np.int64)
-
-            for i in range(source_length):
-                for j in range(source_length):
-                    ll = ret_wavelet[i, j]
-                    hl = ret_wavelet[i, source_length + j]
-                    lh = ret_wavelet[source_length + i, j]
-                    hh = ret_wavelet[source_length + i, source_length + j]
-
-                    a, b, c, d = haar_decode(ll, hl, lh, hh)
-
-                    if self.precision_binary_digits > 0:
-                        scaling_factor_digits = (self.num_levels - source_level) * 2
-                        rescale_digits = scaling_factor_digits - self.precision_binary_digits
-                        if rescale_digits > 0:
-                            a = integers.rescale_ndarray(a, rescale_digits) # shift left
-                            b = integers.rescale_ndarray(b, rescale_digits) # shift left
-                            c = integers.rescale_ndarray(c, rescale_digits) # shift left
-                            d = integers.rescale_ndarray(d, rescale_digits) # shift left
+        return self.as_array().astype(np.uint8)
 
-                    dest_wavelets[2 * i, 2 * j] = a
-                    dest_wavelets[2 * i, 2 * j + 1] = b
-                    dest_wavelets[2 * i + 1, 2 * j] = c
-                    dest_wavelets[2 * i + 1, 2 * j + 1] = d
-
-            ret_wavelet[:dest_wavelets.shape[0], :dest_wavelets.shape[1]] = dest_wavelets
-
-        return ret_wavelet[:self.width, :self.height].astype(np.uint8)
+    def as_array(self):
+        ret_wavelet = self._copy_array(self.wavelet)
+        if self.scratch_dir is None:
+            self._map_planes(self._inverse_plane, ret_wavelet)
+        else:
+            self._transform_in_bands(self._inverse_rows, ret_wavelet, self._inverse_levels())
+        return ret_wavelet[:self.width, :self.height]
+
+    def copy(self):
+        ret = copy.copy(self)
+        ret.wavelet = self._copy_array(self.wavelet)
+        return ret
+
+    def zeros_like(self) -> ndarray:
+        """A zeroed array shaped like the coefficients, backed by a scratch file like them when a scratch directory is set."""
+        return self._allocate(self.wavelet.shape)
+
+    def detail_bands(self, level):
+        """
+        Returns views of the HL, LH and HH coefficients of a wavelet level.
+
+        Parameters:
+        level (int): The wavelet level, where level 0 holds the coarsest detail coefficients.
+
+        Returns:
+        tuple: The (HL, LH, HH) views into the wavelet array.
+        """
+        length = 2 ** level
+        hl = self.wavelet[:length, length:2 * length]
+        lh = self.wavelet[length:2 * length, :length]
+        hh = self.wavelet[length:2 * length, length:2 * length]
+        return hl, lh, hh
+
+    def subtree_maxima(self):
+        """
+        Builds a pyramid of the largest absolute coefficient, over all channels, in the quad-tree
+        below each detail coefficient, including the coefficient itself. The levels are backed by scratch
+        files like the coefficients, and built a band of rows at a time.
+
+        Returns:
+        list: For each level, an array of shape (3, 2 ** level, 2 ** level) holding the HL, LH and HH maxima.
+        """
+        maxima = [None] * self.num_levels
+        for level in reversed(range(self.num_levels)):
+            length = 2 ** level
+            level_maxima = self._allocate((len(FILTERS), length, length))
+            band_rows = self._band_rows(length)
+            for index, band in enumerate(self.detail_bands(level)):
+                for start in range(0, length, band_rows):
+                    stop = min(start + band_rows, length)
+                    block = np.max(np.abs(band[start:stop]), axis=2)
+                    if level + 1 < self.num_levels:
+                        children = maxima[level + 1][index, 2 * start:2 * stop].reshape(stop - start, 2, length, 2).max(axis=(1, 3))
+                        block = np.maximum(block, children)
+                    level_maxima[index, start:stop] = block
+            maxima[level] = level_maxima
+        return maxima
+
+    def _clamp_to_dtype(self, value: int) -> int:
+        # no stored coefficient can exceed the dtype, so larger values behave the same as its max
+        if np.issubdtype(self.wavelet.dtype, np.integer):
+            return min(value, int(np.iinfo(self.wavelet.dtype).max))
+        return value
 
     def apply_hard_threshold(self, threshold: float):
         if threshold == 0:
@@ -130,8 +381,6 @@ class Wavelet:
         lowest_order_level = max(self.num_levels - self.wavelet_levels, 0)
         this_threshold = None
         for this_level in range(lowest_order_level, self.num_levels):
-            this_length = 2 ** this_level
-
             # rescale the threshold in order to perform the calculation in the int domain
             scaling_factor_digits = (self.num_levels - this_level) * 2
             this_threshold = int(round(threshold * 2 ** scaling_factor_digits))
@@ -139,16 +388,10 @@ class Wavelet:
                 rescale_digits = scaling_factor_digits - self.precision_binary_digits
                 if rescale_digits > 0:
                     this_threshold = int(round(threshold * 2 ** rescale_digits))
+            this_threshold = self._clamp_to_dtype(this_threshold)
 
-            for i in range(this_length):
-                for j in range(this_length):
-                    hl = self.wavelet[i, this_length + j]
-                    lh = self.wavelet[this_length + i, j]
-                    hh = self.wavelet[this_length + i, this_length + j]
-
-                    hl[np.abs(hl) < this_threshold] = 0
-                    lh[np.abs(lh) < this_threshold] = 0
-                    hh[np.abs(hh) < this_threshold] = 0
+            for band in self.detail_bands(this_level):
+                band[np.abs(band) < this_threshold] = 0
 
     def apply_soft_threshold(self, threshold: float):
         if threshold == -1:
@@ -157,8 +400,6 @@ class Wavelet:
         lowest_order_level = max(self.num_levels - self.wavelet_levels, 0)
         this_threshold = None
         for this_level in range(lowest_order_level, self.num_levels):
-            this_length = 2 ** this_level
-
             # rescale the threshold in order to perform the calculation in the int domain
             scaling_factor_digits = (self.num_levels - this_level) * 2
             this_threshold = int(round(threshold * 2 ** scaling_factor_digits))
@@ -166,13 +407,67 @@ class Wavelet:
                 rescale_digits = scaling_factor_digits - self.precision_binary_digits
                 if rescale_digits > 0:
                     this_threshold = int(round(threshold * 2 ** rescale_digits))
+            this_threshold = self._clamp_to_dtype(this_threshold)
+
+            for band in self.detail_bands(this_level):
+                band[:] = np.sign(band) * np.maximum(np.abs(band) - this_threshold, 0)
 
-            for i in range(this_length):
-                for j in range(this_length):
-                    hl = self.wavelet[i, this_length + j]
-                    lh = self.wavelet[this_length + i, j]
-                    hh = self.wavelet[this_length + i, this_length + j]
+    def quantization_steps(self, step: float, subband_weights=(1, 1, 1)) -> list:
+        """
+        Builds the table of dead-zone quantizer steps for a base step in pixel units.
 
-                    hl[:] = np.sign(hl) * np.maximum(np.abs(hl) - this_threshold, 0)
-                    lh[:] = np.sign(lh) * np.maximum(np.abs(lh) - this_threshold, 0)
-                    hh[:] = np.sign(hh) * np.maximum(np.abs(hh) - this_threshold, 0)
+        Each coarser level doubles the scale of the integer Haar coefficients relative to their
+        contribution to the squared error, so the step grows by a factor of 2 per level of depth to keep
+        that contribution the same across levels. Levels left untransformed hold pixels and get a step of 1.
+
+        Parameters:
+        step (float): The base quantizer step. Steps of 1 or less disable quantization.
+        subband_weights (tuple): Multipliers for the HL, LH and HH steps.
+
+        Returns:
+        list: For each level, a tuple of the integer HL, LH and HH steps.
+        """
+        if step <= 1:
+            return []
+
+        lowest_order_level = max(self.num_levels - self.wavelet_levels, 0)
+        steps = [(1, 1, 1)] * lowest_order_level
+        for this_level in range(lowest_order_level, self.num_levels):
+            depth = self.num_levels - this_level
+            level_step = step * 2 ** depth
+            if self.precision_binary_digits > 0:
+                rescale_digits = 2 * depth - self.precision_binary_digits
+                if rescale_digits > 0:
+                    level_step /= 2 ** rescale_digits
+            steps.append(tuple(self._clamp_to_dtype(max(1, int(round(level_step * weight)))) for weight in subband_weights))
+
+        return steps
+
+    def quantize(self, steps: list):
+        """
+        Replaces each detail coefficient with its dead-zone quantizer index, sign(x) * floor(|x| / step).
+        Coefficients smaller than the step become zero, so the dead zone is twice as wide as the other bins.
+
+        Parameters:
+        steps (list): The table built by quantization_steps, which may be empty.
+        """
+        for level, level_steps in enumerate(steps):
+            for band, step in zip(self.detail_bands(level), level_steps):
+                if step > 1:
+                    band[:] = np.sign(band) * (np.abs(band) // step)
+
+    def dequantize(self, steps: list):
+        """
+        Replaces each quantizer index with the middle of its bin, sign(q) * (|q| + 1/2) * step.
+
+        Parameters:
+        steps (list): The table the coefficients were quantized with, which may be empty.
+        """
+        limit = int(np.iinfo(self.wavelet.dtype).max) if np.issubdtype(self.wavelet.dtype, np.integer) else None
+        for level, level_steps in enumerate(steps):
+            for band, step in zip(self.detail_bands(level), level_steps):
+                if step > 1:
+                    magnitude = np.where(band != 0, ((2 * np.abs(band).astype(np.int64) + 1) * step) >> 1, 0)
+                    if limit is not None:
+                        magnitude = np.minimum(magnitude, limit)
+                    band[:] = np.sign(band) * magnitude
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 import os
 import argparse
-from bitstring import BitStream
+import hashlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from skimage.io import imread
-from skimage.metrics import peak_signal_noise_ratio
 import random
 import csv
-from qowi.qowi_decoder import QOWIDecoder
-from qowi.qowi_encoder import QOWIEncoder
+from qowi.color_transform import COLOR_TRANSFORM_NONE
+from qowi.qowi_encoder import QOWIEncoder, MAX_WAVELET_LEVELS, MIN_WAVELET_LEVELS
+from qowi.wavelet import Wavelet
 
 # Define parameter ranges
 hard_threshold_range = (0.0001, 1)
@@ -15,93 +18,183 @@ soft_threshold_range = (0.0001, 1)
 wavelet_levels_range = (1, 20)
 wavelet_precision_range = (0, 24)
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description="Optimize QOWI codec parameters.")
-parser.add_argument("input_dir", type=str, help="Path to the directory containing training images.")
-parser.add_argument("output_csv", type=str, help="Path to the output CSV file.")
-parser.add_argument("-t", "--hard-threshold", type=float, default=None, help="Set a fixed hard threshold.")
-parser.add_argument("-s", "--soft-threshold", type=float, default=None, help="Set a fixed soft threshold.")
-parser.add_argument("-w", "--wavelet-levels", type=int, default=None, help="Set a fixed number of wavelet levels.")
-parser.add_argument("-p", "--wavelet-precision", type=int, default=None, help="Set a fixed wavelet precision.")
-parser.add_argument("-n", "--num-samples", type=int, default=100, help="Number of samples to process.")
-args = parser.parse_args()
+IMAGE_FILE_EXTENSION = ".JPEG"
+DEFAULT_SEED = 0
+IMAGE_CACHE_SIZE = 16
+WAVELET_CACHE_SIZE = 64
 
-# Training images directory
-training_images_dir = args.input_dir
+CSV_COLUMNS = ["Sample", "Image", "Hard Threshold", "Soft Threshold", "Wavelet Levels", "Wavelet Precision", "PSNR", "Compressed File Size", "Compression Percentage"]
+
+
+class LRUCache:
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = OrderedDict()
+
+    def get(self, key, compute):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        value = compute()
+        self._entries[key] = value
+        if len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+        return value
+
+
+# per worker process caches of decoded images and their unthresholded wavelets
+_image_cache = LRUCache(IMAGE_CACHE_SIZE)
+_wavelet_cache = LRUCache(WAVELET_CACHE_SIZE)
 
-# Output results file
-output_file = args.output_csv
 
 # Function to generate settings (randomized or from arguments)
-def generate_settings():
-    hard_threshold = args.hard_threshold if args.hard_threshold is not None else round(random.uniform(*hard_threshold_range), 4)
-    soft_threshold = args.soft_threshold if args.soft_threshold is not None else (round(random.uniform(*soft_threshold_range), 4) if hard_threshold is None else -1)
-    wavelet_levels = args.wavelet_levels if args.wavelet_levels is not None else random.randint(*wavelet_levels_range)
-    wavelet_precision = args.wavelet_precision if args.wavelet_precision is not None else random.randint(*wavelet_precision_range)
+def generate_settings(args, rng):
+    hard_threshold = args.hard_threshold if args.hard_threshold is not None else round(rng.uniform(*hard_threshold_range), 4)
+    soft_threshold = args.soft_threshold if args.soft_threshold is not None else (round(rng.uniform(*soft_threshold_range), 4) if hard_threshold is None else -1)
+    wavelet_levels = args.wavelet_levels if args.wavelet_levels is not None else rng.randint(*wavelet_levels_range)
+    wavelet_precision = args.wavelet_precision if args.wavelet_precision is not None else rng.randint(*wavelet_precision_range)
     return hard_threshold, soft_threshold, wavelet_levels, wavelet_precision
 
-# Function to randomly pick an image file from the filesystem
-def get_random_image(directory):
-    valid_files = []
-    for root, _, files in os.walk(directory):
-        valid_files.extend([os.path.join(root, file) for file in files if file.endswith(".JPEG")])
+
+def build_file_index(directory, index_file, rebuild=False):
+    """Walks the image directory once and caches the sorted file list so later runs can skip the walk."""
+    if index_file is not None and os.path.exists(index_file) and not rebuild:
+        with open(index_file) as f:
+            valid_files = [line.rstrip("\n") for line in f if line.strip()]
+    else:
+        valid_files = []
+        for root, _, files in os.walk(directory):
+            valid_files.extend([os.path.join(root, file) for file in files if file.endswith(IMAGE_FILE_EXTENSION)])
+        valid_files.sort()
+
+        if index_file is not None:
+            with open(index_file, "w") as f:
+                f.writelines(file + "\n" for file in valid_files)
 
     if not valid_files:
         raise FileNotFoundError("No valid image files found in the specified directory.")
 
-    random_file = random.choice(valid_files)
-    print("Processing file {}".format(random_file))
-    return imread(random_file)
+    return valid_files
 
 
-def process_image(source_image, wavelet_levels, wavelet_precision, soft_threshold, hard_threshold):
-    original_image_size = source_image.shape[0] * source_image.shape[1] * source_image.shape[2] * 8
-    print("Original image shape {} and size (bits): {}".format(source_image.shape, original_image_size))
+def generate_samples(args, valid_files):
+    """Generates every sample up front from the seed, so a resumed sweep sees the same samples."""
+    rng = random.Random(args.seed)
+    samples = []
+    for sample in range(args.num_samples):
+        hard_threshold, soft_threshold, wavelet_levels, wavelet_precision = generate_settings(args, rng)
+        image_file = rng.choice(valid_files)
+        samples.append((sample, image_file, hard_threshold, soft_threshold, wavelet_levels, wavelet_precision))
+    return samples
 
-    print("Encoding with wavelet levels {}, wavelet precision {}, soft threshold {} and hard threshold {}...".format(
-        wavelet_levels, wavelet_precision, soft_threshold, hard_threshold))
 
-    encoded_bitstream = BitStream()
-    e = QOWIEncoder(hard_threshold, soft_threshold, wavelet_levels, wavelet_precision)
-    e.from_array(source_image)
-    e.to_bitstream(encoded_bitstream)
-    e.encode()
-    print("Finished encoding in {:.2f} seconds".format(e.encode_duration))
+def completed_samples(output_file):
+    """Reads the sample numbers already written to a partial CSV."""
+    if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+        return set()
 
-    encoded_size = len(encoded_bitstream)
-    compression_percentage = round(encoded_size / original_image_size * 100, 2)
-    print("Encoded (bits): {} ({}%)".format(encoded_size, compression_percentage))
+    with open(output_file, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header != CSV_COLUMNS:
+            raise ValueError("{} was not written by this version of the sweep and cannot be resumed".format(output_file))
+        return {int(row[0]) for row in reader if len(row) == len(CSV_COLUMNS)}
 
-    print()
-    print("Decoding...")
-    d = QOWIDecoder()
-    d.from_bitstream(encoded_bitstream)
-    d.decode()
-    decoded_image = d.as_array()
-    print("Finished decoding in {:.2f} seconds".format(d.decode_duration))
 
-    print("Computing signal to noise ratio (SNR)...")
-    psnr = peak_signal_noise_ratio(source_image, decoded_image)
-    print("PSNR: {}".format(psnr))
+def load_image(image_file):
+    def compute():
+        image = imread(image_file)
+        return hashlib.sha1(image.tobytes()).hexdigest(), image
+    return _image_cache.get(image_file, compute)
 
-    return encoded_size, psnr, compression_percentage
 
-# Open output file and write results incrementally
-with open(output_file, mode='w', newline='', ) as file:
-    writer = csv.writer(file)
-    writer.writerow(["Hard Threshold", "Soft Threshold", "Wavelet Levels", "Wavelet Precision", "PSNR", "Compressed File Size", "Compression Percentage"])
-    file.flush()
+def load_wavelet(image_hash, source_image, wavelet_levels, wavelet_precision):
+    def compute():
+        return Wavelet(wavelet_levels=wavelet_levels, precision_digits=wavelet_precision).prepare_from_image(source_image)
+    return _wavelet_cache.get((image_hash, wavelet_levels, wavelet_precision), compute)
 
-    for _ in range(args.num_samples):
-        hard_threshold, soft_threshold, wavelet_levels, wavelet_precision = generate_settings()
 
-        source_image = get_random_image(training_images_dir)  # Randomly pick an image from the filesystem
-        if len(source_image.shape) < 3:
-            continue
+def process_image(source_image, wavelet, wavelet_levels, wavelet_precision, soft_threshold, hard_threshold):
+    original_image_size = source_image.shape[0] * source_image.shape[1] * source_image.shape[2] * 8
+
+    # the size and PSNR are calculated exactly without producing or decoding a bitstream
+    e = QOWIEncoder(hard_threshold, soft_threshold, wavelet_levels, wavelet_precision, COLOR_TRANSFORM_NONE)
+    e.from_array(source_image, wavelet)
+    encoded_size = e.estimate_size()
+    compression_percentage = round(encoded_size / original_image_size * 100, 2)
+    psnr = e.estimate_psnr()
+
+    return encoded_size, psnr, compression_percentage
 
-        encoded_size, psnr, compression_percentage = process_image(source_image, wavelet_levels, wavelet_precision, soft_threshold, hard_threshold)
 
-        writer.writerow([hard_threshold, soft_threshold, wavelet_levels, wavelet_precision, psnr, encoded_size, compression_percentage])
-        file.flush()
+def process_samples(samples):
+    """Processes a group of samples for the same image in a worker process."""
+    results = []
+    for sample, image_file, hard_threshold, soft_threshold, wavelet_levels, wavelet_precision in samples:
+        image_hash, source_image = load_image(image_file)
+        if len(source_image.shape) < 3:
+            continue
 
-print(f"Sampling complete. Results saved to {output_file}")
+        # the encoder clamps the levels, so clamp before keying the cache
+        wavelet_levels = max(MIN_WAVELET_LEVELS, min(wavelet_levels, MAX_WAVELET_LEVELS))
+        wavelet = load_wavelet(image_hash, source_image, wavelet_levels, wavelet_precision)
+
+        start_time = time.time()
+        encoded_size, psnr, compression_percentage = process_image(source_image, wavelet, wavelet_levels, wavelet_precision, soft_threshold, hard_threshold)
+        duration = time.time() - start_time
+
+        results.append(([sample, image_file, hard_threshold, soft_threshold, wavelet_levels, wavelet_precision, psnr, encoded_size, compression_percentage], duration))
+    return results
+
+
+def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Optimize QOWI codec parameters.")
+    parser.add_argument("input_dir", type=str, help="Path to the directory containing training images.")
+    parser.add_argument("output_csv", type=str, help="Path to the output CSV file. An existing partial file is resumed.")
+    parser.add_argument("-t", "--hard-threshold", type=float, default=None, help="Set a fixed hard threshold.")
+    parser.add_argument("-s", "--soft-threshold", type=float, default=None, help="Set a fixed soft threshold.")
+    parser.add_argument("-w", "--wavelet-levels", type=int, default=None, help="Set a fixed number of wavelet levels.")
+    parser.add_argument("-p", "--wavelet-precision", type=int, default=None, help="Set a fixed wavelet precision.")
+    parser.add_argument("-n", "--num-samples", type=int, default=100, help="Number of samples to process.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker processes. Defaults to the number of cores.")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed for the samples. Use the same seed to resume. Defaults to {}".format(DEFAULT_SEED))
+    parser.add_argument("--index-file", type=str, default=None, help="Path of the cached image file index. Defaults to the output CSV path with .index appended.")
+    parser.add_argument("--rebuild-index", action="store_true", help="Walk the image directory again even if the index file exists.")
+    args = parser.parse_args()
+
+    output_file = args.output_csv
+    index_file = args.index_file if args.index_file is not None else output_file + ".index"
+
+    valid_files = build_file_index(args.input_dir, index_file, args.rebuild_index)
+    done = completed_samples(output_file)
+    pending = [sample for sample in generate_samples(args, valid_files) if sample[0] not in done]
+    print("Found {} images, {} samples already complete and {} to process".format(len(valid_files), len(done), len(pending)))
+
+    # group samples by image so each worker reuses its cached image and wavelets
+    groups = OrderedDict()
+    for sample in pending:
+        groups.setdefault(sample[1], []).append(sample)
+
+    # Open output file and write results incrementally
+    with open(output_file, mode='a', newline='', ) as file:
+        writer = csv.writer(file)
+        if len(done) == 0 and file.tell() == 0:
+            writer.writerow(CSV_COLUMNS)
+            file.flush()
+
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(process_samples, group) for group in groups.values()]
+            for future in as_completed(futures):
+                for row, duration in future.result():
+                    print("Sample {} ({}): levels {}, precision {}, soft threshold {}, hard threshold {} -> {} bits ({}%), PSNR {} in {:.2f} seconds".format(
+                        row[0], row[1], row[4], row[5], row[3], row[2], row[7], row[8], row[6], duration))
+                    writer.writerow(row)
+                file.flush()
+
+    print(f"Sampling complete. Results saved to {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,56 @@ import numpy as np
 import os
 import tempfile
 import argparse
-from itertools import islice, product
-import heapq
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
 import struct
 import unittest
 from tqdm import tqdm
+from qowi import integers
+from qowi.haar_sort import HaarSortRank
+from qowi.wavelet import haar_encode
+
+STRUCT_FORMAT_DTYPES = {
+    "B": np.uint8,
+    "H": np.uint16,
+    "I": np.uint32,
+}
+
+MERGE_MEMORY_LIMIT = 1 << 30
+MERGE_OUTPUT_BUFFER_SIZE = 16 << 20
+MIN_MERGE_BLOCK_ENTRIES = 1 << 12
+REVERSE_BLOCK_ENTRIES = 1 << 22
+
+
+class SortedChunkReader:
+    """Reads a sorted chunk file in blocks, keeping the Haar sort keys of the buffered entries."""
+    def __init__(self, table, file, block_entries):
+        self._table = table
+        self._file = open(file, "rb")
+        self._block_entries = block_entries
+        self.indices = np.empty(0, dtype=table._get_dtype())
+        self.keys = np.empty(0, dtype=np.int64)
+
+    def fill(self):
+        """Reads the next block once the buffer is empty. Returns False when the chunk is exhausted."""
+        if len(self.indices) == 0 and not self._file.closed:
+            self.indices = np.fromfile(self._file, dtype=self._table._get_dtype(), count=self._block_entries)
+            if len(self.indices) == 0:
+                self.close()
+                return False
+            self.keys = self._table._haar_sort_key(self._table._indices_to_grids(self.indices))
+        return len(self.indices) > 0
+
+    def take_through(self, bound):
+        """Removes and returns the buffered indices and keys with keys up to and including bound."""
+        n = np.searchsorted(self.keys, bound, side="right")
+        indices, keys = self.indices[:n], self.keys[:n]
+        self.indices, self.keys = self.indices[n:], self.keys[n:]
+        return indices, keys
+
+    def close(self):
+        self._file.close()
+
 
 class HaarSortTable:
     def __init__(self, bit_depth=None, temp_dir=None):
@@ -43,79 +88,194 @@ class HaarSortTable:
             index >>= (bit_depth // 4)
         return tuple(reversed(grid))
 
+    def _get_dtype(self):
+        """The NumPy dtype matching the struct format of table entries."""
+        return STRUCT_FORMAT_DTYPES[self._get_struct_format()]
+
+    def _grids_for_range(self, start, stop):
+        """Vectorized enumeration of the grids numbered start..stop-1 in itertools.product order."""
+        num_values = 1 << self.bit_depth
+        positions = np.arange(start, stop, dtype=np.int64)
+        a, remainder = np.divmod(positions, num_values ** 3)
+        b, remainder = np.divmod(remainder, num_values ** 2)
+        c, d = np.divmod(remainder, num_values)
+        return np.stack([a, b, c, d])
+
+    def _grids_to_indices(self, grids):
+        """Vectorized version of _grid_to_index for a (4, N) array of grids."""
+        value_bits = struct.calcsize(self._get_struct_format()) * 8 // 4
+        a, b, c, d = grids.astype(np.int64)
+        return (((a << value_bits | b) << value_bits | c) << value_bits) | d
+
+    def _indices_to_grids(self, indices):
+        """Vectorized version of _index_to_grid, returning a (4, N) array of grids."""
+        value_bits = struct.calcsize(self._get_struct_format()) * 8 // 4
+        mask = (1 << value_bits) - 1
+        indices = np.asarray(indices, dtype=np.int64)
+        return np.stack([(indices >> (value_bits * shift)) & mask for shift in (3, 2, 1, 0)])
+
     def _calculate_haar_coefficients(self, grid):
-        a, b, c, d = grid.astype(np.int32)
-        LL = a + b + c + d
-        HL = a - b + c - d
-        LH = a + b - c - d
-        HH = a - b - c + d
-        return LL, HL, LH, HH
+        a, b, c, d = np.asarray(grid).astype(np.int64)
+        return haar_encode(a, b, c, d)
 
     def _haar_sort_key(self, grid):
-        """Generate a Haar Sort key for the given grid."""
-        coefficients = self._calculate_haar_coefficients(np.array(grid))
-        LL, HL, LH, HH = coefficients
-        return (LL << 24) | ((HL & 0xFF) << 16) | ((LH & 0xFF) << 8) | (HH & 0xFF)
+        """
+        Generate a Haar Sort key for the given grid, or a (4, N) array of grids. Grids are ordered
+        by LL, then by the zigzag values of HL, LH and HH, so smooth grids come first for each LL.
+        """
+        LL, HL, LH, HH = self._calculate_haar_coefficients(grid)
+        max_value = (1 << self.bit_depth) - 1
+        radix = 4 * max_value + 2  # detail coefficients lie in [-2 * max_value, 2 * max_value]
+        key = LL
+        for coefficient in (HL, LH, HH):
+            key = key * radix + integers.integer_to_zigzag_ndarray(coefficient)
+        return key
+
+    def _sort_chunk(self, start, stop, temp_file):
+        """Sorts the grids numbered start..stop-1 by Haar sort key and saves their packed indices."""
+        grids = self._grids_for_range(start, stop)
+        order = np.argsort(self._haar_sort_key(grids))
+        self._grids_to_indices(grids[:, order]).astype(self._get_dtype()).tofile(temp_file)
+        return temp_file
 
-    def sort_and_save_chunks(self, chunk_size=10**6):
+    def sort_and_save_chunks(self, chunk_size=10**6, max_workers=None):
         if self.bit_depth is None:
             raise ValueError("Bit depth must be set for generating the table.")
 
         max_value = (1 << self.bit_depth) - 1
         total_grids = (max_value + 1) ** 4
-        all_grids = product(range(max_value + 1), repeat=4)
         temp_files = []
-        struct_format = self._get_struct_format()
 
         with tqdm(total=total_grids, desc="Sorting and Saving Chunks") as pbar:
-            while True:
-                chunk = list(islice(all_grids, chunk_size))
-                if not chunk:
-                    break
-                chunk = sorted(chunk, key=lambda grid: self._haar_sort_key(grid))
-                temp_file = os.path.join(self.temp_dir, f"sorted_chunk_{len(temp_files)}.bin")
-                with open(temp_file, "wb") as f:
-                    for grid in chunk:
-                        index = self._grid_to_index(grid)
-                        f.write(struct.pack(struct_format, index))
-                temp_files.append(temp_file)
-                pbar.update(len(chunk))
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {}
+                for start in range(0, total_grids, chunk_size):
+                    stop = min(start + chunk_size, total_grids)
+                    temp_file = os.path.join(self.temp_dir, f"sorted_chunk_{len(temp_files)}.bin")
+                    temp_files.append(temp_file)
+                    futures[executor.submit(self._sort_chunk, start, stop, temp_file)] = stop - start
+
+                for future in as_completed(futures):
+                    future.result()
+                    pbar.update(futures[future])
 
         return temp_files
 
-    def merge_sorted_chunks(self, temp_files, table_file):
-        struct_format = self._get_struct_format()
-        total_grids = sum(os.path.getsize(file) // struct.calcsize(struct_format) for file in temp_files)
+    def merge_sorted_chunks(self, temp_files, table_file, memory_limit=MERGE_MEMORY_LIMIT, buffer_size=MERGE_OUTPUT_BUFFER_SIZE, block_entries=None, reverse_table_file=None):
+        """
+        Merges the sorted chunk files into the main table. Each chunk is read in large blocks, and every
+        round emits all buffered entries whose keys are no greater than the smallest last key of any
+        block, so the comparisons happen a block at a time in NumPy rather than per entry.
+
+        If reverse_table_file is given, the reverse table is built in the same pass by scattering the
+        Haar sort index of every written entry into a memory mapped reverse table. The scatter is random
+        access, so only do this when the reverse table fits in memory.
+        """
+        dtype = self._get_dtype()
+        entry_size = np.dtype(dtype).itemsize
+        total_grids = sum(os.path.getsize(file) // entry_size for file in temp_files)
+
+        # every buffered entry costs its packed index plus its int64 key
+        if block_entries is None:
+            block_entries = max(MIN_MERGE_BLOCK_ENTRIES, memory_limit // (max(len(temp_files), 1) * (entry_size + 8)))
+        readers = [SortedChunkReader(self, file, block_entries) for file in temp_files]
+        active = [reader for reader in readers if reader.fill()]
 
-        def stream_file(file):
-            with open(file, "rb") as f:
-                while True:
-                    data = f.read(struct.calcsize(struct_format))
-                    if not data:
-                        break
-                    yield struct.unpack(struct_format, data)[0]
+        reverse = None
+        if reverse_table_file is not None:
+            reverse = np.memmap(reverse_table_file, dtype=dtype, mode="w+", shape=(total_grids,))
 
+        def write(block, offset):
+            block.tofile(f_out)
+            if reverse is not None:
+                reverse[block] = np.arange(offset, offset + len(block), dtype=dtype)
+            return offset + len(block)
+
+        written = 0
+        pending = []
+        pending_size = 0
         with open(table_file, "wb") as f_out:
             with tqdm(total=total_grids, desc="Merging and Writing Main Table") as pbar:
-                for index in heapq.merge(*(stream_file(f) for f in temp_files)):
-                    f_out.write(struct.pack(struct_format, index))
-                    pbar.update(1)
+                while active:
+                    bound = min(reader.keys[-1] for reader in active)
+
+                    merged_indices = []
+                    merged_keys = []
+                    for reader in active:
+                        indices, keys = reader.take_through(bound)
+                        merged_indices.append(indices)
+                        merged_keys.append(keys)
+
+                    # each taken slice is already sorted, which the stable sort exploits
+                    order = np.argsort(np.concatenate(merged_keys), kind="stable")
+                    block = np.concatenate(merged_indices)[order]
+                    pending.append(block)
+                    pending_size += block.nbytes
+                    pbar.update(len(block))
+
+                    if pending_size >= buffer_size:
+                        written = write(np.concatenate(pending), written)
+                        pending = []
+                        pending_size = 0
+
+                    active = [reader for reader in active if reader.fill()]
+
+                if pending:
+                    write(np.concatenate(pending), written)
+
+        if reverse is not None:
+            reverse.flush()
+            del reverse
+
+        for reader in readers:
+            reader.close()
 
         for file in temp_files:
             os.remove(file)
 
-    def generate_reverse_lookup_table(self, table_file, reverse_table_file):
-        struct_format = self._get_struct_format()
-        entry_size = struct.calcsize(struct_format)
+    def generate_reverse_lookup_table(self, table_file, reverse_table_file, memory_limit=MERGE_MEMORY_LIMIT, block_entries=REVERSE_BLOCK_ENTRIES):
+        """
+        Inverts the forward table, so that reverse[forward[k]] = k. The reverse table is built in ranges
+        that fit in memory_limit. Each range streams the forward table in blocks, scatters the entries
+        that land in the range into an in-memory buffer and then writes the buffer out sequentially, so
+        a reverse table that fits in memory is built in a single pass over the forward table.
+        """
+        dtype = self._get_dtype()
+        forward = np.memmap(table_file, dtype=dtype, mode="r")
+        total_grids = len(forward)
+        range_entries = max(1, memory_limit // np.dtype(dtype).itemsize)
+
+        with open(reverse_table_file, "wb") as f_reverse:
+            with tqdm(total=total_grids, desc="Inverting Main Table") as pbar:
+                for range_start in range(0, total_grids, range_entries):
+                    range_stop = min(range_start + range_entries, total_grids)
+                    buffer = np.zeros(range_stop - range_start, dtype=dtype)
 
-        with open(table_file, "rb") as f_table, open(reverse_table_file, "wb") as f_reverse:
-            index = 0
-            while True:
-                data = f_table.read(entry_size)
-                if not data:
-                    break
-                f_reverse.write(struct.pack(struct_format, index))
-                index += 1
+                    for block_start in range(0, total_grids, block_entries):
+                        block = forward[block_start:block_start + block_entries].astype(np.int64)
+                        positions = np.arange(block_start, block_start + len(block), dtype=np.int64)
+                        if range_stop - range_start < total_grids:
+                            in_range = (block >= range_start) & (block < range_stop)
+                            block, positions = block[in_range], positions[in_range]
+                        buffer[block - range_start] = positions
+
+                    buffer.tofile(f_reverse)
+                    pbar.update(len(buffer))
+
+        del forward
+
+    def validate_inverse_tables(self, forward_table, reverse_table_file, block_entries=REVERSE_BLOCK_ENTRIES):
+        """Checks block by block that reverse[forward[k]] = k for every Haar sort index k."""
+        dtype = self._get_dtype()
+        forward = np.memmap(forward_table, dtype=dtype, mode="r")
+        reverse = np.memmap(reverse_table_file, dtype=dtype, mode="r")
+
+        for block_start in range(0, len(forward), block_entries):
+            block = forward[block_start:block_start + block_entries]
+            expected = np.arange(block_start, block_start + len(block), dtype=np.int64)
+            if not np.array_equal(reverse[block].astype(np.int64), expected):
+                raise ValueError(f"Reverse table does not invert the forward table in entries {block_start} to {block_start + len(block) - 1}.")
+        print("Validation passed: The reverse table inverts the forward table.")
 
     def validate_table_sizes(self, forward_table, reverse_table_file):
         grid_size = os.path.getsize(forward_table)
@@ -160,9 +320,7 @@ class TestHaarSortTable(unittest.TestCase):
                 max_value = (1 << bit_depth) - 1
                 total_entries = (max_value + 1) ** 4
 
-                with open(forward_table.name, "wb") as f:
-                    for index in range(total_entries):
-                        f.write(struct.pack(table._get_struct_format(), index))
+                np.random.default_rng(bit_depth).permutation(total_entries).astype(table._get_dtype()).tofile(forward_table.name)
 
                 table.generate_reverse_lookup_table(forward_table.name, reverse_table.name)
 
@@ -172,10 +330,117 @@ class TestHaarSortTable(unittest.TestCase):
 
                 self.assertEqual(forward_size, expected_size, "Forward table size mismatch")
                 self.assertEqual(reverse_size, expected_size, "Reverse table size mismatch")
+                table.validate_inverse_tables(forward_table.name, reverse_table.name)
             finally:
                 os.unlink(forward_table.name)
                 os.unlink(reverse_table.name)
 
+    def test_vectorized_indices_match_scalar(self):
+        for bit_depth in [2, 4]:
+            table = HaarSortTable(bit_depth=bit_depth)
+            total_grids = (1 << bit_depth) ** 4
+            grids = table._grids_for_range(0, total_grids)
+            indices = table._grids_to_indices(grids)
+
+            expected = [table._grid_to_index(grid) for grid in product(range(1 << bit_depth), repeat=4)]
+            self.assertEqual(indices.tolist(), expected)
+            np.testing.assert_array_equal(table._indices_to_grids(indices), grids)
+
+    def test_haar_sort_keys_are_unique(self):
+        table = HaarSortTable(bit_depth=4)
+        keys = table._haar_sort_key(table._grids_for_range(0, 16 ** 4))
+        self.assertEqual(len(np.unique(keys)), len(keys))
+
+    def test_haar_sort_key_matches_scalar(self):
+        table = HaarSortTable(bit_depth=2)
+        grids = table._grids_for_range(0, 4 ** 4)
+        keys = table._haar_sort_key(grids)
+        for i, grid in enumerate(product(range(4), repeat=4)):
+            self.assertEqual(keys[i], table._haar_sort_key(grid))
+
+    def test_sorted_chunks(self):
+        bit_depth = 2
+        table = HaarSortTable(bit_depth=bit_depth, temp_dir=tempfile.mkdtemp())
+        temp_files = table.sort_and_save_chunks(chunk_size=100, max_workers=2)
+
+        self.assertEqual(len(temp_files), 3)
+        all_indices = []
+        for temp_file in temp_files:
+            indices = np.fromfile(temp_file, dtype=table._get_dtype())
+            keys = table._haar_sort_key(table._indices_to_grids(indices))
+            self.assertTrue(np.all(np.diff(keys) > 0))
+            all_indices.extend(indices.tolist())
+            os.remove(temp_file)
+
+        self.assertEqual(sorted(all_indices), list(range(4 ** 4)))
+
+    def test_merge_sorted_chunks(self):
+        bit_depth = 2
+        temp_dir = tempfile.mkdtemp()
+        table = HaarSortTable(bit_depth=bit_depth, temp_dir=temp_dir)
+        temp_files = table.sort_and_save_chunks(chunk_size=37, max_workers=2)
+        table_file = os.path.join(temp_dir, "table.bin")
+
+        # tiny blocks and buffers force many refills, rounds and writes
+        table.merge_sorted_chunks(temp_files, table_file, buffer_size=64, block_entries=5)
+
+        indices = np.fromfile(table_file, dtype=table._get_dtype())
+        expected = table._grids_to_indices(table._grids_for_range(0, 4 ** 4))
+        expected = expected[np.argsort(table._haar_sort_key(table._indices_to_grids(expected)))]
+        np.testing.assert_array_equal(indices, expected)
+        for temp_file in temp_files:
+            self.assertFalse(os.path.exists(temp_file))
+        os.remove(table_file)
+
+    def test_reverse_lookup_table_in_ranges(self):
+        table = HaarSortTable(bit_depth=4)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            forward_table = os.path.join(temp_dir, "forward.bin")
+            reverse_table = os.path.join(temp_dir, "reverse.bin")
+            forward = np.random.default_rng(0).permutation(16 ** 4).astype(table._get_dtype())
+            forward.tofile(forward_table)
+
+            # a small memory limit splits the reverse table into several ranges
+            table.generate_reverse_lookup_table(forward_table, reverse_table, memory_limit=10000, block_entries=4096)
+
+            reverse = np.fromfile(reverse_table, dtype=table._get_dtype())
+            np.testing.assert_array_equal(reverse[forward], np.arange(16 ** 4))
+
+    def test_merge_builds_reverse_table(self):
+        temp_dir = tempfile.mkdtemp()
+        table = HaarSortTable(bit_depth=2, temp_dir=temp_dir)
+        temp_files = table.sort_and_save_chunks(chunk_size=50, max_workers=2)
+        forward_table = os.path.join(temp_dir, "forward.bin")
+        reverse_table = os.path.join(temp_dir, "reverse.bin")
+
+        table.merge_sorted_chunks(temp_files, forward_table, buffer_size=16, block_entries=8, reverse_table_file=reverse_table)
+
+        table.validate_inverse_tables(forward_table, reverse_table)
+        os.remove(forward_table)
+        os.remove(reverse_table)
+
+    def test_validate_inverse_tables_rejects_identity_reverse(self):
+        table = HaarSortTable(bit_depth=2)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            forward_table = os.path.join(temp_dir, "forward.bin")
+            reverse_table = os.path.join(temp_dir, "reverse.bin")
+            np.arange(256, dtype=np.uint8)[::-1].tofile(forward_table)
+            np.arange(256, dtype=np.uint8).tofile(reverse_table)
+
+            with self.assertRaises(ValueError):
+                table.validate_inverse_tables(forward_table, reverse_table)
+
+    def test_table_matches_closed_form_rank(self):
+        temp_dir = tempfile.mkdtemp()
+        table = HaarSortTable(bit_depth=4, temp_dir=temp_dir)
+        temp_files = table.sort_and_save_chunks(chunk_size=10000, max_workers=2)
+        table_file = os.path.join(temp_dir, "table.bin")
+        table.merge_sorted_chunks(temp_files, table_file)
+
+        grids = table._indices_to_grids(np.fromfile(table_file, dtype=table._get_dtype())).T
+        np.testing.assert_array_equal(HaarSortRank(4).unrank(np.arange(16 ** 4)), grids)
+        os.remove(table_file)
+
     def test_struct_format_sizes(self):
         bit_depth_to_format = {
             2: "B",  # 8 bits
@@ -192,6 +457,7 @@ if __name__ == "__main__":
     parser.add_argument("--generate", action="store_true", help="Generate and sort a Haar sort table.")
     parser.add_argument("--bit_depth", type=int, help="Set the bit depth for the grids (required for generation).")
     parser.add_argument("--chunk_size", type=int, default=5_000_000, help="Set the chunk size for sorting.")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes for sorting. Defaults to the number of cores.")
     parser.add_argument("-t", "--table", type=str, help="Table prefix for Haar sort files.")
     args = parser.parse_args()
 
@@ -200,10 +466,16 @@ if __name__ == "__main__":
             print("--bit_depth and --table are required for table generation.")
             exit(1)
         table = HaarSortTable(bit_depth=args.bit_depth)
-        temp_files = table.sort_and_save_chunks(chunk_size=args.chunk_size)
+        temp_files = table.sort_and_save_chunks(chunk_size=args.chunk_size, max_workers=args.jobs)
         forward_table = f"{args.table}_grids.bin"
         reverse_table = f"{args.table}_index.bin"
-        table.merge_sorted_chunks(temp_files, forward_table)
-        table.generate_reverse_lookup_table(forward_table, reverse_table)
+        total_grids = (1 << args.bit_depth) ** 4
+        if total_grids * np.dtype(table._get_dtype()).itemsize <= MERGE_MEMORY_LIMIT:
+            # the reverse table fits in memory, so scatter it while merging
+            table.merge_sorted_chunks(temp_files, forward_table, reverse_table_file=reverse_table)
+        else:
+            table.merge_sorted_chunks(temp_files, forward_table)
+            table.generate_reverse_lookup_table(forward_table, reverse_table)
         table.validate_table_sizes(forward_table, reverse_table)
+        table.validate_inverse_tables(forward_table, reverse_table)
         print(f"Haar sort table generated and saved to {forward_table}. Reverse lookup table saved to {reverse_table}.")
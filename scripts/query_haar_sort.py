@@ -1,12 +1,30 @@
-import struct
 import argparse
+import os
+import tempfile
+import unittest
+import numpy as np
+
+STRUCT_FORMAT_DTYPES = {
+    "B": np.uint8,
+    "H": np.uint16,
+    "I": np.uint32,
+}
 
 class HaarSortQuery:
+    """
+    Looks up Haar sort tables. The forward table ({table_name}_grids.bin) holds the packed grid for each
+    Haar sort index, and the reverse table ({table_name}_index.bin) holds the Haar sort index for each
+    packed grid. Both tables are memory mapped once, so batches of lookups are plain array indexing.
+    """
     def __init__(self, bit_depth, table_name=None):
         self.bit_depth = bit_depth
         self.forward_table_file = f"{table_name}_grids.bin" if table_name else None
         self.reverse_table_file = f"{table_name}_index.bin" if table_name else None
 
+        dtype = STRUCT_FORMAT_DTYPES[self._get_struct_format()]
+        self._forward_table = np.memmap(self.forward_table_file, dtype=dtype, mode="r") if self.forward_table_file else None
+        self._reverse_table = np.memmap(self.reverse_table_file, dtype=dtype, mode="r") if self.reverse_table_file else None
+
     def _get_struct_format(self):
         if self.bit_depth == 2:
             return "B"  # 8-bit unsigned integer for each 2-bit grid entry
@@ -17,53 +35,102 @@ class HaarSortQuery:
         else:
             raise ValueError("Unsupported bit depth. Only 2, 4, or 8 are allowed.")
 
-    def _calculate_binary_position(self, grid):
-        """Calculate the binary position of the grid in the file."""
-        shift_amount = self.bit_depth  # Number of bits per value
-        return sum((value << (shift_amount * i)) for i, value in enumerate(grid))
+    def _calculate_binary_positions(self, grids):
+        """Packs (..., 4) grids into their positions in the reverse table, first value in the high bits."""
+        grids = np.asarray(grids, dtype=np.int64)
+        if np.any((grids < 0) | (grids >> self.bit_depth != 0)):
+            raise ValueError(f"Grid values must fit in {self.bit_depth} bits.")
 
-    def grid_to_haar_sort_index(self, grid):
-        """Finds the Haar sort index for a given grid in O(1) time."""
-        if not self.forward_table_file:
-            raise ValueError("Forward table file is required for grid lookup.")
+        positions = np.zeros(grids.shape[:-1], dtype=np.int64)
+        for i in range(4):
+            positions = (positions << self.bit_depth) | grids[..., i]
+        return positions
 
-        struct_format = self._get_struct_format()
-        entry_size = struct.calcsize(struct_format)
+    def grids_to_indices(self, grids):
+        """
+        Finds the Haar sort indices for a batch of grids.
 
-        binary_position = self._calculate_binary_position(grid)
+        Parameters:
+        grids (np.ndarray): An array of shape (..., 4) holding the values of each grid.
 
-        with open(self.forward_table_file, "rb") as f:
-            f.seek(binary_position * entry_size)
-            data = f.read(entry_size)
-            if not data:
-                raise ValueError(f"Grid {grid} not found in the forward table.")
+        Returns:
+        np.ndarray: An int64 array of shape (...) holding the Haar sort index of each grid.
+        """
+        if self._reverse_table is None:
+            raise ValueError("Reverse table file is required for grid lookup.")
 
-        return struct.unpack(struct_format, data)[0]
+        return self._reverse_table[self._calculate_binary_positions(grids)].astype(np.int64)
 
-    def haar_sort_index_to_grid(self, index):
-        """Finds the grid corresponding to a Haar sort index in O(1) time."""
-        if not self.reverse_table_file:
-            raise ValueError("Reverse table file is required for index lookup.")
+    def indices_to_grids(self, indices):
+        """
+        Finds the grids for a batch of Haar sort indices.
 
-        struct_format = self._get_struct_format()
-        entry_size = struct.calcsize(struct_format)
+        Parameters:
+        indices (np.ndarray): An array of Haar sort indices.
 
-        with open(self.reverse_table_file, "rb") as f:
-            f.seek(index * entry_size)
-            data = f.read(entry_size)
-            if not data:
-                raise ValueError(f"Index {index} out of range.")
+        Returns:
+        np.ndarray: An int64 array of shape indices.shape + (4,) holding the values of each grid.
+        """
+        if self._forward_table is None:
+            raise ValueError("Forward table file is required for index lookup.")
 
-        packed_value = struct.unpack(struct_format, data)[0]
+        indices = np.asarray(indices, dtype=np.int64)
+        if np.any((indices < 0) | (indices >= len(self._forward_table))):
+            raise ValueError("Haar sort index out of range.")
 
-        # Unpack the value into a 4-element tuple
-        grid = []
+        packed_values = self._forward_table[indices].astype(np.int64)
         mask = (1 << self.bit_depth) - 1
-        for _ in range(4):
-            grid.append(packed_value & mask)
-            packed_value >>= self.bit_depth
+        return np.stack([(packed_values >> (self.bit_depth * shift)) & mask for shift in (3, 2, 1, 0)], axis=-1)
 
-        return tuple(reversed(grid))
+    def grid_to_haar_sort_index(self, grid):
+        """Finds the Haar sort index for a given grid in O(1) time."""
+        return int(self.grids_to_indices(grid))
+
+    def haar_sort_index_to_grid(self, index):
+        """Finds the grid corresponding to a Haar sort index in O(1) time."""
+        return tuple(self.indices_to_grids(index).tolist())
+
+class TestHaarSortQuery(unittest.TestCase):
+    def _write_tables(self, bit_depth, table_name):
+        dtype = STRUCT_FORMAT_DTYPES[HaarSortQuery(bit_depth)._get_struct_format()]
+        total_entries = 1 << (4 * bit_depth)
+        forward = np.random.default_rng(0).permutation(total_entries).astype(dtype)
+        reverse = np.empty_like(forward)
+        reverse[forward] = np.arange(total_entries, dtype=dtype)
+        forward.tofile(f"{table_name}_grids.bin")
+        reverse.tofile(f"{table_name}_index.bin")
+        return forward
+
+    def test_batch_round_trip(self):
+        for bit_depth in [2, 4]:
+            table_name = os.path.join(tempfile.mkdtemp(), "table")
+            forward = self._write_tables(bit_depth, table_name)
+            query = HaarSortQuery(bit_depth, table_name)
+
+            indices = np.arange(len(forward))
+            grids = query.indices_to_grids(indices)
+            self.assertEqual(grids.shape, (len(forward), 4))
+            np.testing.assert_array_equal(query.grids_to_indices(grids), indices)
+
+    def test_scalar_lookups(self):
+        table_name = os.path.join(tempfile.mkdtemp(), "table")
+        forward = self._write_tables(2, table_name)
+        query = HaarSortQuery(2, table_name)
+
+        grid = query.haar_sort_index_to_grid(5)
+        a, b, c, d = grid
+        self.assertEqual((a << 6) | (b << 4) | (c << 2) | d, forward[5])
+        self.assertEqual(query.grid_to_haar_sort_index(grid), 5)
+
+    def test_out_of_range(self):
+        table_name = os.path.join(tempfile.mkdtemp(), "table")
+        self._write_tables(2, table_name)
+        query = HaarSortQuery(2, table_name)
+
+        with self.assertRaises(ValueError):
+            query.indices_to_grids(np.array([256]))
+        with self.assertRaises(ValueError):
+            query.grids_to_indices(np.array([[0, 0, 0, 4]]))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Query Haar Sort Lookup Tables")
@@ -1,8 +1,7 @@
-import pandas as pd
 import utils.analysis as analysis
 from bitstring import BitStream
-from qowi import SpatialDecoder
-from qowi import SpatialEncoder
+from qowi.spatial_decoder import SpatialDecoder
+from qowi.spatial_encoder import SpatialEncoder
 from utils.visualization import display_images_side_by_side
 from skimage import io
 
@@ -22,7 +21,7 @@ print("Original image shape {} and size (bits): {}".format(source_image.shape, o
 
 print("Encoding ...")
 encoded_bitstream = BitStream()
-e = SpatialEncoder()
+e = SpatialEncoder(stats=PRINT_STATS)
 e.from_array(source_image)
 e.to_bitstream(encoded_bitstream)
 e.encode()
@@ -46,19 +45,17 @@ print("SNR: {}".format(analysis.signal_to_noise(source_image, decoded_image)))
 display_images_side_by_side(source_image, decoded_image)
 
 if PRINT_STATS:
-    df = pd.DataFrame(e.stats)
-
     print()
     print("Frequency of op_code usage")
-    print(analysis.op_code_frequency(df))
+    print(analysis.op_code_frequency(e.stats))
     print()
     print("Max values for op_codes")
-    print(analysis.op_code_max_values(df))
+    print(analysis.op_code_max_values(e.stats))
     print()
     # print("RGB Difference Value Frequencies")
-    # print(rgb_frequency_histogram(df))
+    # print(rgb_frequency_histogram(e.stats))
     # print()
     print("op_code num_bits frequencies")
-    print(analysis.op_code_num_bits_frequency_histgram(df))
+    print(analysis.op_code_num_bits_frequency_histgram(e.stats))
 
 print("Done")
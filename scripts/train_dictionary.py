@@ -0,0 +1,51 @@
+import argparse
+import os
+import numpy as np
+from skimage import io
+
+from qowi import color_transform, integers
+from qowi.color_transform import COLOR_TRANSFORMS
+from qowi.dictionary import DEFAULT_DICTIONARY_SIZE, DICTIONARY_DIR, dictionary_path, save_dictionary, train_dictionary
+from qowi.header import CODECS, CODEC_SPATIAL
+from qowi.spatial_encoder import NUM_PIXEL_VALUES
+from qowi.wavelet import Wavelet, traversal_order
+
+DEFAULT_WAVELET_LEVELS = 10
+
+
+def image_tokens(image: np.ndarray, codec: int, wavelet_levels: int, transform: int) -> np.ndarray:
+    """The tokens the integer coder is given for an image, in coding order, as an (n, channels) array."""
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+
+    if codec == CODEC_SPATIAL:
+        return integers.integer_to_shifted_ndarray(image.reshape(-1, image.shape[2]), NUM_PIXEL_VALUES)
+
+    if transform == color_transform.COLOR_TRANSFORM_YCOCG_R and image.shape[2] >= 3:
+        image = color_transform.rgb_to_ycocg_r(image)
+    wavelet = Wavelet(wavelet_levels=wavelet_levels).prepare_from_image(image)
+
+    # the root is coded separately, so only the detail coefficients reach the cache
+    rows, cols = traversal_order(wavelet.num_levels)
+    return wavelet.wavelet[rows, cols]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a QOWI cache dictionary from a corpus of images")
+    parser.add_argument("images", type=str, nargs="+", help="Paths to the training images")
+    parser.add_argument("--id", type=int, required=True, help="Dictionary ID the encoder is given and the header records")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Dictionary file. Defaults to {}".format(dictionary_path("ID", DICTIONARY_DIR)))
+    parser.add_argument("-n", "--size", type=int, default=DEFAULT_DICTIONARY_SIZE, help="Maximum number of entries. Defaults to {}".format(DEFAULT_DICTIONARY_SIZE))
+    parser.add_argument("-m", "--mode", type=str, choices=list(CODECS), default="wavelet", help="Codec whose tokens are counted. Defaults to wavelet")
+    parser.add_argument("-w", "--wavelet-levels", type=int, default=DEFAULT_WAVELET_LEVELS, help="Number of wavelet levels. Defaults to {}".format(DEFAULT_WAVELET_LEVELS))
+    parser.add_argument("-c", "--color-transform", type=str, choices=list(COLOR_TRANSFORMS), default="none", help="Color transform applied before the wavelet. Defaults to none")
+    args = parser.parse_args()
+
+    token_arrays = [image_tokens(io.imread(path), CODECS[args.mode], args.wavelet_levels, COLOR_TRANSFORMS[args.color_transform]) for path in args.images]
+    entries = train_dictionary(token_arrays, args.size)
+
+    output = args.output or dictionary_path(args.id)
+    if args.output is None:
+        os.makedirs(DICTIONARY_DIR, exist_ok=True)
+    save_dictionary(output, entries)
+    print("Wrote {} entries from {} images to {}".format(len(entries), len(token_arrays), output))
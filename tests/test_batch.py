@@ -0,0 +1,107 @@
+import numpy as np
+import os
+import tempfile
+import threading
+import unittest
+from skimage import io
+from qowi.batch import _run_batch, decode_batch, encode_batch, find_sources, read_bytes, write_bytes
+
+
+def _write_images(directory):
+    rng = np.random.default_rng(0)
+    images = {}
+    for name in ["a.png", os.path.join("nested", "b.png"), os.path.join("nested", "c.bmp")]:
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        images[name] = rng.integers(0, 256, size=(6, 5, 3)).astype(np.uint8)
+        io.imsave(path, images[name], check_contrast=False)
+    with open(os.path.join(directory, "notes.txt"), "w") as notes:
+        notes.write("not an image")
+    return images
+
+
+class Interrupted(BaseException):
+    pass
+
+
+def _interrupt(data):
+    raise Interrupted()
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_find_sources(self):
+        directory = tempfile.mkdtemp()
+        _write_images(directory)
+
+        sources = find_sources([directory], (".png",))
+        self.assertEqual([relative_path for _, relative_path in sources], ["a.png", os.path.join("nested", "b.png")])
+
+        sources = find_sources([os.path.join(directory, "nested", "*")], (".png",))
+        self.assertEqual([relative_path for _, relative_path in sources], ["b.png", "c.bmp"])
+
+    def test_round_trip(self):
+        for jobs, queue_depth in [(1, None), (2, None), (2, 1)]:
+            source_directory, encoded_directory, decoded_directory = tempfile.mkdtemp(), tempfile.mkdtemp(), tempfile.mkdtemp()
+            images = _write_images(source_directory)
+
+            result = encode_batch([source_directory], encoded_directory, {"wavelet_encode_levels": 10}, jobs=jobs, queue_depth=queue_depth)
+            self.assertEqual((result.num_coded, result.num_skipped, result.failures), (3, 0, []))
+            self.assertEqual(result.num_pixels, 3 * 6 * 5)
+
+            result = decode_batch([encoded_directory], decoded_directory, jobs=jobs, queue_depth=queue_depth)
+            self.assertEqual((result.num_coded, result.failures), (3, []))
+            for name, image in images.items():
+                decoded_path = os.path.join(decoded_directory, os.path.splitext(name)[0] + ".png")
+                self.assertTrue(np.array_equal(io.imread(decoded_path), image))
+
+            # the outputs are newer than the sources now, so nothing is coded again unless forced
+            result = encode_batch([source_directory], encoded_directory, jobs=jobs)
+            self.assertEqual((result.num_coded, result.num_skipped), (0, 3))
+            result = encode_batch([source_directory], encoded_directory, jobs=jobs, force=True)
+            self.assertEqual((result.num_coded, result.num_skipped), (3, 0))
+
+    def test_failures(self):
+        source_directory, decoded_directory = tempfile.mkdtemp(), tempfile.mkdtemp()
+        with open(os.path.join(source_directory, "broken.qowi"), "wb") as broken:
+            broken.write(b"\x00")
+
+        with open(os.path.join(source_directory, "broken.png"), "wb") as broken:
+            broken.write(b"\x00")
+        _write_images(source_directory)
+
+        result = decode_batch([source_directory], decoded_directory, jobs=1)
+        self.assertEqual(result.num_coded, 0)
+        self.assertEqual(len(result.failures), 1)
+        self.assertTrue(result.failures[0][0].endswith("broken.qowi"))
+
+        # an unreadable source fails in the reader without holding up the rest
+        result = encode_batch([source_directory], decoded_directory, jobs=2)
+        self.assertEqual(result.num_coded, 3)
+        self.assertEqual(len(result.failures), 1)
+        self.assertTrue(result.failures[0][0].endswith("broken.png"))
+
+    def test_colliding_outputs(self):
+        source_directory, encoded_directory = tempfile.mkdtemp(), tempfile.mkdtemp()
+        images = _write_images(source_directory)
+        io.imsave(os.path.join(source_directory, "a.bmp"), images["a.png"], check_contrast=False)
+
+        # a.png and a.bmp would both write a.qowi, so neither is coded
+        result = encode_batch([source_directory], encoded_directory, {"wavelet_encode_levels": 10}, jobs=1)
+        self.assertEqual(result.num_coded, 2)
+        self.assertEqual(sorted(os.path.basename(source_path) for source_path, _ in result.failures), ["a.bmp", "a.png"])
+        self.assertFalse(os.path.exists(os.path.join(encoded_directory, "a.qowi")))
+
+    def test_interrupted(self):
+        source_directory, dest_directory = tempfile.mkdtemp(), tempfile.mkdtemp()
+        for index in range(8):
+            write_bytes(os.path.join(source_directory, "{}.qowi".format(index)), b"\x00")
+
+        # the readers are blocked on the full read queue when the compute stage fails, and must still stop
+        threads = threading.active_count()
+        with self.assertRaises(Interrupted):
+            _run_batch(read_bytes, _interrupt, write_bytes, [source_directory], dest_directory, (".qowi",), ".png", (), jobs=1, queue_depth=1)
+        self.assertEqual(threads, threading.active_count())
+
+if __name__ == '__main__':
+    unittest.main()
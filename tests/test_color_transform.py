@@ -0,0 +1,38 @@
+import numpy as np
+import unittest
+from qowi.color_transform import COLOR_TRANSFORM_NONE, rgb_to_ycocg_r, to_image, ycocg_r_to_rgb
+
+
+class TestColorTransform(unittest.TestCase):
+
+    def test_round_trip_all_extremes(self):
+        values = np.array([0, 1, 127, 128, 254, 255])
+        r, g, b = np.meshgrid(values, values, values, indexing='ij')
+        source_image = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=-1).reshape(-1, 6, 3).astype(np.uint8)
+
+        transformed = rgb_to_ycocg_r(source_image)
+        observed_image = ycocg_r_to_rgb(transformed)
+
+        self.assertTrue(np.array_equal(source_image, observed_image))
+
+    def test_gray_pixels_have_zero_chroma(self):
+        source_image = np.full((4, 4, 3), 93, dtype=np.uint8)
+        transformed = rgb_to_ycocg_r(source_image)
+
+        self.assertTrue(np.all(transformed[..., 0] == 93))
+        self.assertTrue(np.all(transformed[..., 1:] == 0))
+
+    def test_alpha_channel_passes_through(self):
+        source_image = np.random.default_rng(7).integers(0, 256, (8, 8, 4), dtype=np.uint8)
+        transformed = rgb_to_ycocg_r(source_image)
+
+        self.assertTrue(np.array_equal(source_image[..., 3], transformed[..., 3]))
+        self.assertTrue(np.array_equal(source_image, ycocg_r_to_rgb(transformed)))
+
+    def test_to_image_saturates(self):
+        array = np.array([[[-3, 0, 255], [256, 128, 1000]]])
+        expected = np.array([[[0, 0, 255], [255, 128, 255]]], dtype=np.uint8)
+        self.assertTrue(np.array_equal(expected, to_image(array, COLOR_TRANSFORM_NONE)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import numpy as np
+import os
+import tempfile
+import unittest
+from bitstring import BitStream
+from qowi.dictionary import DICTIONARY_NONE, get_dictionary, load_dictionary, register_dictionary, save_dictionary, train_dictionary
+from qowi.header import CODEC_SPATIAL, CODEC_WAVELET
+from qowi.qowi_decoder import QOWIDecoder
+from qowi.qowi_encoder import QOWIEncoder
+from qowi.wavelet import Wavelet, traversal_order
+
+TEST_DICTIONARY_ID = 254
+
+
+def _tiles(seed):
+    """Small noisy images sharing a palette, like a set of thumbnails."""
+    rng = np.random.default_rng(seed)
+    palette = np.array([[200, 30, 30], [30, 200, 30], [30, 30, 200], [240, 240, 240]], dtype=np.uint8)
+    return [palette[rng.integers(0, len(palette), size=(8, 8))] for _ in range(8)]
+
+
+def _wavelet_tokens(image):
+    wavelet = Wavelet(wavelet_levels=10).prepare_from_image(image)
+    rows, cols = traversal_order(wavelet.num_levels)
+    return wavelet.wavelet[rows, cols]
+
+
+class TestDictionary(unittest.TestCase):
+
+    def test_train_dictionary(self):
+        token_arrays = [
+            np.array([[1, 1, 1], [1, 1, 1], [1, 1, 1], [2, 2, 2], [3, 3, 3]]),
+            np.array([[2, 2, 2], [1, 1, 1], [2, 2, 2]]),
+        ]
+        entries = train_dictionary(token_arrays, size=2)
+
+        # the repeated (1, 1, 1) tokens are one run, so (2, 2, 2) is the most frequent
+        self.assertEqual(entries, (((2, 2, 2), 2), ((1, 1, 1), 1)))
+
+    def test_save_and_load(self):
+        entries = (((2, 2, 2), 2), ((1, -1, 1), 1))
+        path = os.path.join(tempfile.mkdtemp(), "1.json")
+        save_dictionary(path, entries)
+        self.assertEqual(load_dictionary(path), entries)
+
+    def test_unknown_dictionary(self):
+        self.assertEqual(get_dictionary(DICTIONARY_NONE), ())
+        with self.assertRaises(ValueError):
+            get_dictionary(253)
+        with self.assertRaises(ValueError):
+            register_dictionary(DICTIONARY_NONE, [])
+
+    def test_round_trip_with_dictionary(self):
+        register_dictionary(TEST_DICTIONARY_ID, train_dictionary([_wavelet_tokens(image) for image in _tiles(0)]))
+
+        for codec in [CODEC_WAVELET, CODEC_SPATIAL]:
+            for source_image in _tiles(1)[:2]:
+                sizes = []
+                for dictionary_id in [DICTIONARY_NONE, TEST_DICTIONARY_ID]:
+                    encoded_bits = BitStream()
+                    e = QOWIEncoder(wavelet_encode_levels=10, codec=codec, dictionary_id=dictionary_id)
+                    e.from_array(source_image)
+                    e.to_bitstream(encoded_bits)
+                    e.encode()
+                    sizes.append(encoded_bits.len)
+
+                    d = QOWIDecoder()
+                    d.from_bitstream(encoded_bits)
+                    d.decode()
+                    self.assertTrue(np.array_equal(d.as_array(), source_image))
+
+                if codec == CODEC_WAVELET:
+                    self.assertLess(sizes[1], sizes[0])
+
+    def test_mismatched_dictionary(self):
+        register_dictionary(TEST_DICTIONARY_ID, train_dictionary([_wavelet_tokens(image) for image in _tiles(0)]))
+        source_image = _tiles(1)[0]
+        for codec in [CODEC_WAVELET, CODEC_SPATIAL]:
+            encoded_bits = BitStream()
+            e = QOWIEncoder(wavelet_encode_levels=10, codec=codec, dictionary_id=TEST_DICTIONARY_ID)
+            e.from_array(source_image)
+            e.to_bitstream(encoded_bits)
+            e.encode()
+
+            # a retrained dictionary under the same ID preloads different tokens, so decoding must fail
+            register_dictionary(TEST_DICTIONARY_ID, train_dictionary([_wavelet_tokens(image) for image in _tiles(2)]))
+            d = QOWIDecoder()
+            d.from_bitstream(encoded_bits)
+            with self.assertRaises(ValueError):
+                d.decode()
+            register_dictionary(TEST_DICTIONARY_ID, train_dictionary([_wavelet_tokens(image) for image in _tiles(0)]))
+
+if __name__ == '__main__':
+    unittest.main()
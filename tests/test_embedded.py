@@ -0,0 +1,62 @@
+import numpy as np
+import unittest
+from bitstring import BitStream
+from qowi.embedded import EmbeddedDecoder, EmbeddedEncoder
+from qowi.wavelet import Wavelet
+
+
+def _test_wavelet(seed=0):
+    rng = np.random.default_rng(seed)
+    gradient = np.add.outer(np.arange(16), np.arange(16)) * 6
+    image = np.clip(gradient[:, :, None] + rng.integers(-20, 20, size=(16, 16, 3)), 0, 255).astype(np.uint8)
+    return Wavelet().prepare_from_image(image)
+
+
+def _decode(wavelet, bits):
+    decoded = Wavelet(wavelet.width, wavelet.height, wavelet.color_depth, wavelet.wavelet_levels, wavelet.precision_binary_digits)
+    decoded.wavelet[0, 0] = wavelet.wavelet[0, 0]
+    decoder = EmbeddedDecoder(bits)
+    decoder.decode(decoded)
+    return decoded, decoder.truncated
+
+
+class TestEmbedded(unittest.TestCase):
+
+    def test_round_trip(self):
+        for seed in range(3):
+            wavelet = _test_wavelet(seed)
+            bits = BitStream()
+            EmbeddedEncoder(bits).encode(wavelet)
+
+            decoded, truncated = _decode(wavelet, BitStream(bits))
+
+            self.assertFalse(truncated)
+            self.assertTrue(np.array_equal(decoded.wavelet, wavelet.wavelet))
+
+    def test_zero_wavelet(self):
+        wavelet = Wavelet().prepare_from_image(np.zeros((4, 4, 3), dtype=np.uint8))
+        bits = BitStream()
+        EmbeddedEncoder(bits).encode(wavelet)
+
+        decoded, truncated = _decode(wavelet, BitStream(bits))
+
+        self.assertFalse(truncated)
+        self.assertTrue(np.array_equal(decoded.wavelet, wavelet.wavelet))
+
+    def test_prefixes_decode_with_falling_error(self):
+        wavelet = _test_wavelet()
+        image = wavelet.as_array().astype(np.int64)
+        bits = BitStream()
+        EmbeddedEncoder(bits).encode(wavelet)
+
+        errors = []
+        for fraction in [0.1, 0.3, 0.6, 0.9]:
+            decoded, truncated = _decode(wavelet, BitStream(bits[:int(bits.len * fraction)]))
+            self.assertTrue(truncated)
+            errors.append(np.mean((decoded.as_array().astype(np.int64) - image) ** 2))
+
+        self.assertEqual(errors, sorted(errors, reverse=True))
+        self.assertGreater(errors[0], errors[-1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@ import numpy as np
 import qowi.entropy as entropy
 import unittest
 from bitstring import BitStream
+from qowi.bit_io import BitReader, BitWriter
 
 class EntropyTestCases(unittest.TestCase):
 
@@ -14,5 +15,27 @@ class EntropyTestCases(unittest.TestCase):
             self.assertEqual(expected, observed)
             self.assertTrue(num_unread == 0)
 
+    def test_simple_code_round_trip_with_bit_io(self):
+        expected = list(range(2048)) + [2 ** 40, 0, 1]
+        bitstream = BitStream()
+        writer = BitWriter(bitstream)
+        for value in expected:
+            writer.write(*entropy.simple_code(value))
+        writer.flush()
+
+        self.assertEqual(sum(entropy.simple_encode_length(value) for value in expected), bitstream.len)
+        self.assertEqual(BitStream().join(entropy.simple_encode(value) for value in expected), bitstream)
+
+        reader = BitReader(bitstream)
+        observed = [entropy.simple_decode_reader(reader) for _ in expected]
+        self.assertEqual(expected, observed)
+        self.assertEqual(bitstream.len, reader.pos)
+
+    def test_simple_encode_length_ndarray(self):
+        values = list(range(2048)) + [2 ** bits + offset for bits in range(11, 62) for offset in (-3, -2, -1, 0)]
+        expected = [entropy.simple_encode_length(value) for value in values]
+        self.assertEqual(expected, entropy.simple_encode_length_ndarray(np.array(values, dtype=np.int64)).tolist())
+        self.assertEqual(sum(expected[:64]), entropy.simple_encode_ndarray(np.arange(64)).len)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,53 @@
+import numpy as np
+from itertools import product
+from qowi.haar_sort import HaarSortRank
+from qowi.integers import integer_to_zigzag_ndarray
+from qowi.wavelet import haar_encode
+import unittest
+
+
+class TestHaarSortRank(unittest.TestCase):
+
+    def _all_grids(self, bit_depth):
+        return np.array(list(product(range(1 << bit_depth), repeat=4)))
+
+    def _sorted_positions(self, grids):
+        ll, hl, lh, hh = haar_encode(grids[:, 0], grids[:, 1], grids[:, 2], grids[:, 3])
+        order = np.lexsort((integer_to_zigzag_ndarray(hh), integer_to_zigzag_ndarray(lh), integer_to_zigzag_ndarray(hl), ll))
+        positions = np.empty(len(grids), dtype=np.int64)
+        positions[order] = np.arange(len(grids))
+        return positions
+
+    def test_rank_matches_sorted_order(self):
+        for bit_depth in [1, 2, 3, 4]:
+            grids = self._all_grids(bit_depth)
+            rank = HaarSortRank(bit_depth)
+            np.testing.assert_array_equal(rank.rank(grids), self._sorted_positions(grids))
+
+    def test_unrank_inverts_rank(self):
+        for bit_depth in [2, 4]:
+            grids = self._all_grids(bit_depth)
+            rank = HaarSortRank(bit_depth)
+            np.testing.assert_array_equal(rank.unrank(np.arange(rank.num_grids)), grids[np.argsort(self._sorted_positions(grids))])
+
+    def test_round_trip_8bit(self):
+        rank = HaarSortRank(8)
+        grids = np.random.default_rng(0).integers(0, 256, size=(20, 30, 4))
+        ranks = rank.rank(grids)
+        self.assertEqual(ranks.shape, (20, 30))
+        np.testing.assert_array_equal(rank.unrank(ranks), grids)
+
+        self.assertEqual(rank.rank(np.zeros(4, dtype=int)), 0)
+        self.assertEqual(rank.rank(np.full(4, 255)), rank.num_grids - 1)
+
+    def test_invalid_input(self):
+        rank = HaarSortRank(2)
+        with self.assertRaises(ValueError):
+            rank.rank(np.array([0, 0, 0, 4]))
+        with self.assertRaises(ValueError):
+            rank.rank(np.array([0, 0, 0]))
+        with self.assertRaises(ValueError):
+            rank.unrank(np.array([256]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,5 +20,71 @@ class TestHeader(unittest.TestCase):
 
         self.assertEqual(expected, observed)
 
+    def test_round_trip_color_transform(self):
+        expected = Header()
+        expected.width = 16
+        expected.height = 16
+        expected.color_depth = 3
+        expected.cache_size = 200
+        expected.wavelet_precision_digits = 0
+        expected.wavelet_levels = 2
+        expected.color_transform = 1
+
+        observed = Header()
+        observed.read(BitStream(expected.header_bits()))
+
+        self.assertEqual(expected, observed)
+
+    def test_round_trip_haar_blocks_and_zerotrees(self):
+        expected = Header()
+        expected.width = 16
+        expected.height = 16
+        expected.color_depth = 3
+        expected.cache_size = 200
+        expected.wavelet_precision_digits = 0
+        expected.wavelet_levels = 2
+        expected.haar_blocks = True
+        expected.zerotrees = True
+
+        observed = Header()
+        observed.read(BitStream(expected.header_bits()))
+
+        self.assertEqual(expected, observed)
+
+    def test_round_trip_embedded_and_codec(self):
+        expected = Header()
+        expected.width = 16
+        expected.height = 16
+        expected.color_depth = 3
+        expected.cache_size = 200
+        expected.wavelet_precision_digits = 0
+        expected.wavelet_levels = 2
+        expected.embedded = True
+        expected.codec = 1
+
+        observed = Header()
+        observed.read(BitStream(expected.header_bits()))
+
+        self.assertEqual(expected, observed)
+        self.assertNotEqual(Header(), observed)
+
+    def test_round_trip_predictors_quantization_steps_and_dictionary(self):
+        expected = Header()
+        expected.width = 16
+        expected.height = 16
+        expected.color_depth = 3
+        expected.cache_size = 200
+        expected.wavelet_precision_digits = 0
+        expected.wavelet_levels = 2
+        expected.predictors = (2, 0, 3)
+        expected.dictionary_id = 200
+        expected.dictionary_checksum = 0xdeadbeef
+        expected.quantization_steps = [(1, 1, 1), (16, 16, 24), (8, 8, 12)]
+
+        observed = Header()
+        observed.read(BitStream(expected.header_bits()))
+
+        self.assertEqual(expected, observed)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+import numpy as np
+import time
+import unittest
+from bitstring import BitStream
+from qowi.header import CODEC_SPATIAL, CODEC_WAVELET
+from qowi.instrumentation import (STAGE_BIT_IO, STAGE_DEQUANTIZE, STAGE_INTEGER_CODING, STAGE_INVERSE_TRANSFORM, STAGE_PREDICTOR_CHOICE,
+                                  STAGE_THRESHOLD, STAGE_TRANSFORM, STAGE_TRAVERSAL, Instrumentation, stage)
+from qowi.qowi_decoder import QOWIDecoder
+from qowi.qowi_encoder import QOWIEncoder
+
+
+def _encode(source_image, instrumentation=None, **kwargs):
+    encoded_bits = BitStream()
+    e = QOWIEncoder(wavelet_encode_levels=10, instrumentation=instrumentation, **kwargs)
+    e.from_array(source_image)
+    e.to_bitstream(encoded_bits)
+    e.encode()
+    return e, encoded_bits
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_nested_stages_are_exclusive(self):
+        events = []
+        instrumentation = Instrumentation(hook=lambda name, seconds: events.append((name, seconds)))
+        inner = instrumentation.timed(lambda: time.sleep(0.02), "inner")
+        with instrumentation.stage("outer"):
+            time.sleep(0.01)
+            inner()
+
+        self.assertGreaterEqual(instrumentation.timings["inner"], 0.02)
+        self.assertLess(instrumentation.timings["outer"], 0.02)
+
+        # only the stage reaches the hook, with its time including the nested one
+        self.assertEqual([name for name, _ in events], ["outer"])
+        self.assertGreaterEqual(events[0][1], 0.03)
+
+    def test_disabled(self):
+        with stage(None, STAGE_TRANSFORM):
+            pass
+
+    def test_encoder_and_decoder(self):
+        source_image = np.random.default_rng(0).integers(0, 8, size=(16, 16, 3)).astype(np.uint8)
+        _, plain_bits = _encode(source_image)
+        instrumentation = Instrumentation()
+        e, encoded_bits = _encode(source_image, instrumentation, codec=CODEC_WAVELET, stats=True)
+        self.assertEqual(plain_bits, encoded_bits)
+
+        for name in [STAGE_TRANSFORM, STAGE_THRESHOLD, STAGE_PREDICTOR_CHOICE, STAGE_TRAVERSAL, STAGE_INTEGER_CODING, STAGE_BIT_IO]:
+            self.assertIn(name, instrumentation.timings)
+
+        # the op counters agree with the recorded ops
+        counters = instrumentation.counters
+        self.assertEqual({name[len("ops."):]: count for name, count in counters.items() if name.startswith("ops.")}, e.stats.op_counts)
+        self.assertEqual(sum(count for name, count in counters.items() if name.startswith("bits.")), e.stats.num_bits)
+        self.assertLessEqual(counters["cache_hits"], counters["cache_lookups"])
+
+        instrumentation = Instrumentation()
+        d = QOWIDecoder(instrumentation=instrumentation)
+        d.from_bitstream(encoded_bits)
+        d.decode()
+        self.assertTrue(np.array_equal(d.as_array(), source_image))
+        for name in [STAGE_TRAVERSAL, STAGE_INTEGER_CODING, STAGE_BIT_IO, STAGE_DEQUANTIZE, STAGE_INVERSE_TRANSFORM]:
+            self.assertIn(name, instrumentation.timings)
+
+    def test_spatial(self):
+        source_image = np.zeros((16, 16, 3), dtype=np.uint8)
+        instrumentation = Instrumentation()
+        _encode(source_image, instrumentation, codec=CODEC_SPATIAL)
+        self.assertIn(STAGE_INTEGER_CODING, instrumentation.timings)
+        self.assertEqual(instrumentation.counters["ops.RUN"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
+import qowi.entropy as entropy
 import unittest
 from bitstring import BitStream
-from qowi.integer_encoder import IntegerEncoder
+from qowi.integer_encoder import IntegerEncoder, OP_CODE_DELTA, OP_CODE_RUN
 from qowi.integer_decoder import IntegerDecoder
 
 
@@ -41,5 +42,81 @@ class TestIntegerDecoder(unittest.TestCase):
 
         self.assertEqual(expected_token_list, observed_token_list)
 
+    def test_round_trip_predictions(self):
+        bitstream = BitStream()
+        e = IntegerEncoder(bitstream, 32, stats=True)
+
+        tokens = [(100, 90, 80), (104, 91, 79), (7, 7, 7), (7, 7, 7), (-50, 60, 0)]
+        predictions = [(101, 90, 80), None, (6, 8, 7), None, (-52, 61, 1)]
+        for token, prediction in zip(tokens, predictions):
+            e.encode_next(token, prediction)
+        e.finish()
+        self.assertEqual({"DELTA": 4, "RUN": 1}, e.stats.op_counts)
+
+        # read the op codes back off the stream, skipping the run length and the deltas
+        ops = bitstream[:]
+        op_codes = []
+        while ops.pos < ops.len:
+            op_code = ops.read(2)
+            if op_code == OP_CODE_RUN:
+                op_codes.append("RUN")
+                entropy.simple_decode(ops)
+            else:
+                self.assertEqual(OP_CODE_DELTA, op_code)
+                op_codes.append("DELTA")
+                entropy.simple_decode_tuple(ops, 3)
+        self.assertEqual(["DELTA", "DELTA", "DELTA", "RUN", "DELTA"], op_codes)
+
+        d = IntegerDecoder(bitstream, 32)
+        self.assertEqual(tokens, [d.decode_next(prediction) for prediction in predictions])
+
+    def test_round_trip_haar_blocks(self):
+        bitstream = BitStream()
+        e = IntegerEncoder(bitstream, 32, haar_blocks=True, stats=True)
+
+        blocks = [[(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 0)],
+                  [(3, 1, 0), (1, 0, 2), (0, 2, 1), (2, 1, 3)],
+                  [(2, 1, 3), (2, 1, 3), (2, 1, 3), (2, 1, 3)],
+                  [(1, 0, 0), (-1, 0, 0), (2, 0, 0), (0, 0, 0)],
+                  [(300, 0, 0), (0, 0, 0), (0, 0, 0), (0, 0, 0)]]
+        e.encode_next((40, -30, 20))
+        for block in blocks:
+            e.encode_block(block)
+        e.finish()
+        self.assertIn("HAAR_BLOCK", e.stats.op_counts)
+
+        expected_token_list = [(40, -30, 20)] + [token for block in blocks for token in block]
+        d = IntegerDecoder(bitstream, 32, haar_blocks=True)
+        observed_token_list = [d.decode_next() for _ in expected_token_list]
+
+        self.assertEqual(expected_token_list, observed_token_list)
+
+    def test_skip_zero_subtrees(self):
+        bitstream = BitStream()
+        e = IntegerEncoder(bitstream, 32, zerotrees=True)
+        e.encode_next((1, 2, 3))
+        e.encode_zero_subtree((0, 0, 0), 5)
+        e.encode_zero_subtree((0, 0, 0), 5)
+        e.encode_next((0, 0, 0))
+        e.encode_next((4, 5, 6))
+        e.finish()
+
+        d = IntegerDecoder(bitstream, 32, zerotrees=True)
+        self.assertEqual((1, 2, 3), d.decode_next())
+        self.assertFalse(d.skip_zero_subtree(4))
+
+        # a zerotree op
+        self.assertEqual((0, 0, 0), d.decode_next())
+        self.assertTrue(d.skip_zero_subtree(4))
+
+        # a run of zeros covering the subtree
+        self.assertEqual((0, 0, 0), d.decode_next())
+        self.assertTrue(d.skip_zero_subtree(4))
+
+        # the run only has one zero left
+        self.assertEqual((0, 0, 0), d.decode_next())
+        self.assertFalse(d.skip_zero_subtree(4))
+        self.assertEqual((4, 5, 6), d.decode_next())
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,7 @@ import unittest
 from bitstring import BitStream
 
 from qowi import integers
-from qowi.integer_encoder import IntegerEncoder, OP_CODE_CACHE, OP_CODE_RUN, OP_CODE_VALUE, OP_CODE_DELTA, ZERO_INTEGER
+from qowi.integer_encoder import IntegerEncoder, IntegerSizeEstimator, OP_CODE_CACHE, OP_CODE_RUN, OP_CODE_VALUE, OP_CODE_DELTA, OP_CODE_EXTENDED, EXTENDED_OP_HAAR_BLOCK, EXTENDED_OP_ZEROTREE, ZERO_INTEGER
 
 
 class TestIntegerEncoder(unittest.TestCase):
@@ -81,6 +81,88 @@ class TestIntegerEncoder(unittest.TestCase):
         pos_value = entropy.simple_decode(bitstream)
         self.assertEqual(1, pos_value)
 
+    def test_size_estimator_matches_encoder(self):
+        tokens = [(0, 0, 0), (0, 0, 0), (5, -3, 2), (5, -3, 2), (255, 255, 255), (0, 0, 0), (5, -3, 2), (6, -3, 2)]
+        bitstream = BitStream()
+        e = IntegerEncoder(bitstream, 1024)
+        estimator = IntegerSizeEstimator(1024)
+        for token in tokens:
+            e.encode_next(token)
+            estimator.encode_next(token)
+        e.finish()
+        estimator.finish()
+
+        self.assertEqual(bitstream.len, estimator.num_bits)
+
+    def test_encode_haar_block(self):
+        bitstream = BitStream()
+        e = IntegerEncoder(bitstream, 1024, haar_blocks=True, stats=True)
+        e.encode_next((40, -30, 20))
+        e.encode_block([(1, 0, 0), (-1, 0, 0), (2, 0, 0), (0, 0, 0)])
+        e.finish()
+
+        self.assertEqual({"DELTA": 1, "HAAR_BLOCK": 1}, e.stats.op_counts)
+        self.assertEqual(bitstream.len, e.stats.num_bits)
+
+        self.assertEqual(OP_CODE_DELTA, bitstream.read(2))
+        entropy.simple_decode_tuple(bitstream, 3)
+        self.assertEqual(OP_CODE_EXTENDED, bitstream.read(3))
+        self.assertEqual(EXTENDED_OP_HAAR_BLOCK, entropy.simple_decode(bitstream))
+
+        # only the first channel varies, so the other channels have the first rank
+        ranks = entropy.simple_decode_tuple(bitstream, 3)
+        self.assertEqual((0, 0), ranks[1:])
+
+    def test_encode_repeated_matches_encode_next(self):
+        repeated_bitstream = BitStream()
+        e = IntegerEncoder(repeated_bitstream, 1024)
+        e.encode_next((1, 2, 3))
+        e.encode_repeated((1, 2, 3), 20)
+        e.encode_zero_subtree(ZERO_INTEGER, 21)
+        e.finish()
+
+        token_bitstream = BitStream()
+        e = IntegerEncoder(token_bitstream, 1024)
+        for token in [(1, 2, 3)] * 21 + [ZERO_INTEGER] * 21:
+            e.encode_next(token)
+        e.finish()
+
+        self.assertEqual(token_bitstream, repeated_bitstream)
+
+    def test_encode_zerotree(self):
+        bitstream = BitStream()
+        e = IntegerEncoder(bitstream, 1024, zerotrees=True, stats=True)
+        e.encode_next((1, 2, 3))
+        e.encode_zero_subtree(ZERO_INTEGER, 21)
+        e.encode_zero_subtree(ZERO_INTEGER, 5)
+        e.finish()
+
+        # the second zero subtree follows a zero, so it extends a run instead
+        self.assertEqual({"DELTA": 1, "ZEROTREE": 1, "RUN": 1}, e.stats.op_counts)
+        self.assertEqual((21, 5), (e.stats.zerotree_tokens, e.stats.max_run_length))
+
+        self.assertEqual(OP_CODE_DELTA, bitstream.read(2))
+        entropy.simple_decode_tuple(bitstream, 3)
+        self.assertEqual(OP_CODE_EXTENDED, bitstream.read(3))
+        self.assertEqual(EXTENDED_OP_ZEROTREE, entropy.simple_decode(bitstream))
+        self.assertEqual(OP_CODE_RUN, bitstream.read(2))
+        self.assertEqual(5 - 1, entropy.simple_decode(bitstream))
+        self.assertEqual(bitstream.len, bitstream.pos)
+
+    def test_encode_block_without_haar_blocks(self):
+        tokens = [(1, 0, 0), (-1, 0, 0), (2, 0, 0), (0, 0, 0)]
+        block_bitstream = BitStream()
+        e = IntegerEncoder(block_bitstream, 1024)
+        e.encode_block(tokens)
+        e.finish()
+
+        token_bitstream = BitStream()
+        e = IntegerEncoder(token_bitstream, 1024)
+        for token in tokens:
+            e.encode_next(token)
+        e.finish()
+
+        self.assertEqual(token_bitstream, block_bitstream)
 
 if __name__ == '__main__':
     unittest.main()
@@ -74,5 +74,28 @@ class TestMFLRUCache(unittest.TestCase):
             observed_exception_raised = True
         self.assertTrue(observed_exception_raised)
 
+    def test_preload(self):
+        c = MFLRUCache(3)
+        c.preload([('A', 5), ('B', 2), ('C', 2), ('D', 1)])
+        self.assertEqual([c[0], c[1], c[2]], ['A', 'B', 'C'])
+        with self.assertRaises(IndexError):
+            c.index('D')
+
+        # observations add to the preloaded counts
+        c.observe('C')
+        self.assertEqual(c.index('C'), 1)
+
+    def test_copy(self):
+        c = MFLRUCache(3)
+        c.observe('A')
+        c.observe('B')
+        c.observe('B')
+        copied = c.copy()
+        copied.observe('A')
+        copied.observe('A')
+
+        self.assertEqual(c.index('B'), 0)
+        self.assertEqual(copied.index('A'), 0)
+
 if __name__ == '__main__':
     unittest.main()
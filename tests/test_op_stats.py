@@ -0,0 +1,82 @@
+import numpy as np
+import unittest
+import utils.analysis as analysis
+from bitstring import BitStream
+from qowi.integer_encoder import IntegerEncoder
+from qowi.op_stats import MAX_OP_BITS, OP_CACHE, OP_DELTA, OP_RUN, OP_VALUE, OpStats
+
+
+def _stats():
+    stats = OpStats(16)
+    stats.record(OP_DELTA, 8)
+    stats.record(OP_VALUE, 14, (5, -3, 0))
+    stats.record(OP_RUN, 4, 6)
+    stats.record(OP_CACHE, 3, 2)
+    stats.record(OP_CACHE, 5, 9)
+    stats.record(OP_VALUE, MAX_OP_BITS + 10, (300, 0, 0))
+    return stats
+
+
+class TestOpStats(unittest.TestCase):
+
+    def test_record(self):
+        stats = _stats()
+        self.assertEqual({"RUN": 1, "CACHE": 2, "DELTA": 1, "VALUE": 2}, stats.op_counts)
+        self.assertEqual(8 + 14 + 4 + 3 + 5 + MAX_OP_BITS, stats.num_bits)
+        self.assertEqual(6, stats.max_run_length)
+        self.assertEqual(1, stats.run_lengths[3])
+        self.assertEqual([2, 9], np.flatnonzero(stats.cache_positions).tolist())
+
+        # 5 and -3 have bit lengths 3 and 2, 300 has 9
+        self.assertEqual([0, 0, 0, 1] + [0] * 5 + [1], stats.value_magnitudes[0, :10].tolist())
+        self.assertEqual(1, stats.value_magnitudes[1, 2])
+        self.assertEqual(2, stats.value_magnitudes[2, 0])
+
+    def test_merge(self):
+        stats = _stats()
+        other = OpStats(32)
+        other.record(OP_RUN, 6, 40)
+        other.record(OP_CACHE, 4, 20)
+        stats.merge(other)
+
+        self.assertEqual({"RUN": 2, "CACHE": 3, "DELTA": 1, "VALUE": 2}, stats.op_counts)
+        self.assertEqual(40, stats.max_run_length)
+        self.assertEqual([2, 9, 20], np.flatnonzero(stats.cache_positions).tolist())
+
+    def test_stats_are_opt_in(self):
+        tokens = [(1, 2, 3), (1, 2, 3), (4, 5, 6), (1, 2, 3)]
+        bitstreams = []
+        for stats in [False, True]:
+            bitstream = BitStream()
+            e = IntegerEncoder(bitstream, 32, stats=stats)
+            for token in tokens:
+                e.encode_next(token)
+            e.finish()
+            bitstreams.append(bitstream)
+
+            if stats:
+                self.assertEqual(bitstream.len, e.stats.num_bits)
+            else:
+                self.assertIsNone(e.stats)
+        self.assertEqual(bitstreams[0], bitstreams[1])
+
+    def test_analysis(self):
+        stats = _stats()
+        frequency = analysis.op_code_frequency(stats)
+        self.assertEqual(["CACHE", "VALUE"], sorted(frequency[frequency["count"] == 2]["op_code"].tolist()))
+
+        max_values = analysis.op_code_max_values(stats)
+        self.assertEqual([6, 9], max_values["Value"].tolist())
+
+        histogram = analysis.rgb_frequency_histogram(stats)
+        self.assertEqual(["R", "G", "B"], histogram.columns.tolist())
+        self.assertEqual(1, histogram.loc["4-7", "R"])
+        self.assertEqual(1, histogram.loc["256-511", "R"])
+
+        num_bits = analysis.op_code_num_bits_frequency_histgram(stats)
+        self.assertEqual(1, num_bits.loc["8", "DELTA"])
+        self.assertEqual(1, num_bits.loc["14", "VALUE"])
+        self.assertEqual(1, num_bits.loc["2", "CACHE"])
+
+if __name__ == '__main__':
+    unittest.main()
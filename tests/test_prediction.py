@@ -0,0 +1,70 @@
+import numpy as np
+import unittest
+from unittest import mock
+from qowi.prediction import PREDICTOR_LAST, PREDICTOR_MEDIAN, PREDICTOR_NEIGHBOUR, PREDICTOR_PARENT, PREDICTORS, predict, prediction_array
+from qowi.wavelet import FILTERS, Wavelet, coefficient_position, traversal_order
+
+
+class TestPrediction(unittest.TestCase):
+
+    def _walk(self, num_levels):
+        """The quad-tree nodes in the order the coders visit them."""
+        stack = [(0, 'HH', 0, 0), (0, 'LH', 0, 0), (0, 'HL', 0, 0)]
+        while stack:
+            level, filter, i, j = stack.pop()
+            yield level, filter, i, j
+            if level + 1 < num_levels:
+                stack.extend([(level + 1, filter, 2 * i, 2 * j), (level + 1, filter, 2 * i, 2 * j + 1),
+                              (level + 1, filter, 2 * i + 1, 2 * j), (level + 1, filter, 2 * i + 1, 2 * j + 1)])
+
+    def test_prediction_array_matches_decoding_order(self):
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 256, size=(16, 16, 3)).astype(np.uint8)
+        w = Wavelet(wavelet_levels=4).prepare_from_image(image)
+
+        for predictors in [(PREDICTOR_LAST, PREDICTOR_PARENT, PREDICTOR_NEIGHBOUR), (PREDICTOR_MEDIAN,) * 3]:
+            expected = prediction_array(w.wavelet, w.num_levels, predictors)
+
+            # predict each coefficient from a wavelet holding only the coefficients decoded before it
+            decoded = np.zeros_like(w.wavelet)
+            last_integer = (0, 0, 0)
+            for level, filter, i, j in self._walk(w.num_levels):
+                position = coefficient_position(level, filter, i, j)
+                observed = predict(decoded, predictors[FILTERS.index(filter)], last_integer, level, filter, i, j)
+                self.assertEqual(tuple(expected[position].tolist()), observed)
+
+                decoded[position] = w.wavelet[position]
+                last_integer = tuple(w.wavelet[position].tolist())
+
+    def test_prediction_array_in_row_blocks(self):
+        rng = np.random.default_rng(1)
+        image = rng.integers(0, 256, size=(32, 32, 4)).astype(np.uint8)
+        w = Wavelet(wavelet_levels=5).prepare_from_image(image)
+
+        # the last prediction is the previous coefficient in traversal order
+        rows, cols = traversal_order(w.num_levels)
+        expected = np.zeros(w.wavelet.shape, dtype=np.int64)
+        expected[rows[1:], cols[1:]] = w.wavelet[rows[:-1], cols[:-1]]
+        self.assertTrue(np.array_equal(expected, prediction_array(w.wavelet, w.num_levels, (PREDICTOR_LAST,) * 3)))
+
+        # working a row at a time into the wavelet's dtype gives the same predictions
+        for predictor in PREDICTORS:
+            expected = prediction_array(w.wavelet, w.num_levels, (predictor,) * 3)
+            with mock.patch("qowi.prediction.PREDICTION_BLOCK_BYTES", 1):
+                observed = prediction_array(w.wavelet, w.num_levels, (predictor,) * 3, np.zeros_like(w.wavelet))
+            self.assertTrue(np.array_equal(expected, observed))
+
+    def test_predictors(self):
+        wavelet = np.zeros((4, 4, 1), dtype=np.int64)
+        wavelet[0, 1] = 9     # HL level 0
+        wavelet[1, 3] = 5     # HL level 1, (1, 1)
+        wavelet[0, 3] = 2     # HL level 1, (0, 1)
+
+        self.assertEqual((4,), predict(wavelet, PREDICTOR_PARENT, (1,), 1, 'HL', 0, 0))
+        self.assertEqual((2,), predict(wavelet, PREDICTOR_NEIGHBOUR, (1,), 1, 'HL', 0, 0))
+        self.assertEqual((0,), predict(wavelet, PREDICTOR_NEIGHBOUR, (1,), 1, 'HL', 0, 1))
+        self.assertEqual((2,), predict(wavelet, PREDICTOR_MEDIAN, (1,), 1, 'HL', 0, 0))
+        self.assertEqual((1,), predict(wavelet, PREDICTOR_LAST, (1,), 1, 'HL', 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
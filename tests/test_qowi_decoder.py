@@ -1,6 +1,10 @@
 import numpy as np
+import os
+import tempfile
 import unittest
 from bitstring import BitStream
+from qowi.color_transform import COLOR_TRANSFORM_YCOCG_R
+from qowi.header import CODEC_SPATIAL, CODEC_WAVELET
 from qowi.qowi_decoder import QOWIDecoder
 from qowi.qowi_encoder import QOWIEncoder
 
@@ -150,5 +154,258 @@ class TestQOWIDecoder(unittest.TestCase):
 
         self.assertTrue(np.array_equal(decoded_image, source_image))
 
+    def test_round_trip_ycocg_r_from_three_image(self):
+        source_image = TEST_IMAGES[3]
+        encoded_bits = BitStream()
+
+        e = QOWIEncoder(color_transform=COLOR_TRANSFORM_YCOCG_R)
+        e.from_array(source_image)
+        e.to_bitstream(encoded_bits)
+        e.encode()
+
+        d = QOWIDecoder()
+        d.from_bitstream(encoded_bits)
+        d.decode()
+        decoded_image = d.as_array()
+
+        self.assertTrue(np.array_equal(decoded_image, source_image))
+
+    def test_round_trip_haar_blocks(self):
+        for source_image in TEST_IMAGES:
+            encoded_bits = BitStream()
+
+            e = QOWIEncoder(wavelet_encode_levels=10, haar_blocks=True)
+            e.from_array(source_image)
+            e.to_bitstream(encoded_bits)
+            e.encode()
+
+            estimator = QOWIEncoder(wavelet_encode_levels=10, haar_blocks=True)
+            estimator.from_array(source_image)
+            self.assertEqual(encoded_bits.len, estimator.estimate_size())
+
+            d = QOWIDecoder()
+            d.from_bitstream(encoded_bits)
+            d.decode()
+
+            self.assertTrue(np.array_equal(d.as_array(), source_image))
+
+    def test_round_trip_zerotrees(self):
+        for hard_threshold in [-1, 10, 40]:
+            for haar_blocks in [False, True]:
+                source_image = TEST_IMAGES[3]
+                encoded_bits = BitStream()
+
+                e = QOWIEncoder(hard_threshold, wavelet_encode_levels=10, haar_blocks=haar_blocks, zerotrees=True)
+                e.from_array(source_image)
+                e.to_bitstream(encoded_bits)
+                e.encode()
+
+                estimator = QOWIEncoder(hard_threshold, wavelet_encode_levels=10, haar_blocks=haar_blocks, zerotrees=True)
+                estimator.from_array(source_image)
+                self.assertEqual(encoded_bits.len, estimator.estimate_size())
+
+                d = QOWIDecoder()
+                d.from_bitstream(encoded_bits)
+                d.decode()
+
+                self.assertTrue(np.array_equal(d._wavelet.wavelet, e._wavelet.wavelet))
+
+    def test_round_trip_embedded(self):
+        for source_image in TEST_IMAGES:
+            encoded_bits = BitStream()
+
+            e = QOWIEncoder(wavelet_encode_levels=10, embedded=True)
+            e.from_array(source_image)
+            e.to_bitstream(encoded_bits)
+            e.encode()
+
+            estimator = QOWIEncoder(wavelet_encode_levels=10, embedded=True)
+            estimator.from_array(source_image)
+            self.assertEqual(encoded_bits.len, estimator.estimate_size())
+
+            d = QOWIDecoder()
+            d.from_bitstream(encoded_bits)
+            d.decode()
+
+            self.assertFalse(d.truncated)
+            self.assertTrue(np.array_equal(d.as_array(), source_image))
+
+    def test_round_trip_quantization(self):
+        for embedded, subband_weights in [(False, (1, 1, 1)), (True, (1, 1, 1)), (False, (1, 1, 2))]:
+            source_image = TEST_IMAGES[3]
+            encoded_bits = BitStream()
+
+            e = QOWIEncoder(wavelet_encode_levels=10, embedded=embedded, quantization_step=4, subband_weights=subband_weights)
+            e.from_array(source_image)
+            e.to_bitstream(encoded_bits)
+            e.encode()
+
+            estimator = QOWIEncoder(wavelet_encode_levels=10, embedded=embedded, quantization_step=4, subband_weights=subband_weights)
+            estimator.from_array(source_image)
+            self.assertEqual(encoded_bits.len, estimator.estimate_size())
+
+            d = QOWIDecoder()
+            d.from_bitstream(encoded_bits)
+            d.decode()
+            decoded_image = d.as_array()
+
+            # the HH steps of the finest level follow the weights
+            hl_step, _, hh_step = d._header.quantization_steps[-1]
+            self.assertEqual(subband_weights[2] * hl_step, hh_step)
+
+            mse = np.mean((source_image.astype(np.float64) - decoded_image) ** 2)
+            self.assertGreater(mse, 0)
+            self.assertAlmostEqual(10 * np.log10(255 ** 2 / mse), estimator.estimate_psnr())
+
+    def test_round_trip_predictors(self):
+        rgba_image = np.dstack([TEST_IMAGES[3], TEST_IMAGES[3][:, :, 1]])
+        for source_image in [TEST_IMAGES[3], rgba_image]:
+            for predictors in [(1, 1, 1), (2, 2, 2), (3, 3, 3), (0, 2, 3), None]:
+                for haar_blocks in [False, True]:
+                    encoded_bits = BitStream()
+
+                    e = QOWIEncoder(10, wavelet_encode_levels=10, haar_blocks=haar_blocks, zerotrees=True, predictors=predictors)
+                    e.from_array(source_image)
+                    e.to_bitstream(encoded_bits)
+                    e.encode()
+
+                    estimator = QOWIEncoder(10, wavelet_encode_levels=10, haar_blocks=haar_blocks, zerotrees=True, predictors=predictors)
+                    estimator.from_array(source_image)
+                    self.assertEqual(encoded_bits.len, estimator.estimate_size())
+
+                    d = QOWIDecoder()
+                    d.from_bitstream(encoded_bits)
+                    d.decode()
+
+                    self.assertEqual(e._header.predictors, d._header.predictors)
+                    self.assertTrue(np.array_equal(d._wavelet.wavelet, e._wavelet.wavelet))
+
+    def test_round_trip_codecs(self):
+        flat_image = np.zeros((24, 40, 3), dtype=np.uint8)
+        flat_image[4:20, 8:32] = (30, 144, 255)
+        for source_image, codec, expected_codec in [(flat_image, CODEC_SPATIAL, CODEC_SPATIAL), (flat_image, CODEC_WAVELET, CODEC_WAVELET),
+                                                    (flat_image, None, CODEC_SPATIAL), (TEST_IMAGES[3], None, None)]:
+            encoded_bits = BitStream()
+
+            e = QOWIEncoder(wavelet_encode_levels=10, codec=codec)
+            e.from_array(source_image)
+            e.to_bitstream(encoded_bits)
+            e.encode()
+
+            estimator = QOWIEncoder(wavelet_encode_levels=10, codec=codec)
+            estimator.from_array(source_image)
+            self.assertEqual(encoded_bits.len, estimator.estimate_size())
+            if expected_codec is not None:
+                self.assertEqual(expected_codec, e.codec)
+
+            d = QOWIDecoder()
+            d.from_bitstream(encoded_bits)
+            d.decode()
+
+            self.assertEqual(e.codec, d.codec)
+            self.assertTrue(np.array_equal(d.as_array(), source_image))
+
+    def test_round_trip_rgba_wavelet(self):
+        source_image = np.dstack([TEST_IMAGES[3], TEST_IMAGES[3][:, :, 0]])
+        for predictors in [None, (1, 2, 3), (3, 3, 3), (0, 2, 3)]:
+            for haar_blocks in [False, True]:
+                encoded_bits = BitStream()
+
+                e = QOWIEncoder(wavelet_encode_levels=10, codec=CODEC_WAVELET, haar_blocks=haar_blocks, zerotrees=True, predictors=predictors)
+                e.from_array(source_image)
+                e.to_bitstream(encoded_bits)
+                e.encode()
+
+                d = QOWIDecoder()
+                d.from_bitstream(encoded_bits)
+                d.decode()
+
+                self.assertEqual(e._header.predictors, d._header.predictors)
+                self.assertTrue(np.array_equal(d.as_array(), source_image))
+
+    def test_lossy_codecs(self):
+        source_image = np.zeros((16, 16, 3), dtype=np.uint8)
+
+        e = QOWIEncoder(hard_threshold=4, codec=None)
+        e.from_array(source_image)
+        e.to_bitstream(BitStream())
+        e.encode()
+        self.assertEqual(CODEC_WAVELET, e.codec)
+
+        e = QOWIEncoder(quantization_step=4, codec=CODEC_SPATIAL)
+        e.from_array(source_image)
+        e.to_bitstream(BitStream())
+        with self.assertRaises(ValueError):
+            e.encode()
+
+    def test_progress_hook(self):
+        source_image = TEST_IMAGES[3]
+        encoded_bits = BitStream()
+        encode_progress, decode_progress = [], []
+
+        e = QOWIEncoder(wavelet_encode_levels=10, progress_hook=lambda progress, total: encode_progress.append((progress, total)))
+        e.from_array(source_image)
+        e.to_bitstream(encoded_bits)
+        e.encode()
+
+        d = QOWIDecoder(progress_hook=lambda progress, total: decode_progress.append((progress, total)))
+        d.from_bitstream(encoded_bits)
+        d.decode()
+
+        self.assertTrue(np.array_equal(d.as_array(), source_image))
+        self.assertEqual(encode_progress, decode_progress)
+        self.assertEqual(encode_progress[0], (1, d._wavelet.length ** 2 - 1))
+
+    def test_round_trip_scratch_dir(self):
+        source_image = TEST_IMAGES[3]
+        scratch_dir = tempfile.mkdtemp()
+        encoded_bits = BitStream()
+
+        e = QOWIEncoder(wavelet_encode_levels=10, zerotrees=True, scratch_dir=scratch_dir, codec=None)
+        e.from_array(source_image)
+        e.to_bitstream(encoded_bits)
+        e.encode()
+
+        # the predictors are chosen band by band from the scratch files, as they would be in memory
+        in_memory_bits = BitStream()
+        e = QOWIEncoder(wavelet_encode_levels=10, zerotrees=True, codec=CODEC_WAVELET)
+        e.from_array(source_image)
+        e.to_bitstream(in_memory_bits)
+        e.encode()
+        self.assertEqual(in_memory_bits, encoded_bits)
+
+        d = QOWIDecoder(scratch_dir=scratch_dir)
+        d.from_bitstream(encoded_bits)
+        d.decode()
+
+        self.assertTrue(np.array_equal(d.as_array(), source_image))
+        self.assertEqual(os.listdir(scratch_dir), [])
+
+        # targets and embedded coding need the whole wavelet in memory
+        for embedded, target_bytes in [(False, 100), (True, None)]:
+            e = QOWIEncoder(wavelet_encode_levels=10, embedded=embedded, scratch_dir=scratch_dir)
+            e.from_array(source_image)
+            e.to_bitstream(BitStream())
+            with self.assertRaises(ValueError):
+                e.encode(target_bytes=target_bytes)
+
+    def test_truncated_embedded(self):
+        source_image = TEST_IMAGES[3]
+        encoded_bits = BitStream()
+
+        e = QOWIEncoder(embedded=True)
+        e.from_array(source_image)
+        e.to_bitstream(encoded_bits)
+        e.encode()
+
+        d = QOWIDecoder()
+        d.from_bitstream(BitStream(encoded_bits[:encoded_bits.len // 2]))
+        d.decode()
+        decoded_image = d.as_array()
+
+        self.assertTrue(d.truncated)
+        self.assertEqual(decoded_image.shape, source_image.shape)
+        self.assertLess(np.mean(np.abs(decoded_image.astype(np.int64) - source_image)), 16)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,12 @@
 import numpy as np
+import os
 import unittest
 
 from bitstring import BitStream
+from skimage import io
 
+from qowi.header import CODEC_WAVELET
+from qowi.qowi_decoder import QOWIDecoder
 from qowi.qowi_encoder import QOWIEncoder
 from qowi.wavelet import Wavelet
 
@@ -88,6 +92,103 @@ class TestQOWIEncoder(unittest.TestCase):
         e.encode()
         self.assertGreater(bitstream.len, 32)
 
+    def test_estimate_size_matches_encoded_size(self):
+        for hard_threshold in (-1, 1, 4):
+            for source_image in TEST_IMAGES:
+                e = QOWIEncoder(hard_threshold=hard_threshold)
+                e.from_array(source_image)
+                estimated_size = e.estimate_size()
+
+                bitstream = BitStream()
+                e.to_bitstream(bitstream)
+                e.encode()
+
+                self.assertEqual(bitstream.len, estimated_size)
+
+    def test_encode_from_prepared_wavelet(self):
+        source_image = TEST_IMAGES[3]
+        wavelet = Wavelet(wavelet_levels=2).prepare_from_image(source_image)
+        expected_coefficients = wavelet.wavelet.copy()
+
+        expected = BitStream()
+        e = QOWIEncoder(hard_threshold=4)
+        e.from_array(source_image)
+        e.to_bitstream(expected)
+        e.encode()
+
+        observed = BitStream()
+        e = QOWIEncoder(hard_threshold=4)
+        e.from_array(source_image, wavelet)
+        e.to_bitstream(observed)
+        e.encode()
+
+        self.assertEqual(expected, observed)
+        self.assertTrue(np.array_equal(expected_coefficients, wavelet.wavelet))
+
+    def test_encode_to_target_bytes(self):
+        lossless_bits = BitStream()
+        e = QOWIEncoder()
+        e.from_array(TEST_IMAGES[3])
+        e.to_bitstream(lossless_bits)
+        e.encode()
+
+        target_bytes = lossless_bits.len // 8 // 2
+        bitstream = BitStream()
+        e = QOWIEncoder()
+        e.from_array(TEST_IMAGES[3])
+        e.to_bitstream(bitstream)
+        e.encode(target_bytes=target_bytes)
+
+        self.assertLessEqual(bitstream.len // 8, target_bytes)
+
+    def test_encode_embedded_to_target_bytes(self):
+        lossless_bits = BitStream()
+        e = QOWIEncoder(embedded=True)
+        e.from_array(TEST_IMAGES[3])
+        e.to_bitstream(lossless_bits)
+        e.encode()
+
+        target_bytes = lossless_bits.len // 8 // 2
+        bitstream = BitStream()
+        e = QOWIEncoder(embedded=True)
+        e.from_array(TEST_IMAGES[3])
+        e.to_bitstream(bitstream)
+        e.encode(target_bytes=target_bytes)
+
+        self.assertEqual(bitstream.len // 8, target_bytes)
+        self.assertEqual(bitstream, lossless_bits[:target_bytes * 8])
+
+    def test_encode_to_target_psnr(self):
+        source_image = TEST_IMAGES[3]
+        bitstream = BitStream()
+        e = QOWIEncoder()
+        e.from_array(source_image)
+        e.to_bitstream(bitstream)
+        e.encode(target_psnr=30)
+
+        d = QOWIDecoder()
+        d.from_bitstream(bitstream)
+        d.decode()
+        decoded_image = d.as_array()
+
+        mse = np.mean((source_image.astype(np.float64) - decoded_image) ** 2)
+        self.assertGreater(mse, 0)
+        self.assertGreaterEqual(10 * np.log10(255 ** 2 / mse), 30)
+
+    def test_encode_with_both_targets(self):
+        e = QOWIEncoder()
+        e.from_array(TEST_IMAGES[3])
+        e.to_bitstream(BitStream())
+        with self.assertRaises(ValueError):
+            e.encode(target_bytes=100, target_psnr=30)
+
+    def test_auto_codec_picks_the_smaller(self):
+        # a photo, where the wavelet is smaller over the whole image though not on a crop of it
+        source_image = io.imread(os.path.join(os.path.dirname(__file__), "..", "media", "mango_512x512.jpg"))
+        e = QOWIEncoder(wavelet_encode_levels=10, codec=None)
+        e.from_array(source_image)
+        self.assertEqual(CODEC_WAVELET, e._choose_codec(False))
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,63 @@
+import numpy as np
+import unittest
+from bitstring import BitStream
+from qowi.sequence import SequenceDecoder, SequenceEncoder
+
+
+def _frames(num_frames):
+    """A noisy background with a square moving across it, and a still frame at the end."""
+    background = np.random.default_rng(0).integers(0, 256, size=(16, 16, 3)).astype(np.uint8)
+    frames = []
+    for k in range(num_frames - 1):
+        frame = background.copy()
+        frame[4:8, k:k + 4] = (255, 0, 0)
+        frames.append(frame)
+    frames.append(frames[-1].copy())
+    return frames
+
+
+def _encode(frames, **kwargs):
+    encoded_bits = BitStream()
+    e = SequenceEncoder(wavelet_encode_levels=10, **kwargs)
+    e.to_bitstream(encoded_bits)
+    for frame in frames:
+        e.add_frame(frame)
+    return e, encoded_bits
+
+
+class TestSequence(unittest.TestCase):
+
+    def test_round_trip(self):
+        frames = _frames(6)
+        for color_transform in [0, 1]:
+            e, encoded_bits = _encode(frames, keyframe_interval=4, color_transform=color_transform, zerotrees=True)
+
+            d = SequenceDecoder()
+            d.from_bitstream(encoded_bits)
+            self.assertEqual(d.num_frames, len(frames))
+            self.assertEqual(d.keyframes(), [0, 4])
+            for decoded_frame, frame in zip(d.frames(), frames):
+                self.assertTrue(np.array_equal(decoded_frame, frame))
+
+            # the residual frames are much smaller than the keyframes, and a repeated frame costs almost nothing
+            self.assertLess(max(e.frame_sizes[1:4]), e.frame_sizes[0] / 4)
+            self.assertLess(e.frame_sizes[-1], 32)
+
+    def test_seek(self):
+        frames = _frames(7)
+        _, encoded_bits = _encode(frames, keyframe_interval=3)
+
+        d = SequenceDecoder()
+        d.from_bitstream(encoded_bits)
+        for index in [5, 1, 2, 6, 0]:
+            self.assertTrue(np.array_equal(d.frame(index), frames[index]))
+        with self.assertRaises(IndexError):
+            d.frame(7)
+
+    def test_mismatched_frames(self):
+        e, _ = _encode(_frames(2))
+        with self.assertRaises(ValueError):
+            e.add_frame(np.zeros((8, 16, 3), dtype=np.uint8))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import numpy as np
+import unittest
+from bitstring import BitStream
+from qowi.spatial_decoder import SpatialDecoder
+from qowi.spatial_encoder import SpatialEncoder
+
+
+def _round_trip(source_image):
+    encoded_bits = BitStream()
+    e = SpatialEncoder()
+    e.from_array(source_image)
+    e.to_bitstream(encoded_bits)
+    e.encode()
+
+    d = SpatialDecoder()
+    d.from_bitstream(encoded_bits)
+    d.decode()
+    return encoded_bits, d.as_array()
+
+
+class TestSpatialDecoder(unittest.TestCase):
+
+    def test_round_trip_random(self):
+        source_image = np.random.default_rng(0).integers(0, 256, size=(13, 7, 3)).astype(np.uint8)
+        _, decoded_image = _round_trip(source_image)
+        self.assertTrue(np.array_equal(decoded_image, source_image))
+
+    def test_round_trip_runs(self):
+        source_image = np.zeros((16, 16, 3), dtype=np.uint8)
+        source_image[4:12, 2:14] = (200, 10, 30)
+        source_image[15, 15] = (128, 128, 128)
+        encoded_bits, decoded_image = _round_trip(source_image)
+
+        self.assertTrue(np.array_equal(decoded_image, source_image))
+        self.assertEqual(0, encoded_bits.len % 8)
+        self.assertLess(encoded_bits.len, 600)
+
+    def test_round_trip_four_channels(self):
+        source_image = np.random.default_rng(1).integers(0, 256, size=(8, 8, 4)).astype(np.uint8)
+        source_image[:, :, 3] = 255
+        _, decoded_image = _round_trip(source_image)
+        self.assertTrue(np.array_equal(decoded_image, source_image))
+
+    def test_round_trip_grayscale(self):
+        source_image = np.arange(64, dtype=np.uint8).reshape(8, 8)
+        _, decoded_image = _round_trip(source_image)
+        self.assertTrue(np.array_equal(decoded_image[:, :, 0], source_image))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import pathlib
 import numpy as np
+import tempfile
 import unittest
-from qowi.wavelet import Wavelet, haar_decode, haar_encode
+from unittest import mock
+from qowi.wavelet import FILTERS, PARALLEL_MIN_LENGTH, Wavelet, coefficient_position, haar_decode, haar_encode, max_coefficient_magnitude, storage_dtype, subtree_size, traversal_order
 from skimage import io
 
 TEST_IMAGES = [
@@ -120,6 +122,112 @@ class TestWavelet(unittest.TestCase):
         wavelet_image = w.as_image()
         self.assertTrue(np.array_equal(source_image, wavelet_image))
 
+    def test_max_coefficient_magnitude(self):
+        self.assertEqual(255, max_coefficient_magnitude(8, 0, 0))
+        self.assertEqual(1020, max_coefficient_magnitude(8, 1, 0))
+        self.assertEqual(255 * 4 ** 5, max_coefficient_magnitude(8, 5, 0))
+        self.assertLess(max_coefficient_magnitude(8, 5, 4), max_coefficient_magnitude(8, 5, 0))
+
+    def test_storage_dtype(self):
+        self.assertEqual(np.int16, storage_dtype(max_coefficient_magnitude(8, 2, 0)))
+        self.assertEqual(np.int32, storage_dtype(max_coefficient_magnitude(8, 3, 0)))
+        self.assertEqual(np.int64, storage_dtype(max_coefficient_magnitude(8, 15, 0)))
+
+    def test_generate_round_trip_full_255s_minimal_dtype(self):
+        source_image = np.full((2 ** 5, 2 ** 5, 3), 255, dtype=np.uint8)
+        for wavelet_levels in range(6):
+            w = Wavelet(wavelet_levels=wavelet_levels).prepare_from_image(source_image)
+            self.assertEqual(storage_dtype(max_coefficient_magnitude(8, wavelet_levels, 0)), w.wavelet.dtype)
+            self.assertTrue(np.array_equal(source_image, w.as_image()))
+
+    def test_traversal_order_matches_quad_tree_walk(self):
+        num_levels = 4
+        expected = []
+        stack = [(0, 1, 1), (0, 1, 0), (0, 0, 1)]
+        while len(stack) > 0:
+            level, i, j = stack.pop()
+            expected.append((i, j))
+            if level + 1 < num_levels:
+                for di, dj in ((0, 0), (0, 1), (1, 0), (1, 1)):
+                    stack.append((level + 1, 2 * i + di, 2 * j + dj))
+
+        rows, cols = traversal_order(num_levels)
+        self.assertEqual(expected, list(zip(rows.tolist(), cols.tolist())))
+
+    def test_subtree_maxima(self):
+        w = Wavelet(wavelet_levels=10).prepare_from_image(TEST_IMAGES[-1])
+        w.apply_hard_threshold(20)
+        maxima = w.subtree_maxima()
+        self.assertEqual(len(maxima), w.num_levels)
+
+        def walk(level, filter, i, j):
+            ret = int(np.max(np.abs(w.wavelet[coefficient_position(level, filter, i, j)])))
+            count = 1
+            if level + 1 < w.num_levels:
+                for di, dj in ((0, 0), (0, 1), (1, 0), (1, 1)):
+                    child_max, child_count = walk(level + 1, filter, 2 * i + di, 2 * j + dj)
+                    ret = max(ret, child_max)
+                    count += child_count
+            return ret, count
+
+        for level in range(w.num_levels):
+            for band, filter in enumerate(FILTERS):
+                for i in range(2 ** level):
+                    for j in range(2 ** level):
+                        expected_max, expected_count = walk(level, filter, i, j)
+                        self.assertEqual(expected_max, maxima[level][band, i, j])
+                        self.assertEqual(expected_count, subtree_size(level, w.num_levels))
+
+    def test_quantization_steps(self):
+        w = Wavelet(wavelet_levels=2).prepare_from_image(np.zeros((8, 8, 3), dtype=np.uint8))
+
+        self.assertEqual([], w.quantization_steps(1))
+        self.assertEqual([(1, 1, 1), (8, 8, 16), (4, 4, 8)], w.quantization_steps(2, subband_weights=(1, 1, 2)))
+
+    def test_quantize_dequantize(self):
+        w = Wavelet(wavelet_levels=3).prepare_from_image(TEST_IMAGES[-1])
+        steps = w.quantization_steps(3)
+        expected = w.wavelet.astype(np.int64)
+
+        w.quantize(steps)
+        for level, level_steps in enumerate(steps):
+            for band, step in zip(w.detail_bands(level), level_steps):
+                self.assertLessEqual(np.max(np.abs(band)), np.max(np.abs(expected)) // step)
+
+        w.dequantize(steps)
+        for level, level_steps in enumerate(steps):
+            original_bands = [expected[:2 ** level, 2 ** level:2 ** (level + 1)],
+                              expected[2 ** level:2 ** (level + 1), :2 ** level],
+                              expected[2 ** level:2 ** (level + 1), 2 ** level:2 ** (level + 1)]]
+            for band, original, step in zip(w.detail_bands(level), original_bands, level_steps):
+                # the dead zone maps small coefficients to zero and the rest to the middle of their bin
+                self.assertTrue(np.all(np.abs(band - original) <= np.where(band == 0, step - 1, step // 2)))
+                self.assertTrue(np.all(band * original >= 0))
+
+    def test_threaded_transform(self):
+        source_image = np.random.default_rng(0).integers(0, 256, size=(PARALLEL_MIN_LENGTH, PARALLEL_MIN_LENGTH - 3, 3))
+        for precision_digits in [0, 3]:
+            serial = Wavelet(precision_digits=precision_digits, threads=1).prepare_from_image(source_image)
+            threaded = Wavelet(precision_digits=precision_digits, threads=3).prepare_from_image(source_image)
+            self.assertTrue(np.array_equal(serial.wavelet, threaded.wavelet))
+            self.assertTrue(np.array_equal(serial.as_array(), threaded.as_array()))
+            if precision_digits == 0:
+                self.assertTrue(np.array_equal(threaded.as_array(), source_image))
+
+    def test_scratch_backed_transform(self):
+        source_image = np.random.default_rng(0).integers(0, 256, size=(37, 29, 3))
+        scratch_dir = tempfile.mkdtemp()
+        for precision_digits in [0, 3]:
+            in_memory = Wavelet(precision_digits=precision_digits).prepare_from_image(source_image)
+
+            # a tiny block size makes every level span several bands of rows
+            with mock.patch("qowi.wavelet.SCRATCH_BLOCK_BYTES", 256):
+                scratch_backed = Wavelet(precision_digits=precision_digits, scratch_dir=scratch_dir).prepare_from_image(source_image)
+                self.assertIsInstance(scratch_backed.wavelet, np.memmap)
+                self.assertTrue(np.array_equal(in_memory.wavelet, scratch_backed.wavelet))
+                self.assertTrue(np.array_equal(in_memory.as_array(), scratch_backed.as_array()))
+                self.assertIsInstance(scratch_backed.copy().wavelet, np.memmap)
+
     def test_round_trip_all_files_in_media_folder(self):
         training_image_dir = pathlib.Path("../media")
         media_directory = [item for item in training_image_dir.rglob('*')]
@@ -1,83 +1,57 @@
 import numpy as np
 import pandas as pd
+from qowi.op_stats import OP_NAMES, OpStats
 
-def op_code_frequency(df):
+def op_code_frequency(stats: OpStats):
     # Count occurrences of each op_code
-    op_code_counts = df['op_code'].value_counts()
+    op_code_counts = sorted(stats.op_counts.items(), key=lambda item: -item[1])
 
     # Create a simple table with op_code values and their counts
-    ret = pd.DataFrame(op_code_counts).reset_index()
-    ret.columns = ['op_code', 'count']
+    return pd.DataFrame(op_code_counts, columns=['op_code', 'count'])
 
-    return ret
-
-
-def op_code_max_values(df):
-    # Fill missing values with 0 and convert to integers
-    df['run_length'] = df['run_length'].fillna(0).astype(int)
-    df['index'] = df['index'].fillna(0).astype(int)
 
-    # Calculate max run_length for RUN
-    max_run_length = df[df['op_code'] == 'RUN']['run_length'].max()
-
-    # Calculate max index for CACHE
-    max_index_cache = df[df['op_code'] == 'CACHE']['index'].max()
+def op_code_max_values(stats: OpStats):
+    # the cache positions are counted individually, so the largest used is the last non-zero count
+    cache_positions = np.flatnonzero(stats.cache_positions)
+    max_index_cache = int(cache_positions[-1]) if len(cache_positions) > 0 else 0
 
     # Create a result table
     ret = pd.DataFrame({
         'Metric': ['Max Run Length (RUN)', 'Max Index (CACHE)'],
-        'Value': [max_run_length, max_index_cache]
+        'Value': [stats.max_run_length, max_index_cache]
     })
 
     return ret
 
 
-def rgb_frequency_histogram(df):
-    # Convert diff columns to float
-    df['uint10_r'] = df['uint10_r'].astype(float)
-    df['uint10_g'] = df['uint10_g'].astype(float)
-    df['uint10_b'] = df['uint10_b'].astype(float)
-
-    # Filter rows where op_code is "VALUE"
-    filtered_df = df[df['op_code'] == "VALUE"]
+def _bit_length_labels(num_bins):
+    # bit length b holds the values [2 ** (b - 1), 2 ** b - 1], and 0 on its own
+    return ["0-0"] + [f"{1 << (b - 1)}-{(1 << b) - 1}" for b in range(1, num_bins)]
 
-    # Define variable-sized bins
-    bins = [0]
-    multiplier = 1
-    while bins[-1] < 256:
-        bins.append(bins[-1] + multiplier)
-        multiplier *= 2
 
-    # Define labels for the bins
-    labels = [f"{bins[i]}-{bins[i + 1] - 1}" for i in range(len(bins) - 1)]
-
-    # Calculate histogram counts for each diff column
-    hist_r = pd.cut(filtered_df['uint10_r'].abs(), bins=bins, labels=labels, right=False).value_counts().sort_index()
-    hist_g = pd.cut(filtered_df['uint10_g'].abs(), bins=bins, labels=labels, right=False).value_counts().sort_index()
-    hist_b = pd.cut(filtered_df['uint10_b'].abs(), bins=bins, labels=labels, right=False).value_counts().sort_index()
+def rgb_frequency_histogram(stats: OpStats):
+    # the VALUE magnitudes are binned by bit length, which are the powers of two bins
+    channels = [channel for channel in range(len(stats.value_magnitudes)) if stats.value_magnitudes[channel].any()]
+    used_bins = np.flatnonzero(stats.value_magnitudes.any(axis=0))
+    num_bins = int(used_bins[-1]) + 1 if len(used_bins) > 0 else 1
 
     # Create a histogram table
-    ret = pd.DataFrame({
-        'Range': labels,
-        'uint10_r': hist_r.values,
-        'uint10_g': hist_g.values,
-        'uint10_b': hist_b.values
-    })
+    ret = pd.DataFrame({"RGBA"[channel]: stats.value_magnitudes[channel, :num_bins] for channel in channels},
+                       index=_bit_length_labels(num_bins))
+    ret.index.name = "Range"
 
     return ret
 
 
-def op_code_num_bits_frequency_histgram(df):
-    # Define bins and labels for the histogram
-    bins = np.arange(2, 62, 2)  # Increments of 1 from 1 to 60
+def op_code_num_bits_frequency_histgram(stats: OpStats):
+    # Define bins of two bits from 2 to 60
+    bins = np.arange(2, 62, 2)
 
-    # Calculate histogram counts for each op_code
-    op_code_values = df['op_code'].unique()
+    # Sum the counts of each op_code over each bin
     histogram_data = {}
-    for op_code in op_code_values:
-        filtered_df = df[df['op_code'] == op_code]
-        hist_counts = pd.cut(filtered_df['num_bits'], bins=bins, right=False).value_counts().sort_index()
-        histogram_data[op_code] = hist_counts.values
+    for op_code, name in enumerate(OP_NAMES):
+        if stats.op_bits[op_code].any():
+            histogram_data[name] = np.add.reduceat(stats.op_bits[op_code, :bins[-1]], bins[:-1])
 
     # Create a histogram table
     ret = pd.DataFrame(histogram_data, index=[f"{int(bins[i])}" for i in range(len(bins) - 1)])